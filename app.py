@@ -1,27 +1,66 @@
-from flask import Flask, render_template, jsonify, request, Response
+from flask import Flask, render_template, jsonify, request, Response, g
 import os
 import json
+import base64
 import re
 import time
 import shutil
 from collections import Counter
 from database import (
-    get_db, init_db, migrate_db, buscar_duplicados, eliminar_duplicados,
-    obtener_estadisticas, busqueda_fulltext, reconstruir_fts, generar_hash, DB_NAME
+    get_db, liberar_db, migrate_db, buscar_duplicados, eliminar_duplicados,
+    obtener_estadisticas, busqueda_fulltext, resaltar_letra, mantenimiento_fts, generar_hash, generar_huella, DB_NAME,
+    escritor, escribir_lote, estadistica_materializada, filtro_categoria, CATEGORIAS,
+    normalizar_nombre, resolver_entidad, expresion_trigrama, SQL_GUARDAR_CONTENIDO,
+    comprimir_analisis, leer_analisis, COLUMNAS_FTS, FRAGMENTO_TOKENS,
+    consultas, instrumentar_consultas, CONSULTAS_UMBRAL_MS, LONGITUD_MIN_ANALISIS, LONGITUD_MIN_ALEATORIO
 )
 from metadata_extractor import extraer_metadata, normalizar_letra, evaluar_calidad
 from scraper import ejecutar_scraper
 from scraper_letrasdecarnaval import iniciar_scraper as ldc_iniciar, detener_scraper as ldc_detener, obtener_progreso as ldc_progreso
 from scraper_huggingface import ejecutar_importador_huggingface
 from poetry_analyzer import analizar_letra, analizar_corpus
+from copias_seguridad import (
+    iniciar_copia, obtener_progreso as copias_progreso, iniciar_programador,
+    COPIA_INTERVALO_HORAS, COPIA_RETENCION,
+)
+from mantenimiento_db import (
+    ejecutar_mantenimiento, convertir_auto_vacuum, obtener_estado as mantenimiento_estado,
+    iniciar_mantenimiento_programado, MANTENIMIENTO_INTERVALO_S,
+)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 app = Flask(__name__)
 
-# Inicializar y migrar DB
-init_db()
+# Crear/migrar el esquema (no hace nada si ya esta al dia)
 migrate_db()
 
+# Copias de seguridad periodicas (COPIAS_INTERVALO_HORAS=0 las desactiva)
+iniciar_programador(
+    float(os.environ.get("COPIAS_INTERVALO_HORAS", COPIA_INTERVALO_HORAS)),
+    int(os.environ.get("COPIAS_RETENCION", COPIA_RETENCION)),
+)
+
+# Tiempos por consulta y log de consultas lentas (CONSULTAS_INSTRUMENTADAS=1)
+if os.environ.get("CONSULTAS_INSTRUMENTADAS") == "1":
+    instrumentar_consultas(True, float(os.environ.get("CONSULTAS_UMBRAL_MS", CONSULTAS_UMBRAL_MS)))
+
+# Checkpoints, ANALYZE/optimize e incremental_vacuum (MANTENIMIENTO_INTERVALO_S=0 los desactiva)
+iniciar_mantenimiento_programado(float(os.environ.get("MANTENIMIENTO_INTERVALO_S", MANTENIMIENTO_INTERVALO_S)))
+
+
+def db():
+    """Conexion de la peticion actual: se toma del pool una sola vez por peticion."""
+    if "db" not in g:
+        g.db = get_db()
+    return g.db
+
+
+@app.teardown_appcontext
+def liberar_db_peticion(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        liberar_db(conn)
+
 
 # =========================
 # RUTAS WEB
@@ -51,57 +90,140 @@ def pagina_agrupacion(nombre):
 # API: LETRAS (PAGINADA)
 # =========================
 
+# Orden de /api/letras: columna, sentido. El id desempata y hace estable
+# tanto la paginacion por offset como la paginacion por cursor (?after=)
+ORDENES_LETRAS = {
+    "titulo": ("titulo", "ASC"),
+    "anio": ("anio", "ASC"),
+    "modalidad": ("modalidad", "ASC"),
+    "calidad": ("calidad", "DESC"),
+}
+
+# Tamano de pagina maximo de /api/letras
+PER_PAGE_MAX = 500
+
+
+def codificar_cursor(valor, letra_id):
+    """Cursor opaco con la clave de orden y el id de la ultima fila."""
+    crudo = json.dumps([valor, letra_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(crudo).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(cursor_txt):
+    """Devuelve (valor, id) o lanza ValueError si el cursor no es valido."""
+    try:
+        crudo = base64.urlsafe_b64decode(cursor_txt + "=" * (-len(cursor_txt) % 4))
+        valor, letra_id = json.loads(crudo.decode("utf-8"))
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError("Cursor no valido")
+    # El valor va tal cual a los parametros del seek: solo tipos que SQLite enlaza
+    if (not isinstance(letra_id, int) or isinstance(letra_id, bool)
+            or not isinstance(valor, (str, int, float, type(None)))):
+        raise ValueError("Cursor no valido")
+    return valor, letra_id
+
+
+def tramos_seek(columna, sentido, valor, letra_id):
+    """Condiciones que continuan justo despues de (valor, id), en orden.
+
+    SQLite ordena los NULL primero en ASC y ultimos en DESC; el NULL va en
+    su propio tramo para que cada condicion siga siendo un rango del indice.
+    """
+    if sentido == "ASC":
+        if valor is None:
+            return [(f"{columna} IS NULL AND id > ?", [letra_id]), (f"{columna} IS NOT NULL", [])]
+        return [(f"({columna}, id) > (?, ?)", [valor, letra_id])]
+    if valor is None:
+        return [(f"{columna} IS NULL AND id < ?", [letra_id])]
+    return [(f"({columna}, id) < (?, ?)", [valor, letra_id]), (f"{columna} IS NULL", [])]
+
+
 @app.route("/api/letras")
 def obtener_letras():
     anio = request.args.get("anio")
     modalidad = request.args.get("modalidad")
     tipo_pieza = request.args.get("tipo_pieza")
     agrupacion = request.args.get("agrupacion")
-    page = int(request.args.get("page", 1))
-    per_page = int(request.args.get("per_page", 50))
+    page = max(1, int(request.args.get("page", 1)))
+    per_page = max(1, min(int(request.args.get("per_page", 50)), PER_PAGE_MAX))
     orden = request.args.get("orden", "titulo")
+    after = request.args.get("after")
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    query = "SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion, calidad FROM letras WHERE 1=1"
-    count_query = "SELECT COUNT(*) as total FROM letras WHERE 1=1"
+    where = ""
     params = []
 
     if anio:
-        query += " AND anio=?"
-        count_query += " AND anio=?"
+        where += " AND anio=?"
         params.append(anio)
     if modalidad:
-        query += " AND modalidad=?"
-        count_query += " AND modalidad=?"
+        where += " AND " + filtro_categoria("modalidades")
         params.append(modalidad)
     if tipo_pieza:
-        query += " AND tipo_pieza=?"
-        count_query += " AND tipo_pieza=?"
+        where += " AND " + filtro_categoria("tipos_pieza")
         params.append(tipo_pieza)
     if agrupacion:
-        query += " AND agrupacion LIKE ?"
-        count_query += " AND agrupacion LIKE ?"
-        params.append(f"%{agrupacion}%")
+        expresion = expresion_trigrama("agrupacion", agrupacion)
+        if expresion:
+            where += " AND id IN (SELECT rowid FROM letras_trigrama WHERE letras_trigrama MATCH ?)"
+            params.append(expresion)
+        else:
+            # Menos de 3 caracteres: subcadena sobre la tabla de agrupaciones
+            where += """ AND id IN (
+                SELECT la.letra_id FROM letra_agrupacion la
+                JOIN agrupaciones a ON a.id = la.agrupacion_id
+                WHERE instr(a.nombre_norm, ?) > 0)"""
+            params.append(normalizar_nombre(agrupacion))
+
+    # Orden
+    columna, sentido = ORDENES_LETRAS.get(orden, ORDENES_LETRAS["titulo"])
+    orden_sql = f" ORDER BY {columna} {sentido}, id {sentido}"
+    query = "SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion, calidad FROM letras WHERE 1=1"
+
+    # Paginacion por cursor: busca directamente tras la ultima fila vista
+    # en vez de recorrer y descartar OFFSET filas, y no recuenta el total
+    if after is not None:
+        tramos = [("1=1", [])]
+        if after:
+            try:
+                valor, ultimo_id = decodificar_cursor(after)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            tramos = tramos_seek(columna, sentido, valor, ultimo_id)
+
+        rows = []
+        for condicion, seek_params in tramos:
+            cursor.execute(
+                query + where + f" AND {condicion}" + orden_sql + " LIMIT ?",
+                params + seek_params + [per_page + 1 - len(rows)]
+            )
+            rows += cursor.fetchall()
+            if len(rows) > per_page:
+                break
+
+        letras = [dict(r) for r in rows[:per_page]]
+
+        siguiente = None
+        if len(rows) > per_page:
+            ultima = letras[-1]
+            siguiente = codificar_cursor(ultima[columna], ultima["id"])
+
+        return jsonify({
+            "letras": letras,
+            "per_page": per_page,
+            "next_cursor": siguiente
+        })
 
     # Total
-    cursor.execute(count_query, params)
+    cursor.execute("SELECT COUNT(*) as total FROM letras WHERE 1=1" + where, params)
     total = cursor.fetchone()["total"]
 
-    # Orden
-    ordenes_validos = {"titulo": "titulo", "anio": "anio", "modalidad": "modalidad", "calidad": "calidad DESC"}
-    orden_sql = ordenes_validos.get(orden, "titulo")
-    query += f" ORDER BY {orden_sql}"
-
     # Paginacion
     offset = (page - 1) * per_page
-    query += " LIMIT ? OFFSET ?"
-    params.extend([per_page, offset])
-
-    cursor.execute(query, params)
+    cursor.execute(query + where + orden_sql + " LIMIT ? OFFSET ?", params + [per_page, offset])
     rows = cursor.fetchall()
-    conn.close()
 
     letras = [dict(r) for r in rows]
 
@@ -116,16 +238,28 @@ def obtener_letras():
 
 @app.route("/api/letra/<int:letra_id>")
 def obtener_letra(letra_id):
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM letras WHERE id=?", (letra_id,))
+    cursor.execute("SELECT * FROM letras_completas WHERE id=?", (letra_id,))
     row = cursor.fetchone()
-    conn.close()
 
     if not row:
         return jsonify({"error": "No encontrada"}), 404
 
-    return jsonify(dict(row))
+    letra = dict(row)
+    letra["analisis_poetico"] = leer_analisis(letra["analisis_poetico"])
+    # Entero de 64 bits: en JS pierde precision y solo sirve para deduplicar
+    letra.pop("huella", None)
+    # Codigos internos de los diccionarios: el texto ya va en la respuesta
+    for definicion in CATEGORIAS.values():
+        letra.pop(definicion["fk"], None)
+    # Copias de otras fuentes fusionadas en esta al deduplicar
+    cursor.execute(
+        "SELECT origen_id, fuente, url, fecha_fusion FROM letras_procedencia WHERE letra_id=? ORDER BY id",
+        (letra_id,),
+    )
+    letra["procedencia"] = [dict(r) for r in cursor.fetchall()]
+    return jsonify(letra)
 
 
 # =========================
@@ -137,16 +271,57 @@ def buscar():
     q = request.args.get("q", "").strip()
     limit = int(request.args.get("limit", 50))
     offset = int(request.args.get("offset", 0))
+    # Fragmento de `tokens` palabras de `columna` ("auto": la que mejor encaje)
+    columna = request.args.get("columna", "contenido")
+    # No numerico: el valor por defecto; el rango lo acota busqueda_fulltext
+    tokens = request.args.get("tokens", FRAGMENTO_TOKENS, type=int)
+    # facetas=1: conteos por modalidad, decada, tipo y agrupacion de todos los aciertos
+    con_facetas = request.args.get("facetas") == "1"
+
+    if columna == "auto":
+        columna = None
+    elif columna not in COLUMNAS_FTS:
+        return jsonify({"error": f"columna debe ser auto o una de: {', '.join(COLUMNAS_FTS)}"}), 400
 
     if not q or len(q) < 2:
         return jsonify({"resultados": [], "total": 0})
 
-    resultados = busqueda_fulltext(q, limit, offset)
-    return jsonify({
+    try:
+        resultados, total, facetas = busqueda_fulltext(
+            q, limit, offset, columna=columna, tokens=tokens, facetas=con_facetas
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    respuesta = {
         "resultados": resultados,
-        "total": len(resultados),
+        "total": total,
         "query": q
-    })
+    }
+    if con_facetas:
+        respuesta["facetas"] = facetas
+    return jsonify(respuesta)
+
+
+@app.route("/api/buscar/<int:letra_id>")
+def buscar_en_letra(letra_id):
+    """Texto completo de un resultado con los aciertos de la busqueda marcados."""
+    q = request.args.get("q", "").strip()
+    columna = request.args.get("columna", "contenido")
+
+    if columna not in COLUMNAS_FTS:
+        return jsonify({"error": f"columna debe ser una de: {', '.join(COLUMNAS_FTS)}"}), 400
+    if not q or len(q) < 2:
+        return jsonify({"error": "Falta la busqueda (q)"}), 400
+
+    try:
+        resaltado = resaltar_letra(letra_id, q, columna)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if resaltado is None:
+        return jsonify({"error": "Sin coincidencias en esta letra"}), 404
+
+    return jsonify({"id": letra_id, "columna": columna, "resaltado": resaltado})
 
 
 # =========================
@@ -165,19 +340,18 @@ def estadisticas():
 
 @app.route("/api/filtros")
 def obtener_filtros():
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT DISTINCT anio FROM letras WHERE anio IS NOT NULL ORDER BY anio DESC")
+    cursor.execute("SELECT DISTINCT anio FROM agg_anio_modalidad WHERE anio IS NOT NULL ORDER BY anio DESC")
     anios = [r["anio"] for r in cursor.fetchall()]
 
-    cursor.execute("SELECT DISTINCT modalidad FROM letras WHERE modalidad IS NOT NULL ORDER BY modalidad")
+    cursor.execute("SELECT DISTINCT modalidad FROM agg_anio_modalidad WHERE modalidad IS NOT NULL ORDER BY modalidad")
     modalidades = [r["modalidad"] for r in cursor.fetchall()]
 
-    cursor.execute("SELECT DISTINCT tipo_pieza FROM letras WHERE tipo_pieza IS NOT NULL ORDER BY tipo_pieza")
+    cursor.execute("SELECT tipo_pieza FROM agg_tipo_pieza WHERE tipo_pieza IS NOT NULL ORDER BY tipo_pieza")
     tipos = [r["tipo_pieza"] for r in cursor.fetchall()]
 
-    conn.close()
 
     return jsonify({
         "anios": anios,
@@ -251,18 +425,22 @@ def lanzar_importador_huggingface():
 @app.route("/api/estadisticas_fuentes")
 def estadisticas_fuentes():
     """Estadísticas desglosadas por fuente de datos."""
-    conn = get_db()
+    return jsonify(estadistica_materializada("fuentes", calcular_estadisticas_fuentes))
+
+
+def calcular_estadisticas_fuentes(conn):
     cursor = conn.cursor()
 
     cursor.execute("""
-        SELECT fuente, COUNT(*) as total,
-               COUNT(DISTINCT anio) as anios,
-               COUNT(DISTINCT modalidad) as modalidades,
-               COUNT(DISTINCT agrupacion) as agrupaciones,
-               AVG(calidad) as calidad_media,
-               SUM(verificado) as verificadas
-        FROM letras
-        GROUP BY fuente
+        SELECT f.nombre as fuente, COUNT(*) as total,
+               COUNT(DISTINCT l.anio) as anios,
+               COUNT(DISTINCT l.modalidad_id) as modalidades,
+               COUNT(DISTINCT l.agrupacion) as agrupaciones,
+               AVG(l.calidad) as calidad_media,
+               SUM(l.verificado) as verificadas
+        FROM letras l
+        LEFT JOIN fuentes f ON f.id = l.fuente_id
+        GROUP BY l.fuente_id
         ORDER BY total DESC
     """)
     fuentes = []
@@ -277,8 +455,7 @@ def estadisticas_fuentes():
             "verificadas": r["verificadas"] or 0,
         })
 
-    conn.close()
-    return jsonify({"fuentes": fuentes})
+    return {"fuentes": fuentes}
 
 
 # =========================
@@ -288,35 +465,34 @@ def estadisticas_fuentes():
 @app.route("/api/cross_reference")
 def cross_reference():
     """Identifica letras que existen en múltiples fuentes vs exclusivas."""
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    # Letras con mismo hash en diferentes fuentes
+    # Letras con la misma huella en diferentes fuentes
     cursor.execute("""
-        SELECT contenido_hash, GROUP_CONCAT(DISTINCT fuente) as fuentes,
-               COUNT(DISTINCT fuente) as num_fuentes, COUNT(*) as copias
+        SELECT huella, COUNT(DISTINCT fuente_id) as num_fuentes, COUNT(*) as copias
         FROM letras
-        WHERE contenido_hash IS NOT NULL
-        GROUP BY contenido_hash
+        WHERE huella IS NOT NULL
+        GROUP BY huella
         HAVING num_fuentes > 1
     """)
     compartidas = cursor.fetchall()
 
     # Conteo por fuente exclusiva
     cursor.execute("""
-        SELECT fuente, COUNT(*) as exclusivas
-        FROM letras
-        WHERE contenido_hash IN (
-            SELECT contenido_hash FROM letras
-            WHERE contenido_hash IS NOT NULL
-            GROUP BY contenido_hash
-            HAVING COUNT(DISTINCT fuente) = 1
+        SELECT f.nombre as fuente, COUNT(*) as exclusivas
+        FROM letras l
+        LEFT JOIN fuentes f ON f.id = l.fuente_id
+        WHERE l.huella IN (
+            SELECT huella FROM letras
+            WHERE huella IS NOT NULL
+            GROUP BY huella
+            HAVING COUNT(DISTINCT fuente_id) = 1
         )
-        GROUP BY fuente
+        GROUP BY l.fuente_id
     """)
     exclusivas = {r["fuente"]: r["exclusivas"] for r in cursor.fetchall()}
 
-    conn.close()
 
     return jsonify({
         "compartidas_entre_fuentes": len(compartidas),
@@ -331,16 +507,17 @@ def cross_reference():
 
 @app.route("/api/enriquecer", methods=["POST"])
 def enriquecer_metadata():
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT id, titulo, etiquetas, contenido, url FROM letras")
+    cursor.execute("SELECT id, titulo, etiquetas, contenido, url FROM letras_completas")
     rows = cursor.fetchall()
 
     actualizados = 0
     limpiados = 0
     autores_encontrados = 0
 
+    cambios = []
     for row in rows:
         # Extraccion inteligente: titulo + etiquetas + URL
         metadata = extraer_metadata(row["titulo"], row["etiquetas"], row["url"])
@@ -355,51 +532,138 @@ def enriquecer_metadata():
         if metadata.get("autor"):
             autores_encontrados += 1
 
-        cursor.execute("""
-            UPDATE letras
-            SET anio=?, modalidad=?, tipo_pieza=?, agrupacion=?,
-                autor=?, calidad=?, contenido_hash=?, contenido=?
-            WHERE id=?
-        """, (
-            metadata["anio"],
-            metadata["modalidad"],
-            metadata["tipo_pieza"],
-            metadata["agrupacion"],
-            metadata.get("autor"),
-            calidad,
-            contenido_hash,
-            contenido_limpio or row["contenido"],
-            row["id"]
-        ))
+        cambios.append({
+            "anio": metadata["anio"],
+            "modalidad": metadata["modalidad"],
+            "tipo_pieza": metadata["tipo_pieza"],
+            "agrupacion": metadata["agrupacion"],
+            "autor": metadata.get("autor"),
+            "calidad": calidad,
+            "contenido_hash": contenido_hash,
+            "huella": generar_huella(row["contenido"]),
+            "contenido": contenido_limpio or row["contenido"],
+            "id": row["id"],
+        })
         actualizados += 1
 
-    conn.commit()
-    conn.close()
-
-    reconstruir_fts()
+    with mantenimiento_fts() as indice:
+        escribir_lote(("""
+            UPDATE letras
+            SET anio=:anio, modalidad=:modalidad, tipo_pieza=:tipo_pieza, agrupacion=:agrupacion,
+                autor=:autor, calidad=:calidad, contenido_hash=:contenido_hash, huella=:huella
+            WHERE id=:id
+        """, SQL_GUARDAR_CONTENIDO), cambios)
 
     return jsonify({
         "actualizados": actualizados,
         "limpiados": limpiados,
-        "autores_encontrados": autores_encontrados
+        "autores_encontrados": autores_encontrados,
+        "indice_fts": indice,
     })
 
 
+# =========================
+# API: ESCRITOR DE BD
+# =========================
+
+@app.route("/api/estado_escritor")
+def estado_escritor():
+    """Lotes procesados por el hilo escritor y su latencia (cola + transaccion)."""
+    return jsonify(escritor.estadisticas())
+
+
+# =========================
+# API: COPIAS DE SEGURIDAD
+# =========================
+
+@app.route("/api/copias")
+def ver_copias():
+    """Progreso de la copia en curso (o la ultima) y copias disponibles."""
+    return jsonify(copias_progreso())
+
+
+@app.route("/api/copias/crear", methods=["POST"])
+def crear_copia_ahora():
+    if iniciar_copia():
+        return jsonify({"ok": True, "mensaje": "Copia iniciada"})
+    return jsonify({"ok": False, "mensaje": "Ya hay una copia en curso"}), 409
+
+
+# =========================
+# API: INSTRUMENTACION DE CONSULTAS
+# =========================
+
+ORDENES_CONSULTAS = ("total_ms", "p95_ms", "max_ms", "llamadas", "filas")
+
+
+@app.route("/api/consultas")
+def ver_consultas():
+    """Sentencias que mas tiempo consumen y ultimas consultas lentas con su plan."""
+    orden = request.args.get("orden", "total_ms")
+    if orden not in ORDENES_CONSULTAS:
+        return jsonify({"error": f"orden debe ser uno de: {', '.join(ORDENES_CONSULTAS)}"}), 400
+    limit = int(request.args.get("limit", 20))
+    return jsonify(consultas.resumen(orden, limit))
+
+
+@app.route("/api/consultas", methods=["POST"])
+def configurar_consultas():
+    """Body JSON: `activo` (bool), `umbral_ms` y `reiniciar` (borra lo acumulado)."""
+    data = request.json or {}
+    umbral_ms = data.get("umbral_ms")
+    if umbral_ms is not None and (not isinstance(umbral_ms, (int, float)) or umbral_ms < 0):
+        return jsonify({"error": "umbral_ms debe ser un numero >= 0"}), 400
+    instrumentar_consultas(bool(data.get("activo", consultas.activo)), umbral_ms)
+    if data.get("reiniciar"):
+        consultas.reiniciar()
+    return jsonify(consultas.resumen())
+
+
+# =========================
+# API: MANTENIMIENTO DE LA BD
+# =========================
+
+@app.route("/api/mantenimiento")
+def ver_mantenimiento():
+    """Tamano del WAL, paginas libres y tiempos de las ultimas tareas."""
+    return jsonify(mantenimiento_estado())
+
+
+@app.route("/api/mantenimiento", methods=["POST"])
+def lanzar_mantenimiento():
+    """Ciclo de mantenimiento inmediato. Con {"vacuum": true} convierte la BD a auto_vacuum incremental."""
+    data = request.json or {}
+    if data.get("vacuum"):
+        convertir_auto_vacuum()
+    elif ejecutar_mantenimiento(forzar=True) is None:
+        return jsonify({"error": "Ya hay un ciclo de mantenimiento en curso"}), 409
+    return jsonify(mantenimiento_estado())
+
+
 # =========================
 # API: DEDUPLICACION
 # =========================
 
 @app.route("/api/duplicados")
 def ver_duplicados():
-    resultado = buscar_duplicados()
+    modo = request.args.get("modo", "exacto")
+    if modo not in ("exacto", "aproximado"):
+        return jsonify({"error": "modo debe ser 'exacto' o 'aproximado'"}), 400
+    try:
+        umbral = float(request.args.get("umbral", 0.90))
+    except ValueError:
+        return jsonify({"error": "umbral debe ser un numero"}), 400
+    if not 0 < umbral <= 1:
+        return jsonify({"error": "umbral debe estar entre 0 y 1"}), 400
+    resultado = buscar_duplicados(umbral, modo)
     return jsonify(resultado)
 
 
 @app.route("/api/deduplicar", methods=["POST"])
 def deduplicar():
-    eliminados = eliminar_duplicados()
-    reconstruir_fts()
-    return jsonify({"eliminados": eliminados})
+    with mantenimiento_fts() as indice:
+        resultado = eliminar_duplicados()
+    return jsonify({**resultado, "indice_fts": indice})
 
 
 # =========================
@@ -414,25 +678,24 @@ def generar_dataset():
     tipo_pieza = data.get("tipo_pieza")
     formato = data.get("formato", "simple")
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    query = "SELECT titulo, contenido, anio, modalidad, tipo_pieza, agrupacion FROM letras WHERE contenido IS NOT NULL"
+    query = "SELECT titulo, contenido, anio, modalidad, tipo_pieza, agrupacion FROM letras_completas WHERE contenido IS NOT NULL"
     params = []
 
     if modalidad:
-        query += " AND modalidad=?"
+        query += " AND " + filtro_categoria("modalidades")
         params.append(modalidad)
     if anio:
         query += " AND anio=?"
         params.append(anio)
     if tipo_pieza:
-        query += " AND tipo_pieza=?"
+        query += " AND " + filtro_categoria("tipos_pieza")
         params.append(tipo_pieza)
 
     cursor.execute(query, params)
     rows = cursor.fetchall()
-    conn.close()
 
     os.makedirs(os.path.join(BASE_DIR, "data"), exist_ok=True)
 
@@ -509,11 +772,10 @@ def export_static():
     os.makedirs(os.path.join(export_dir, "js"))
     os.makedirs(os.path.join(export_dir, "api"))
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion, contenido, url FROM letras")
+    cursor.execute("SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion, contenido, url FROM letras_completas")
     rows = cursor.fetchall()
-    conn.close()
 
     letras = [dict(r) for r in rows]
 
@@ -583,23 +845,22 @@ def export_static():
 
 @app.route("/api/limpiar_textos", methods=["POST"])
 def limpiar_textos():
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT id, contenido FROM letras WHERE contenido IS NOT NULL")
+    cursor.execute("SELECT id, contenido FROM letras_texto WHERE contenido IS NOT NULL")
     rows = cursor.fetchall()
 
-    limpiados = 0
+    cambios = []
     for row in rows:
         limpia = normalizar_letra(row["contenido"])
         if limpia != row["contenido"]:
             calidad = evaluar_calidad(limpia)
-            cursor.execute("UPDATE letras SET contenido=?, calidad=? WHERE id=?", (limpia, calidad, row["id"]))
-            limpiados += 1
+            cambios.append({"contenido": limpia, "calidad": calidad, "id": row["id"]})
 
-    conn.commit()
-    conn.close()
-    return jsonify({"limpiados": limpiados, "total": len(rows)})
+    with mantenimiento_fts() as indice:
+        limpiados = escribir_lote(("UPDATE letras SET calidad=:calidad WHERE id=:id", SQL_GUARDAR_CONTENIDO), cambios)
+    return jsonify({"limpiados": limpiados, "total": len(rows), "indice_fts": indice})
 
 
 # =========================
@@ -661,11 +922,14 @@ def buscar_tematica():
     # Construir query FTS con OR
     fts_query = " OR ".join(expanded_terms)
 
-    resultados = busqueda_fulltext(fts_query, limit, 0)
+    try:
+        resultados, total, _ = busqueda_fulltext(fts_query, limit, 0)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     return jsonify({
         "resultados": resultados,
-        "total": len(resultados),
+        "total": total,
         "query_original": q,
         "query_expandida": fts_query,
         "tematicas_disponibles": list(sinonimos.keys())
@@ -685,31 +949,37 @@ def comparar_estilos():
     if not agrupacion1 or not agrupacion2:
         return jsonify({"error": "Necesitas dos agrupaciones (a1 y a2)"}), 400
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
     def stats_agrupacion(nombre):
+        entidad = resolver_entidad(conn, "agrupaciones", nombre)
+        if not entidad:
+            return None
+        agrupacion_id, nombre = entidad
+
         cursor.execute("""
             SELECT COUNT(*) as total,
                    COUNT(DISTINCT anio) as anios,
                    GROUP_CONCAT(DISTINCT modalidad) as modalidades,
                    GROUP_CONCAT(DISTINCT tipo_pieza) as tipos,
                    GROUP_CONCAT(DISTINCT autor) as autores,
-                   AVG(LENGTH(contenido)) as longitud_media,
+                   AVG(longitud) as longitud_media,
                    AVG(calidad) as calidad_media,
                    MIN(anio) as primer_anio,
                    MAX(anio) as ultimo_anio
-            FROM letras WHERE agrupacion LIKE ?
-        """, (f"%{nombre}%",))
+            FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?)
+        """, (agrupacion_id,))
         row = cursor.fetchone()
         if not row or row["total"] == 0:
             return None
 
         cursor.execute("""
-            SELECT tipo_pieza, COUNT(*) as cnt
-            FROM letras WHERE agrupacion LIKE ? AND tipo_pieza IS NOT NULL
-            GROUP BY tipo_pieza ORDER BY cnt DESC
-        """, (f"%{nombre}%",))
+            SELECT t.nombre as tipo_pieza, COUNT(*) as cnt
+            FROM letras l JOIN tipos_pieza t ON t.id = l.tipo_pieza_id
+            WHERE l.id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?)
+            GROUP BY l.tipo_pieza_id ORDER BY cnt DESC
+        """, (agrupacion_id,))
         tipos_detalle = [{"tipo": r["tipo_pieza"], "cantidad": r["cnt"]} for r in cursor.fetchall()]
 
         return {
@@ -728,7 +998,6 @@ def comparar_estilos():
     stats1 = stats_agrupacion(agrupacion1)
     stats2 = stats_agrupacion(agrupacion2)
 
-    conn.close()
 
     if not stats1:
         return jsonify({"error": f"No se encontro '{agrupacion1}'"}), 404
@@ -746,23 +1015,26 @@ def comparar_estilos():
 
 @app.route("/api/estadisticas_avanzadas")
 def estadisticas_avanzadas():
-    conn = get_db()
+    return jsonify(estadistica_materializada("avanzadas", calcular_estadisticas_avanzadas))
+
+
+def calcular_estadisticas_avanzadas(conn):
     cursor = conn.cursor()
 
     stats = {}
 
     # Top autores
     cursor.execute("""
-        SELECT autor, COUNT(*) as cantidad, COUNT(DISTINCT agrupacion) as agrupaciones
-        FROM letras WHERE autor IS NOT NULL AND autor != ''
+        SELECT autor, SUM(cantidad) as cantidad, COUNT(DISTINCT agrupacion) as agrupaciones
+        FROM agg_autor WHERE autor != ''
         GROUP BY autor ORDER BY cantidad DESC LIMIT 15
     """)
     stats["top_autores"] = [{"autor": r["autor"], "letras": r["cantidad"], "agrupaciones": r["agrupaciones"]} for r in cursor.fetchall()]
 
     # Evolucion por anio y modalidad
     cursor.execute("""
-        SELECT anio, modalidad, COUNT(*) as cantidad
-        FROM letras WHERE anio IS NOT NULL AND modalidad IS NOT NULL
+        SELECT anio, modalidad, SUM(cantidad) as cantidad
+        FROM agg_anio_modalidad WHERE anio IS NOT NULL AND modalidad IS NOT NULL
         GROUP BY anio, modalidad ORDER BY anio
     """)
     evolucion = {}
@@ -775,8 +1047,8 @@ def estadisticas_avanzadas():
 
     # Longitud media por modalidad
     cursor.execute("""
-        SELECT modalidad, AVG(LENGTH(contenido)) as media, COUNT(*) as total
-        FROM letras WHERE modalidad IS NOT NULL AND contenido IS NOT NULL
+        SELECT modalidad, AVG(longitud) as media, COUNT(*) as total
+        FROM letras WHERE modalidad IS NOT NULL AND longitud IS NOT NULL
         GROUP BY modalidad
     """)
     stats["longitud_por_modalidad"] = [
@@ -799,8 +1071,7 @@ def estadisticas_avanzadas():
     """)
     stats["distribucion_calidad"] = [{"rango": r["rango"], "cantidad": r["cantidad"]} for r in cursor.fetchall()]
 
-    conn.close()
-    return jsonify(stats)
+    return stats
 
 
 # =========================
@@ -813,23 +1084,25 @@ def letra_aleatoria():
     modalidad = request.args.get("modalidad")
     anio = request.args.get("anio")
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    query = "SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion, contenido, autor FROM letras WHERE contenido IS NOT NULL AND LENGTH(contenido) > 100"
+    # El sorteo recorre solo idx_letras_largas; el texto se lee para la elegida
+    query = f"SELECT id FROM letras WHERE longitud > {LONGITUD_MIN_ALEATORIO}"
     params = []
 
     if modalidad:
-        query += " AND modalidad=?"
+        query += " AND " + filtro_categoria("modalidades")
         params.append(modalidad)
     if anio:
         query += " AND anio=?"
         params.append(anio)
 
     query += " ORDER BY RANDOM() LIMIT 1"
-    cursor.execute(query, params)
+    cursor.execute(
+        "SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion, contenido, autor FROM letras_completas "
+        f"WHERE id IN ({query})", params)
     row = cursor.fetchone()
-    conn.close()
 
     if not row:
         return jsonify({"error": "No hay letras disponibles"}), 404
@@ -844,42 +1117,44 @@ def letra_aleatoria():
 @app.route("/api/timeline")
 def timeline():
     """Cronologia del carnaval: eventos por anio con resumen."""
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
     cursor.execute("""
         SELECT anio,
-               COUNT(*) as total_letras,
-               COUNT(DISTINCT agrupacion) as agrupaciones,
-               COUNT(DISTINCT modalidad) as modalidades,
+               SUM(cantidad) as total_letras,
                GROUP_CONCAT(DISTINCT modalidad) as lista_modalidades,
-               AVG(calidad) as calidad_media
-        FROM letras
+               SUM(suma_calidad) * 1.0 / SUM(cantidad) as calidad_media
+        FROM agg_anio_modalidad
         WHERE anio IS NOT NULL
         GROUP BY anio
         ORDER BY anio
     """)
+    por_anio = cursor.fetchall()
 
-    timeline_data = []
-    for r in cursor.fetchall():
-        # Top agrupacion de ese anio
-        cursor.execute("""
-            SELECT agrupacion, COUNT(*) as cnt
-            FROM letras WHERE anio=? AND agrupacion IS NOT NULL
-            GROUP BY agrupacion ORDER BY cnt DESC LIMIT 3
-        """, (r["anio"],))
-        top_agrup = [row["agrupacion"] for row in cursor.fetchall()]
+    # Agrupaciones de cada anio (distintas y top 3) en una sola pasada
+    cursor.execute("""
+        SELECT anio, agrupacion, SUM(cantidad) as cnt
+        FROM agg_agrupacion WHERE anio IS NOT NULL
+        GROUP BY anio, agrupacion
+        ORDER BY anio, cnt DESC
+    """)
+    agrupaciones_anio = {}
+    for row in cursor.fetchall():
+        agrupaciones_anio.setdefault(row["anio"], []).append(row["agrupacion"])
 
+    timeline_data = []
+    for r in por_anio:
+        agrupaciones = agrupaciones_anio.get(r["anio"], [])
         timeline_data.append({
             "anio": r["anio"],
             "total_letras": r["total_letras"],
-            "agrupaciones": r["agrupaciones"],
+            "agrupaciones": len(agrupaciones),
             "modalidades": r["lista_modalidades"],
             "calidad_media": round(r["calidad_media"] or 0, 1),
-            "top_agrupaciones": top_agrup
+            "top_agrupaciones": agrupaciones[:3]
         })
 
-    conn.close()
     return jsonify({"timeline": timeline_data})
 
 
@@ -897,14 +1172,14 @@ def palabras_frecuentes():
     anio = request.args.get("anio")
     limit = int(request.args.get("limit", 60))
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    query = "SELECT contenido FROM letras WHERE contenido IS NOT NULL"
+    query = "SELECT contenido FROM letras_completas WHERE contenido IS NOT NULL"
     params = []
 
     if modalidad:
-        query += " AND modalidad=?"
+        query += " AND " + filtro_categoria("modalidades")
         params.append(modalidad)
     if anio:
         query += " AND anio=?"
@@ -937,7 +1212,6 @@ def palabras_frecuentes():
         counter.update(palabras_filtradas)
         total_textos += 1
 
-    conn.close()
 
     top_palabras = [{"palabra": p, "frecuencia": c} for p, c in counter.most_common(limit)]
 
@@ -957,9 +1231,14 @@ def detalle_autor(nombre):
     """Ficha completa de un autor con stats generales + poéticas agregadas."""
     import json as _json
     from collections import Counter as _Counter
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
+    entidad = resolver_entidad(conn, "autores", nombre)
+    if not entidad:
+        return jsonify({"error": "Autor no encontrado"}), 404
+    autor_id, nombre = entidad
+
     cursor.execute("""
         SELECT COUNT(*) as total,
                COUNT(DISTINCT agrupacion) as agrupaciones,
@@ -967,17 +1246,16 @@ def detalle_autor(nombre):
                GROUP_CONCAT(DISTINCT modalidad) as modalidades,
                MIN(anio) as primer_anio,
                MAX(anio) as ultimo_anio,
-               AVG(LENGTH(contenido)) as longitud_media,
+               AVG(longitud) as longitud_media,
                AVG(calidad) as calidad_media,
                AVG(score_poetico) as score_poetico_medio,
                AVG(densidad_lexica) as densidad_media,
                AVG(n_versos) as versos_medio
-        FROM letras WHERE autor LIKE ?
-    """, (f"%{nombre}%",))
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?)
+    """, (autor_id,))
     stats = cursor.fetchone()
 
     if not stats or stats["total"] == 0:
-        conn.close()
         return jsonify({"error": "Autor no encontrado"}), 404
 
     # Obras completas con datos poéticos
@@ -985,73 +1263,73 @@ def detalle_autor(nombre):
         SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion,
                score_poetico, nombre_metro, tipo_rima, esquema_rima,
                n_estrofas, n_versos, densidad_lexica, versos_destacados
-        FROM letras WHERE autor LIKE ?
+        FROM letras_completas WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?)
         ORDER BY anio DESC, titulo
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     obras = [dict(r) for r in cursor.fetchall()]
 
     # Agrupaciones con conteo
     cursor.execute("""
         SELECT agrupacion, COUNT(*) as cnt, MIN(anio) as desde, MAX(anio) as hasta
-        FROM letras WHERE autor LIKE ? AND agrupacion IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND agrupacion IS NOT NULL
         GROUP BY agrupacion ORDER BY cnt DESC
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     agrupaciones_detalle = [dict(r) for r in cursor.fetchall()]
 
     # Actividad por año
     cursor.execute("""
         SELECT anio, COUNT(*) as cnt, AVG(score_poetico) as score_medio
-        FROM letras WHERE autor LIKE ? AND anio IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND anio IS NOT NULL
         GROUP BY anio ORDER BY anio
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     por_anio = [{"anio": r["anio"], "cnt": r["cnt"], "score_medio": round(r["score_medio"] or 0, 1)}
                 for r in cursor.fetchall()]
 
     # Tipos de pieza más usados
     cursor.execute("""
         SELECT tipo_pieza, COUNT(*) as cnt
-        FROM letras WHERE autor LIKE ? AND tipo_pieza IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND tipo_pieza IS NOT NULL
         GROUP BY tipo_pieza ORDER BY cnt DESC
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     tipos_pieza = [{"tipo": r["tipo_pieza"], "cnt": r["cnt"]} for r in cursor.fetchall()]
 
     # Estadísticas poéticas agregadas (de letras ya analizadas)
     cursor.execute("""
         SELECT nombre_metro, COUNT(*) as cnt
-        FROM letras WHERE autor LIKE ? AND nombre_metro IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND nombre_metro IS NOT NULL
         GROUP BY nombre_metro ORDER BY cnt DESC LIMIT 5
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     metros = [{"metro": r["nombre_metro"], "cnt": r["cnt"]} for r in cursor.fetchall()]
 
     cursor.execute("""
         SELECT tipo_rima, COUNT(*) as cnt
-        FROM letras WHERE autor LIKE ? AND tipo_rima IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND tipo_rima IS NOT NULL
         GROUP BY tipo_rima ORDER BY cnt DESC
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     rimas = [{"tipo": r["tipo_rima"], "cnt": r["cnt"]} for r in cursor.fetchall()]
 
     cursor.execute("""
         SELECT esquema_rima, COUNT(*) as cnt
-        FROM letras WHERE autor LIKE ? AND esquema_rima IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND esquema_rima IS NOT NULL
         GROUP BY esquema_rima ORDER BY cnt DESC LIMIT 5
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     esquemas = [{"esquema": r["esquema_rima"], "cnt": r["cnt"]} for r in cursor.fetchall()]
 
     # Top letras por score poético
     cursor.execute("""
         SELECT id, titulo, anio, modalidad, tipo_pieza, agrupacion,
                score_poetico, nombre_metro, tipo_rima
-        FROM letras WHERE autor LIKE ? AND score_poetico > 0
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND score_poetico > 0
         ORDER BY score_poetico DESC LIMIT 5
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     top_letras = [dict(r) for r in cursor.fetchall()]
 
     # Léxico gaditano más frecuente del autor (agregado)
     cursor.execute("""
-        SELECT lexico_gaditano FROM letras
-        WHERE autor LIKE ? AND lexico_gaditano IS NOT NULL AND lexico_gaditano != '[]'
+        SELECT lexico_gaditano FROM letras_completas
+        WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND lexico_gaditano IS NOT NULL AND lexico_gaditano != '[]'
         LIMIT 200
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     lexico_counter = _Counter()
     for row in cursor.fetchall():
         try:
@@ -1064,10 +1342,10 @@ def detalle_autor(nombre):
 
     # Figuras retóricas más usadas
     cursor.execute("""
-        SELECT figuras_retoricas FROM letras
-        WHERE autor LIKE ? AND figuras_retoricas IS NOT NULL AND figuras_retoricas != '[]'
+        SELECT figuras_retoricas FROM letras_completas
+        WHERE id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?) AND figuras_retoricas IS NOT NULL AND figuras_retoricas != '[]'
         LIMIT 200
-    """, (f"%{nombre}%",))
+    """, (autor_id,))
     figuras_counter = _Counter()
     for row in cursor.fetchall():
         try:
@@ -1079,7 +1357,6 @@ def detalle_autor(nombre):
             pass
     figuras_top = [{"figura": f, "cnt": c} for f, c in figuras_counter.most_common(6)]
 
-    conn.close()
 
     return jsonify({
         "autor": nombre,
@@ -1115,9 +1392,14 @@ def detalle_agrupacion(nombre):
     """Ficha completa de una agrupación con historia, autores y análisis poético."""
     import json as _json
     from collections import Counter as _Counter
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
+    entidad = resolver_entidad(conn, "agrupaciones", nombre)
+    if not entidad:
+        return jsonify({"error": "Agrupación no encontrada"}), 404
+    agrupacion_id, nombre = entidad
+
     cursor.execute("""
         SELECT COUNT(*) as total,
                COUNT(DISTINCT autor) as autores,
@@ -1126,16 +1408,15 @@ def detalle_agrupacion(nombre):
                GROUP_CONCAT(DISTINCT modalidad) as modalidades,
                MIN(anio) as primer_anio,
                MAX(anio) as ultimo_anio,
-               AVG(LENGTH(contenido)) as longitud_media,
+               AVG(longitud) as longitud_media,
                AVG(calidad) as calidad_media,
                AVG(score_poetico) as score_poetico_medio,
                AVG(densidad_lexica) as densidad_media
-        FROM letras WHERE agrupacion LIKE ?
-    """, (f"%{nombre}%",))
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?)
+    """, (agrupacion_id,))
     stats = cursor.fetchone()
 
     if not stats or stats["total"] == 0:
-        conn.close()
         return jsonify({"error": "Agrupación no encontrada"}), 404
 
     # Obras con datos poéticos
@@ -1143,17 +1424,17 @@ def detalle_agrupacion(nombre):
         SELECT id, titulo, anio, modalidad, tipo_pieza, autor,
                score_poetico, nombre_metro, tipo_rima, esquema_rima,
                n_estrofas, n_versos, versos_destacados
-        FROM letras WHERE agrupacion LIKE ?
+        FROM letras_completas WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?)
         ORDER BY anio DESC, tipo_pieza, titulo
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     obras = [dict(r) for r in cursor.fetchall()]
 
     # Autores que han escrito para esta agrupación
     cursor.execute("""
         SELECT autor, COUNT(*) as cnt, MIN(anio) as desde, MAX(anio) as hasta
-        FROM letras WHERE agrupacion LIKE ? AND autor IS NOT NULL AND autor != ''
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND autor IS NOT NULL AND autor != ''
         GROUP BY autor ORDER BY cnt DESC
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     autores_detalle = [dict(r) for r in cursor.fetchall()]
 
     # Actividad por año
@@ -1161,9 +1442,9 @@ def detalle_agrupacion(nombre):
         SELECT anio, COUNT(*) as cnt,
                GROUP_CONCAT(DISTINCT tipo_pieza) as tipos,
                AVG(score_poetico) as score_medio
-        FROM letras WHERE agrupacion LIKE ? AND anio IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND anio IS NOT NULL
         GROUP BY anio ORDER BY anio
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     por_anio = [{"anio": r["anio"], "cnt": r["cnt"],
                  "tipos": r["tipos"], "score_medio": round(r["score_medio"] or 0, 1)}
                 for r in cursor.fetchall()]
@@ -1171,41 +1452,41 @@ def detalle_agrupacion(nombre):
     # Tipos de pieza
     cursor.execute("""
         SELECT tipo_pieza, COUNT(*) as cnt
-        FROM letras WHERE agrupacion LIKE ? AND tipo_pieza IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND tipo_pieza IS NOT NULL
         GROUP BY tipo_pieza ORDER BY cnt DESC
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     tipos_pieza = [{"tipo": r["tipo_pieza"], "cnt": r["cnt"]} for r in cursor.fetchall()]
 
     # Análisis poético agregado
     cursor.execute("""
         SELECT nombre_metro, COUNT(*) as cnt
-        FROM letras WHERE agrupacion LIKE ? AND nombre_metro IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND nombre_metro IS NOT NULL
         GROUP BY nombre_metro ORDER BY cnt DESC LIMIT 5
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     metros = [{"metro": r["nombre_metro"], "cnt": r["cnt"]} for r in cursor.fetchall()]
 
     cursor.execute("""
         SELECT tipo_rima, COUNT(*) as cnt
-        FROM letras WHERE agrupacion LIKE ? AND tipo_rima IS NOT NULL
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND tipo_rima IS NOT NULL
         GROUP BY tipo_rima ORDER BY cnt DESC
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     rimas = [{"tipo": r["tipo_rima"], "cnt": r["cnt"]} for r in cursor.fetchall()]
 
     # Top letras
     cursor.execute("""
         SELECT id, titulo, anio, modalidad, tipo_pieza, autor,
                score_poetico, nombre_metro, tipo_rima
-        FROM letras WHERE agrupacion LIKE ? AND score_poetico > 0
+        FROM letras WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND score_poetico > 0
         ORDER BY score_poetico DESC LIMIT 5
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     top_letras = [dict(r) for r in cursor.fetchall()]
 
     # Léxico gaditano
     cursor.execute("""
-        SELECT lexico_gaditano FROM letras
-        WHERE agrupacion LIKE ? AND lexico_gaditano IS NOT NULL AND lexico_gaditano != '[]'
+        SELECT lexico_gaditano FROM letras_completas
+        WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND lexico_gaditano IS NOT NULL AND lexico_gaditano != '[]'
         LIMIT 200
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     lexico_counter = _Counter()
     for row in cursor.fetchall():
         try:
@@ -1217,10 +1498,10 @@ def detalle_agrupacion(nombre):
 
     # Figuras retóricas
     cursor.execute("""
-        SELECT figuras_retoricas FROM letras
-        WHERE agrupacion LIKE ? AND figuras_retoricas IS NOT NULL AND figuras_retoricas != '[]'
+        SELECT figuras_retoricas FROM letras_completas
+        WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND figuras_retoricas IS NOT NULL AND figuras_retoricas != '[]'
         LIMIT 200
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     figuras_counter = _Counter()
     for row in cursor.fetchall():
         try:
@@ -1233,11 +1514,11 @@ def detalle_agrupacion(nombre):
 
     # Versos más destacados de la agrupación (top 5 globales)
     cursor.execute("""
-        SELECT titulo, anio, versos_destacados FROM letras
-        WHERE agrupacion LIKE ? AND versos_destacados IS NOT NULL
+        SELECT titulo, anio, versos_destacados FROM letras_completas
+        WHERE id IN (SELECT letra_id FROM letra_agrupacion WHERE agrupacion_id = ?) AND versos_destacados IS NOT NULL
               AND versos_destacados != '[]' AND score_poetico > 0
         ORDER BY score_poetico DESC LIMIT 20
-    """, (f"%{nombre}%",))
+    """, (agrupacion_id,))
     versos_icono = []
     for row in cursor.fetchall():
         try:
@@ -1251,7 +1532,6 @@ def detalle_agrupacion(nombre):
         except Exception:
             pass
 
-    conn.close()
 
     return jsonify({
         "agrupacion": nombre,
@@ -1284,19 +1564,19 @@ def detalle_agrupacion(nombre):
 @app.route("/api/autores")
 def listado_autores():
     """Listado de autores con estadísticas básicas."""
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
     cursor.execute("""
         SELECT autor,
-               COUNT(*) as total_obras,
+               SUM(cantidad) as total_obras,
                COUNT(DISTINCT agrupacion) as agrupaciones,
                COUNT(DISTINCT anio) as anios_activos,
                MIN(anio) as primer_anio,
                MAX(anio) as ultimo_anio,
-               AVG(score_poetico) as score_medio,
+               SUM(suma_score) * 1.0 / SUM(cantidad) as score_medio,
                GROUP_CONCAT(DISTINCT modalidad) as modalidades
-        FROM letras
-        WHERE autor IS NOT NULL AND autor != ''
+        FROM agg_autor
+        WHERE autor != ''
         GROUP BY autor
         ORDER BY total_obras DESC
         LIMIT 200
@@ -1312,7 +1592,6 @@ def listado_autores():
             "score_medio": round(r["score_medio"] or 0, 1),
             "modalidades": r["modalidades"],
         })
-    conn.close()
     return jsonify({"autores": autores, "total": len(autores)})
 
 
@@ -1320,23 +1599,47 @@ def listado_autores():
 # API: LISTADO DE AGRUPACIONES
 # =========================
 
+def filtro_subcadena(columna, q):
+    """Condicion (y su parametro) que filtra `columna` por subcadena de `q` con letras_trigrama."""
+    expresion = expresion_trigrama(columna, q)
+    if expresion:
+        return f""" AND {columna} IN (
+            SELECT {columna} FROM letras WHERE id IN (
+                SELECT rowid FROM letras_trigrama WHERE letras_trigrama MATCH ?))""", expresion
+    return f" AND instr(normalizar_nombre({columna}), ?) > 0", normalizar_nombre(q)
+
+
+def contar_autores_por_agrupacion(cursor, modalidad=None, q=None):
+    """Autores distintos por agrupacion, leidos de agg_autor."""
+    query = "SELECT agrupacion, COUNT(DISTINCT autor) as autores FROM agg_autor WHERE agrupacion IS NOT NULL"
+    params = []
+    if q:
+        filtro, param = filtro_subcadena("agrupacion", q)
+        query += filtro
+        params.append(param)
+    if modalidad:
+        query += " AND modalidad = ?"
+        params.append(modalidad)
+    cursor.execute(query + " GROUP BY agrupacion", params)
+    return {r["agrupacion"]: r["autores"] for r in cursor.fetchall()}
+
+
 @app.route("/api/agrupaciones")
 def listado_agrupaciones():
     """Listado de agrupaciones con estadísticas básicas."""
     modalidad = request.args.get("modalidad")
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
     query = """
         SELECT agrupacion,
-               COUNT(*) as total_letras,
-               COUNT(DISTINCT autor) as autores,
+               SUM(cantidad) as total_letras,
                COUNT(DISTINCT anio) as anios_activos,
                MIN(anio) as primer_anio,
                MAX(anio) as ultimo_anio,
-               AVG(score_poetico) as score_medio,
+               SUM(suma_score) * 1.0 / SUM(cantidad) as score_medio,
                GROUP_CONCAT(DISTINCT modalidad) as modalidades
-        FROM letras
-        WHERE agrupacion IS NOT NULL AND agrupacion != ''
+        FROM agg_agrupacion
+        WHERE agrupacion != ''
     """
     params = []
     if modalidad:
@@ -1344,18 +1647,20 @@ def listado_agrupaciones():
         params.append(modalidad)
     query += " GROUP BY agrupacion ORDER BY total_letras DESC LIMIT 300"
     cursor.execute(query, params)
+    rows = cursor.fetchall()
+    autores = contar_autores_por_agrupacion(cursor, modalidad=modalidad)
+
     agrupaciones = []
-    for r in cursor.fetchall():
+    for r in rows:
         agrupaciones.append({
             "agrupacion": r["agrupacion"],
             "total_letras": r["total_letras"],
-            "autores": r["autores"],
+            "autores": autores.get(r["agrupacion"], 0),
             "anios_activos": r["anios_activos"],
             "periodo": f"{r['primer_anio'] or '?'} – {r['ultimo_anio'] or '?'}",
             "score_medio": round(r["score_medio"] or 0, 1),
             "modalidades": r["modalidades"],
         })
-    conn.close()
     return jsonify({"agrupaciones": agrupaciones, "total": len(agrupaciones)})
 
 
@@ -1363,14 +1668,53 @@ def listado_agrupaciones():
 # API: ANÁLISIS POÉTICO
 # =========================
 
+SQL_GUARDAR_ANALISIS = ("""
+    UPDATE letras SET
+        metro_dominante=:metro_dominante, nombre_metro=:nombre_metro,
+        coherencia_metrica=:coherencia_metrica, esquema_rima=:esquema_rima,
+        tipo_rima=:tipo_rima, score_poetico=:score_poetico,
+        n_estrofas=:n_estrofas, n_versos=:n_versos, densidad_lexica=:densidad_lexica,
+        fecha_analisis=datetime('now')
+    WHERE id=:id
+""", """
+    INSERT INTO letras_analisis (id, versos_destacados, figuras_retoricas, lexico_gaditano, analisis_poetico)
+    VALUES (:id, :versos_destacados, :figuras_retoricas, :lexico_gaditano, :analisis_poetico)
+    ON CONFLICT(id) DO UPDATE SET
+        versos_destacados=excluded.versos_destacados, figuras_retoricas=excluded.figuras_retoricas,
+        lexico_gaditano=excluded.lexico_gaditano, analisis_poetico=excluded.analisis_poetico
+""")
+
+# Filas de analisis que se envian juntas al escritor en /api/analizar_todo
+LOTE_ANALISIS = 200
+
+
+def valores_analisis(analisis, letra_id):
+    """Parametros de SQL_GUARDAR_ANALISIS para el resultado de analizar_letra()."""
+    return {
+        "metro_dominante": analisis["metrica"].get("metro_dominante"),
+        "nombre_metro": analisis["metrica"].get("nombre_metro"),
+        "coherencia_metrica": analisis["metrica"].get("coherencia_pct", 0),
+        "esquema_rima": analisis["rima"].get("esquema_predominante"),
+        "tipo_rima": analisis["rima"].get("tipo_rima"),
+        "score_poetico": analisis["score_poetico"],
+        "n_estrofas": analisis["n_estrofas"],
+        "n_versos": analisis["n_versos"],
+        "densidad_lexica": analisis["vocabulario"].get("densidad_lexica", 0),
+        "versos_destacados": json.dumps(analisis["versos_destacados"], ensure_ascii=False),
+        "figuras_retoricas": json.dumps(analisis["figuras_retoricas"], ensure_ascii=False),
+        "lexico_gaditano": json.dumps(analisis["vocabulario"].get("lexico_gaditano", []), ensure_ascii=False),
+        "analisis_poetico": comprimir_analisis(json.dumps(analisis, ensure_ascii=False)),
+        "id": letra_id,
+    }
+
+
 @app.route("/api/analisis_poetico/<int:letra_id>")
 def analisis_poetico_letra(letra_id):
     """Análisis poético completo de una letra individual."""
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM letras WHERE id=?", (letra_id,))
+    cursor.execute("SELECT * FROM letras_completas WHERE id=?", (letra_id,))
     row = cursor.fetchone()
-    conn.close()
 
     if not row:
         return jsonify({"error": "Letra no encontrada"}), 404
@@ -1380,10 +1724,10 @@ def analisis_poetico_letra(letra_id):
     # Si ya está analizada y guardada, devolver caché
     if row.get("analisis_poetico"):
         try:
-            cached = json.loads(row["analisis_poetico"])
+            cached = json.loads(leer_analisis(row["analisis_poetico"]))
             cached["desde_cache"] = True
             return jsonify(cached)
-        except (json.JSONDecodeError, TypeError):
+        except (TypeError, ValueError):
             pass
 
     contenido = row.get("contenido", "")
@@ -1396,34 +1740,7 @@ def analisis_poetico_letra(letra_id):
         return jsonify(analisis), 422
 
     # Guardar en BD para no recalcular
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE letras SET
-            metro_dominante=?, nombre_metro=?, coherencia_metrica=?,
-            esquema_rima=?, tipo_rima=?, score_poetico=?,
-            n_estrofas=?, n_versos=?, densidad_lexica=?,
-            versos_destacados=?, figuras_retoricas=?, lexico_gaditano=?,
-            analisis_poetico=?, fecha_analisis=datetime('now')
-        WHERE id=?
-    """, (
-        analisis["metrica"].get("metro_dominante"),
-        analisis["metrica"].get("nombre_metro"),
-        analisis["metrica"].get("coherencia_pct", 0),
-        analisis["rima"].get("esquema_predominante"),
-        analisis["rima"].get("tipo_rima"),
-        analisis["score_poetico"],
-        analisis["n_estrofas"],
-        analisis["n_versos"],
-        analisis["vocabulario"].get("densidad_lexica", 0),
-        json.dumps(analisis["versos_destacados"], ensure_ascii=False),
-        json.dumps(analisis["figuras_retoricas"], ensure_ascii=False),
-        json.dumps(analisis["vocabulario"].get("lexico_gaditano", []), ensure_ascii=False),
-        json.dumps(analisis, ensure_ascii=False),
-        letra_id,
-    ))
-    conn.commit()
-    conn.close()
+    escribir_lote(SQL_GUARDAR_ANALISIS, [valores_analisis(analisis, letra_id)])
 
     return jsonify(analisis)
 
@@ -1440,30 +1757,29 @@ def analizar_corpus_endpoint():
     tipo_pieza = data.get("tipo_pieza")
     limit = int(data.get("limit", 500))
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    query = """
-        SELECT id, titulo, contenido, modalidad, anio, tipo_pieza, agrupacion
-        FROM letras
-        WHERE contenido IS NOT NULL AND LENGTH(contenido) > 50
-    """
+    # La muestra se elige sobre idx_letras_analizables y solo se lee su texto
+    query = f"SELECT id FROM letras WHERE longitud > {LONGITUD_MIN_ANALISIS}"
     params = []
     if modalidad:
-        query += " AND modalidad=?"
+        query += " AND " + filtro_categoria("modalidades")
         params.append(modalidad)
     if anio:
         query += " AND anio=?"
         params.append(anio)
     if tipo_pieza:
-        query += " AND tipo_pieza=?"
+        query += " AND " + filtro_categoria("tipos_pieza")
         params.append(tipo_pieza)
     query += " ORDER BY RANDOM() LIMIT ?"
     params.append(limit)
 
-    cursor.execute(query, params)
+    cursor.execute(f"""
+        SELECT id, titulo, contenido, modalidad, anio, tipo_pieza, agrupacion
+        FROM letras_completas WHERE id IN ({query})
+    """, params)
     letras = [dict(r) for r in cursor.fetchall()]
-    conn.close()
 
     if not letras:
         return jsonify({"error": "No hay letras que analizar con esos filtros"}), 404
@@ -1483,22 +1799,21 @@ def analizar_todo():
     data = request.json or {}
     forzar = data.get("forzar", False)  # True para re-analizar incluso las ya analizadas
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
-    if forzar:
-        cursor.execute(
-            "SELECT id, titulo, contenido FROM letras WHERE contenido IS NOT NULL AND LENGTH(contenido) > 50"
-        )
-    else:
-        cursor.execute(
-            "SELECT id, titulo, contenido FROM letras WHERE contenido IS NOT NULL AND LENGTH(contenido) > 50 AND analisis_poetico IS NULL"
-        )
+    # Pendientes: fecha_analisis la pone SQL_GUARDAR_ANALISIS junto al analisis,
+    # y idx_letras_pendientes solo contiene esas filas
+    pendientes_sql = "" if forzar else " AND l.fecha_analisis IS NULL"
+    cursor.execute(f"""
+        SELECT l.id, l.titulo, t.contenido FROM letras l JOIN letras_texto t ON t.id = l.id
+        WHERE l.longitud > {LONGITUD_MIN_ANALISIS}{pendientes_sql}
+    """)
     rows = cursor.fetchall()
-    conn.close()
 
     analizadas = 0
     errores = 0
+    pendientes = []
 
     for row in rows:
         try:
@@ -1507,37 +1822,17 @@ def analizar_todo():
                 errores += 1
                 continue
 
-            conn = get_db()
-            cursor = conn.cursor()
-            cursor.execute("""
-                UPDATE letras SET
-                    metro_dominante=?, nombre_metro=?, coherencia_metrica=?,
-                    esquema_rima=?, tipo_rima=?, score_poetico=?,
-                    n_estrofas=?, n_versos=?, densidad_lexica=?,
-                    versos_destacados=?, figuras_retoricas=?, lexico_gaditano=?,
-                    analisis_poetico=?, fecha_analisis=datetime('now')
-                WHERE id=?
-            """, (
-                analisis["metrica"].get("metro_dominante"),
-                analisis["metrica"].get("nombre_metro"),
-                analisis["metrica"].get("coherencia_pct", 0),
-                analisis["rima"].get("esquema_predominante"),
-                analisis["rima"].get("tipo_rima"),
-                analisis["score_poetico"],
-                analisis["n_estrofas"],
-                analisis["n_versos"],
-                analisis["vocabulario"].get("densidad_lexica", 0),
-                json.dumps(analisis["versos_destacados"], ensure_ascii=False),
-                json.dumps(analisis["figuras_retoricas"], ensure_ascii=False),
-                json.dumps(analisis["vocabulario"].get("lexico_gaditano", []), ensure_ascii=False),
-                json.dumps(analisis, ensure_ascii=False),
-                row["id"],
-            ))
-            conn.commit()
-            conn.close()
+            pendientes.append(valores_analisis(analisis, row["id"]))
             analizadas += 1
         except Exception:
             errores += 1
+            continue
+
+        if len(pendientes) >= LOTE_ANALISIS:
+            escribir_lote(SQL_GUARDAR_ANALISIS, pendientes)
+            pendientes = []
+
+    escribir_lote(SQL_GUARDAR_ANALISIS, pendientes)
 
     return jsonify({
         "analizadas": analizadas,
@@ -1549,23 +1844,25 @@ def analizar_todo():
 @app.route("/api/estadisticas_poeticas")
 def estadisticas_poeticas():
     """Estadísticas poéticas agregadas del corpus completo."""
-    conn = get_db()
+    return jsonify(estadistica_materializada("poeticas", calcular_estadisticas_poeticas))
+
+
+def calcular_estadisticas_poeticas(conn):
     cursor = conn.cursor()
 
     # Solo letras ya analizadas
-    cursor.execute("SELECT COUNT(*) as total FROM letras WHERE analisis_poetico IS NOT NULL")
+    cursor.execute("SELECT COUNT(*) as total FROM letras_analisis WHERE analisis_poetico IS NOT NULL")
     total_analizadas = cursor.fetchone()["total"]
 
     cursor.execute("SELECT COUNT(*) as total FROM letras")
     total_letras = cursor.fetchone()["total"]
 
     if total_analizadas == 0:
-        conn.close()
-        return jsonify({
+        return {
             "total_analizadas": 0,
             "total_letras": total_letras,
             "mensaje": "Ejecuta el análisis poético desde el panel admin primero."
-        })
+        }
 
     # Score poético medio
     cursor.execute("SELECT AVG(score_poetico) as media FROM letras WHERE score_poetico > 0")
@@ -1625,13 +1922,12 @@ def estadisticas_poeticas():
     cursor.execute("""
         SELECT id, titulo, agrupacion, anio, modalidad, score_poetico, nombre_metro, tipo_rima
         FROM letras WHERE score_poetico > 0
-        ORDER BY score_poetico DESC LIMIT 10
+        ORDER BY score_poetico DESC, id LIMIT 10
     """)
     top_letras = [dict(r) for r in cursor.fetchall()]
 
-    conn.close()
 
-    return jsonify({
+    return {
         "total_analizadas": total_analizadas,
         "total_letras": total_letras,
         "pct_analizadas": round(total_analizadas / max(total_letras, 1) * 100, 1),
@@ -1643,7 +1939,7 @@ def estadisticas_poeticas():
         "score_por_modalidad": scores_modalidad,
         "evolucion_score": evolucion_score,
         "top_letras_poeticas": top_letras,
-    })
+    }
 
 
 
@@ -1659,27 +1955,28 @@ def api_directorio():
     modalidad = request.args.get("modalidad", "")
     ordenar = request.args.get("ordenar", "obras")  # obras, score, anios
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
     if tipo == "autores":
         sql = """
             SELECT
                 autor as nombre,
-                COUNT(*) as total_obras,
+                SUM(cantidad) as total_obras,
                 COUNT(DISTINCT agrupacion) as total_agrupaciones,
                 MIN(anio) as anio_inicio,
                 MAX(anio) as anio_fin,
                 (MAX(anio) - MIN(anio) + 1) as anios_activo,
-                AVG(CASE WHEN score_poetico > 0 THEN score_poetico END) as score_medio,
+                SUM(suma_score) * 1.0 / NULLIF(SUM(n_score), 0) as score_medio,
                 GROUP_CONCAT(DISTINCT modalidad) as modalidades
-            FROM letras
-            WHERE autor IS NOT NULL AND autor != ''
+            FROM agg_autor
+            WHERE autor != ''
         """
         params = []
         if q:
-            sql += " AND autor LIKE ?"
-            params.append(f"%{q}%")
+            filtro, param = filtro_subcadena("autor", q)
+            sql += filtro
+            params.append(param)
         if modalidad:
             sql += " AND modalidad = ?"
             params.append(modalidad)
@@ -1695,26 +1992,27 @@ def api_directorio():
 
         sql += " LIMIT 200"
         cursor.execute(sql, params)
+        rows = cursor.fetchall()
 
     else:  # agrupaciones
         sql = """
             SELECT
                 agrupacion as nombre,
-                COUNT(*) as total_obras,
-                COUNT(DISTINCT autor) as total_autores,
+                SUM(cantidad) as total_obras,
                 MIN(anio) as anio_inicio,
                 MAX(anio) as anio_fin,
                 (MAX(anio) - MIN(anio) + 1) as anios_activo,
-                AVG(CASE WHEN score_poetico > 0 THEN score_poetico END) as score_medio,
+                SUM(suma_score) * 1.0 / NULLIF(SUM(n_score), 0) as score_medio,
                 GROUP_CONCAT(DISTINCT modalidad) as modalidades,
                 MAX(modalidad) as modalidad_principal
-            FROM letras
-            WHERE agrupacion IS NOT NULL AND agrupacion != ''
+            FROM agg_agrupacion
+            WHERE agrupacion != ''
         """
         params = []
         if q:
-            sql += " AND agrupacion LIKE ?"
-            params.append(f"%{q}%")
+            filtro, param = filtro_subcadena("agrupacion", q)
+            sql += filtro
+            params.append(param)
         if modalidad:
             sql += " AND modalidad = ?"
             params.append(modalidad)
@@ -1730,9 +2028,8 @@ def api_directorio():
 
         sql += " LIMIT 300"
         cursor.execute(sql, params)
-
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
+        autores = contar_autores_por_agrupacion(cursor, modalidad=modalidad, q=q)
 
     result = []
     for r in rows:
@@ -1748,7 +2045,7 @@ def api_directorio():
         if tipo == "autores":
             item["total_agrupaciones"] = r["total_agrupaciones"]
         else:
-            item["total_autores"] = r["total_autores"]
+            item["total_autores"] = autores.get(r["nombre"], 0)
             item["modalidad_principal"] = r["modalidad_principal"]
         result.append(item)
 
@@ -1773,7 +2070,7 @@ def api_evolucion_tematica():
         {"label": "Presente (2016–hoy)", "desde": 2016, "hasta": 2100},
     ]
 
-    conn = get_db()
+    conn = db()
     cursor = conn.cursor()
 
     resultado = []
@@ -1782,7 +2079,7 @@ def api_evolucion_tematica():
         params = [epoca["desde"], epoca["hasta"]]
         mod_filter = ""
         if modalidad:
-            mod_filter = " AND modalidad = ?"
+            mod_filter = " AND " + filtro_categoria("modalidades")
             params.append(modalidad)
 
         # Conteo y score
@@ -1792,7 +2089,7 @@ def api_evolucion_tematica():
                    AVG(CASE WHEN densidad_lexica > 0 THEN densidad_lexica END) as densidad_media,
                    COUNT(DISTINCT agrupacion) as n_agrupaciones
             FROM letras
-            WHERE anio >= ? AND anio <= ?{mod_filter}
+            WHERE anio_num BETWEEN ? AND ?{mod_filter}
         """, params)
         stats_row = cursor.fetchone()
 
@@ -1803,7 +2100,7 @@ def api_evolucion_tematica():
         cursor.execute(f"""
             SELECT nombre_metro, COUNT(*) as cnt
             FROM letras
-            WHERE anio >= ? AND anio <= ? AND nombre_metro IS NOT NULL{mod_filter}
+            WHERE anio_num BETWEEN ? AND ? AND nombre_metro IS NOT NULL{mod_filter}
             GROUP BY nombre_metro ORDER BY cnt DESC LIMIT 1
         """, params)
         metro_row = cursor.fetchone()
@@ -1812,7 +2109,7 @@ def api_evolucion_tematica():
         cursor.execute(f"""
             SELECT tipo_rima, COUNT(*) as cnt
             FROM letras
-            WHERE anio >= ? AND anio <= ? AND tipo_rima IS NOT NULL{mod_filter}
+            WHERE anio_num BETWEEN ? AND ? AND tipo_rima IS NOT NULL{mod_filter}
             GROUP BY tipo_rima ORDER BY cnt DESC LIMIT 1
         """, params)
         rima_row = cursor.fetchone()
@@ -1821,15 +2118,15 @@ def api_evolucion_tematica():
         cursor.execute(f"""
             SELECT agrupacion, COUNT(*) as cnt
             FROM letras
-            WHERE anio >= ? AND anio <= ? AND agrupacion IS NOT NULL{mod_filter}
+            WHERE anio_num BETWEEN ? AND ? AND agrupacion IS NOT NULL{mod_filter}
             GROUP BY agrupacion ORDER BY cnt DESC LIMIT 5
         """, params)
         top_agrupaciones = [{"nombre": r["agrupacion"], "obras": r["cnt"]} for r in cursor.fetchall()]
 
         # Palabras clave: extraer del contenido
         cursor.execute(f"""
-            SELECT contenido FROM letras
-            WHERE anio >= ? AND anio <= ? AND contenido IS NOT NULL{mod_filter}
+            SELECT contenido FROM letras_completas
+            WHERE anio_num BETWEEN ? AND ? AND contenido IS NOT NULL{mod_filter}
             ORDER BY RANDOM() LIMIT 100
         """, params)
         contenidos = [r["contenido"] for r in cursor.fetchall() if r["contenido"]]
@@ -1866,7 +2163,6 @@ def api_evolucion_tematica():
             "top_palabras": top_palabras,
         })
 
-    conn.close()
     return jsonify({"epocas": resultado})
 
 
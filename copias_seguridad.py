@@ -0,0 +1,350 @@
+"""
+Copias de seguridad en caliente de la base de datos con la API de backup de SQLite.
+
+La copia avanza por pasos de COPIA_PAGINAS_POR_PASO paginas con una pausa
+entre pasos, sobre una transaccion de lectura abierta en la conexion origen:
+en WAL ni lectores ni el hilo escritor esperan, y la copia es una foto
+coherente aunque el scraper siga escribiendo (sin la transaccion, cada
+escritura ajena obligaria a SQLite a reiniciar la copia desde el principio).
+
+Uso desde linea de comandos:
+    python copias_seguridad.py crear
+    python copias_seguridad.py listar
+    python copias_seguridad.py restaurar copias/letras-20250101-030000-000000-1234.db
+"""
+
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from database import DB_NAME, abrir_conexion, migrate_db
+
+DIR_COPIAS = os.path.join(os.path.dirname(DB_NAME), "copias")
+# Cerrojo entre procesos: con varios workers solo uno copia a la vez
+CERROJO_COPIAS = os.path.join(DIR_COPIAS, ".copia.lock")
+
+# Paginas por paso (4 MB con paginas de 4 KB) y pausa entre pasos: cada paso
+# es una lectura corta; la pausa deja aire al resto de conexiones
+COPIA_PAGINAS_POR_PASO = 1024
+COPIA_PAUSA_S = 0.02
+
+# Programacion por defecto: una copia cada 24 h, se conservan las 7 ultimas
+COPIA_INTERVALO_HORAS = 24
+COPIA_RETENCION = 7
+
+
+# =============================================
+# Estado global de la copia en curso
+# =============================================
+class EstadoCopia:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.running = False
+        self.fichero = None
+        self.paginas_copiadas = 0
+        self.paginas_total = 0
+        self.mensaje = "Inactivo"
+        self.terminado = False
+        self.ultima = None  # informe de la ultima copia terminada
+
+    def to_dict(self):
+        with self.lock:
+            pct = round(self.paginas_copiadas / self.paginas_total * 100, 1) if self.paginas_total else 0
+            return {
+                "running": self.running,
+                "fichero": self.fichero,
+                "paginas_copiadas": self.paginas_copiadas,
+                "paginas_total": self.paginas_total,
+                "porcentaje": pct,
+                "mensaje": self.mensaje,
+                "terminado": self.terminado,
+                "ultima": self.ultima,
+            }
+
+
+estado_copia = EstadoCopia()
+
+
+class CopiaEnCurso(RuntimeError):
+    """Otro proceso tiene el cerrojo de copias."""
+
+
+@contextmanager
+def _cerrojo_copias():
+    """Cerrojo exclusivo no bloqueante sobre CERROJO_COPIAS; lanza CopiaEnCurso si esta tomado."""
+    os.makedirs(DIR_COPIAS, exist_ok=True)
+    fd = os.open(CERROJO_COPIAS, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            raise CopiaEnCurso("Ya hay una copia en curso en otro proceso") from None
+        yield
+        # Se libera al cerrar el descriptor
+    finally:
+        os.close(fd)
+
+
+def _ultima_copia_mtime():
+    copias = glob.glob(os.path.join(DIR_COPIAS, "letras-*.db"))
+    return max((os.path.getmtime(c) for c in copias), default=0)
+
+
+# =============================================
+# Copia, retencion y restauracion
+# =============================================
+
+def listar_copias():
+    """Copias existentes, de la mas reciente a la mas antigua."""
+    copias = []
+    for ruta in sorted(glob.glob(os.path.join(DIR_COPIAS, "letras-*.db")), reverse=True):
+        info = os.stat(ruta)
+        copias.append({
+            "fichero": os.path.basename(ruta),
+            "bytes": info.st_size,
+            "fecha": datetime.fromtimestamp(info.st_mtime).isoformat(timespec="seconds"),
+        })
+    return copias
+
+
+def aplicar_retencion(conservar=COPIA_RETENCION):
+    """Borra las copias mas antiguas dejando las `conservar` mas recientes. Devuelve las borradas."""
+    borradas = []
+    for copia in listar_copias()[conservar:]:
+        os.remove(os.path.join(DIR_COPIAS, copia["fichero"]))
+        borradas.append(copia["fichero"])
+    return borradas
+
+
+def crear_copia(paginas=COPIA_PAGINAS_POR_PASO, pausa=COPIA_PAUSA_S, retencion=COPIA_RETENCION,
+                intervalo_s=None):
+    """Copia la base de datos a DIR_COPIAS en un fichero autocontenido (sin -wal).
+
+    Se escribe primero en un .parcial y se renombra al terminar y pasar
+    quick_check, asi que una copia a medias nunca aparece en listar_copias().
+    Solo un proceso copia a la vez (lanza CopiaEnCurso si otro la tiene). Con
+    `intervalo_s`, ya dentro del cerrojo, no copia y devuelve None si la
+    ultima copia tiene menos de esos segundos.
+    """
+    with _cerrojo_copias():
+        if intervalo_s and time.time() - _ultima_copia_mtime() < intervalo_s:
+            return None
+        return _copiar(paginas, pausa, retencion)
+
+
+def _copiar(paginas, pausa, retencion):
+    # Nombre unico aunque dos copias caigan en el mismo segundo
+    ahora = datetime.now()
+    nombre = f"letras-{ahora:%Y%m%d-%H%M%S}-{ahora:%f}-{os.getpid()}.db"
+    final = os.path.join(DIR_COPIAS, nombre)
+    fd, parcial = tempfile.mkstemp(prefix=nombre + ".", suffix=".parcial", dir=DIR_COPIAS)
+    os.close(fd)
+
+    def progreso(status, restantes, total):
+        with estado_copia.lock:
+            estado_copia.paginas_total = total
+            estado_copia.paginas_copiadas = total - restantes
+        # El `sleep` de backup() solo se aplica si el paso devuelve BUSY
+        if restantes and pausa:
+            time.sleep(pausa)
+
+    with estado_copia.lock:
+        estado_copia.fichero = nombre
+        estado_copia.paginas_copiadas = estado_copia.paginas_total = 0
+        estado_copia.mensaje = f"Copiando a {nombre}..."
+
+    inicio = time.perf_counter()
+    origen = abrir_conexion(solo_lectura=True)
+    destino = sqlite3.connect(parcial)
+    try:
+        # Foto fija: la transaccion de lectura se mantiene durante todos los pasos
+        origen.execute("BEGIN")
+        origen.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        origen.backup(destino, pages=paginas, progress=progreso, sleep=pausa)
+        origen.rollback()
+        destino.execute("PRAGMA journal_mode=DELETE")
+        if destino.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise sqlite3.DatabaseError(f"La copia {nombre} no supera quick_check")
+    except BaseException:
+        destino.close()
+        if os.path.exists(parcial):
+            os.remove(parcial)
+        raise
+    finally:
+        origen.close()
+    destino.close()
+    os.replace(parcial, final)
+
+    informe = {
+        "fichero": nombre,
+        "bytes": os.path.getsize(final),
+        "segundos": round(time.perf_counter() - inicio, 2),
+        "borradas": aplicar_retencion(retencion),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+    }
+    with estado_copia.lock:
+        estado_copia.ultima = informe
+    return informe
+
+
+def restaurar_copia(fichero):
+    """Sustituye el contenido de la base de datos por el de una copia.
+
+    Usa tambien la API de backup, en un solo paso: las demas conexiones ven
+    el cambio de golpe. Despues aplica las migraciones que le falten a la
+    copia y adelanta version_datos para invalidar caches de otros procesos.
+    """
+    ruta = fichero if os.path.isabs(fichero) or os.path.exists(fichero) else os.path.join(DIR_COPIAS, fichero)
+    if not os.path.isfile(ruta):
+        raise FileNotFoundError(f"No existe la copia {fichero}")
+
+    origen = sqlite3.connect(f"file:{ruta}?mode=ro", uri=True)
+    destino = abrir_conexion()
+    try:
+        if origen.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise sqlite3.DatabaseError(f"La copia {fichero} no supera quick_check")
+        try:
+            version_previa = destino.execute(
+                "SELECT valor FROM version_datos WHERE clave = 'letras'").fetchone()[0]
+        except sqlite3.OperationalError:
+            version_previa = 0
+        origen.backup(destino)
+        destino.execute("PRAGMA journal_mode=WAL")
+    finally:
+        origen.close()
+        destino.close()
+
+    migrate_db()
+    conn = abrir_conexion()
+    try:
+        conn.execute(
+            "UPDATE version_datos SET valor = MAX(valor, ?) + 1 WHERE clave = 'letras'", (version_previa,))
+        conn.commit()
+        total = conn.execute("SELECT COUNT(*) FROM letras").fetchone()[0]
+    finally:
+        conn.close()
+    return {"fichero": os.path.basename(ruta), "letras": total}
+
+
+# =============================================
+# Ejecucion en hilo de fondo y programacion
+# =============================================
+
+def _worker_copia(retencion, intervalo_s):
+    state = estado_copia
+    try:
+        informe = crear_copia(retencion=retencion, intervalo_s=intervalo_s)
+        if informe is None:
+            mensaje = "Ya hay una copia reciente (hecha por otro proceso)"
+        else:
+            mensaje = f"Copia {informe['fichero']} completada en {informe['segundos']}s"
+    except CopiaEnCurso as e:
+        mensaje = str(e)
+    except Exception as e:
+        mensaje = f"Error en la copia: {e}"
+    with state.lock:
+        state.mensaje = mensaje
+        state.running = False
+        state.terminado = True
+
+
+def iniciar_copia(retencion=COPIA_RETENCION, intervalo_s=None):
+    """Lanza una copia en un hilo de fondo. Devuelve False si ya hay una en curso en este proceso."""
+    with estado_copia.lock:
+        if estado_copia.running:
+            return False
+        ultima = estado_copia.ultima
+        estado_copia.reset()
+        estado_copia.ultima = ultima
+        estado_copia.running = True
+        estado_copia.mensaje = "Iniciando..."
+
+    threading.Thread(
+        target=_worker_copia, args=(retencion, intervalo_s), name="copia-db", daemon=True).start()
+    return True
+
+
+def obtener_progreso():
+    """Estado de la copia en curso (o de la ultima) y copias disponibles."""
+    estado = estado_copia.to_dict()
+    estado["copias"] = listar_copias()
+    return estado
+
+
+def _bucle_programado(intervalo_horas, retencion):
+    intervalo = intervalo_horas * 3600
+    while True:
+        # Se mide contra la copia mas reciente en disco, no contra el arranque,
+        # asi que reiniciar la app no adelanta la copia. Con varios workers
+        # todos pueden despertar a la vez: crear_copia vuelve a mirar la ultima
+        # copia dentro del cerrojo entre procesos y solo copia uno
+        espera = _ultima_copia_mtime() + intervalo - time.time()
+        if espera <= 0:
+            iniciar_copia(retencion, intervalo_s=intervalo)
+            espera = intervalo
+        time.sleep(min(espera, 3600))
+
+
+_programador = None
+
+
+def iniciar_programador(intervalo_horas=COPIA_INTERVALO_HORAS, retencion=COPIA_RETENCION):
+    """Arranca (una sola vez por proceso) las copias periodicas. intervalo_horas<=0 las desactiva."""
+    global _programador
+    if intervalo_horas <= 0 or _programador is not None:
+        return False
+    _programador = threading.Thread(
+        target=_bucle_programado, args=(intervalo_horas, retencion), name="copias-programadas", daemon=True)
+    _programador.start()
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copias de seguridad de la base de datos de letras")
+    sub = parser.add_subparsers(dest="orden", required=True)
+    crear = sub.add_parser("crear", help="Hace una copia ahora")
+    crear.add_argument("--retencion", type=int, default=COPIA_RETENCION)
+    sub.add_parser("listar", help="Lista las copias disponibles")
+    restaurar = sub.add_parser("restaurar", help="Restaura una copia sobre la base de datos")
+    restaurar.add_argument("fichero")
+    args = parser.parse_args(argv)
+
+    if args.orden == "crear":
+        try:
+            informe = crear_copia(retencion=args.retencion)
+        except CopiaEnCurso as e:
+            print(e, file=sys.stderr)
+            return 1
+        print(f"{informe['fichero']}: {informe['bytes']} bytes en {informe['segundos']}s")
+        for borrada in informe["borradas"]:
+            print(f"  borrada {borrada}")
+    elif args.orden == "listar":
+        for copia in listar_copias():
+            print(f"{copia['fichero']}  {copia['bytes']:>12}  {copia['fecha']}")
+    else:
+        resultado = restaurar_copia(args.fichero)
+        print(f"Restaurada {resultado['fichero']}: {resultado['letras']} letras")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,174 +1,1750 @@
 import sqlite3
 import hashlib
+import json
+import math
+import operator
 import os
+import queue
+import re
+import struct
+import threading
+import time
+import unicodedata
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future
 from difflib import SequenceMatcher
 
 DB_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.db")
 
+# PRAGMAs por conexion: se aplican una sola vez al abrirla.
+# journal_mode=WAL es persistente en el fichero y se fija en migrate_db().
+PRAGMAS_CONEXION = (
+    ("foreign_keys", "ON"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", "-16000"),     # ~16 MB de cache de paginas
+    ("mmap_size", "268435456"),   # 256 MB mapeados en memoria
+    ("temp_store", "MEMORY"),
+    ("busy_timeout", "5000"),
+    ("journal_size_limit", "67108864"),  # el -wal se recorta a 64 MB tras cada checkpoint
+)
 
-def get_db():
-    conn = sqlite3.connect(DB_NAME)
+# Conexiones ociosas que se conservan para reutilizar
+POOL_TAMANO = 8
+
+# Instrumentacion de las conexiones de lectura (desactivada por defecto):
+# umbral de consulta lenta, muestras por consulta para los percentiles y
+# fichero (junto a la BD) donde se anotan las lentas con su plan
+CONSULTAS_UMBRAL_MS = 100
+CONSULTAS_MUESTRAS = 500
+CONSULTAS_LOG = "consultas_lentas.log"
+
+# Maximo de tareas de escritura que el hilo escritor agrupa en una transaccion
+ESCRITOR_MAX_TAREAS = 64
+
+# Registros que los importadores acumulan antes de cada importar_letras()
+LOTE_IMPORTACION = 200
+
+# Grupos de duplicados que resuelve cada transaccion de eliminar_duplicados()
+LOTE_DEDUPLICACION = 200
+
+# Metadatos que la letra canonica hereda de sus duplicados si le faltan
+CAMPOS_FUSIONABLES = ("autor", "anio", "modalidad", "tipo_pieza", "agrupacion")
+
+# Mantenimiento de letras_fts/letras_trigrama tras mutaciones masivas:
+# por encima de esta fraccion de filas tocadas se reconstruye el indice
+# entero en vez de reindexar fila a fila. automerge/crisismerge son los
+# parametros de fusion de segmentos de FTS5 (valores por defecto: 4 y 16).
+FTS_UMBRAL_RECONSTRUCCION = 0.25
+FTS_AUTOMERGE = 4
+FTS_CRISISMERGE = 16
+
+# Fragmentos de busqueda: tokens por fragmento (FTS5 admite hasta 64) y
+# columnas de letras_fts por las que se puede pedir (None = la que mejor
+# encaje en cada resultado)
+FRAGMENTO_TOKENS = 24
+FRAGMENTO_MAX_TOKENS = 64
+COLUMNAS_FTS = ("titulo", "contenido", "agrupacion")
+
+# Filtros de la busqueda (campo:valor): alias -> campo. titulo, agrupacion y
+# contenido filtran dentro de letras_fts; el resto son predicados sobre letras
+CAMPOS_BUSQUEDA = {
+    "anio": "anio", "año": "anio",
+    "modalidad": "modalidad",
+    "tipo": "tipo_pieza", "tipo_pieza": "tipo_pieza",
+    "autor": "autor",
+    "titulo": "titulo",
+    "agrupacion": "agrupacion",
+    "letra": "contenido", "contenido": "contenido",
+}
+
+# Rankings de busqueda completos que se conservan en memoria (LRU por consulta)
+BUSQUEDA_CACHE_TAMANO = 64
+
+# Agrupaciones que se devuelven en la faceta de una busqueda
+FACETAS_TOP_AGRUPACIONES = 10
+
+# Deteccion de casi duplicados: firma MinHash de MINHASH_BINS valores sobre
+# shingles de SHINGLE_CARACTERES caracteres, partida en LSH_BANDAS bandas.
+# Con 64 bins y 16 bandas de 4 filas, dos letras con similitud de Jaccard
+# por encima de ~0.5 caen casi seguro en alguna cubeta comun.
+SHINGLE_CARACTERES = 5
+MINHASH_BINS = 64
+LSH_BANDAS = 16
+
+# Longitud minima (caracteres) de las letras que se analizan y de las que
+# sirve /api/aleatorio. Forman parte del WHERE de indices parciales: al
+# cambiarlas hay que recrear esos indices en una migracion nueva
+LONGITUD_MIN_ANALISIS = 50
+LONGITUD_MIN_ALEATORIO = 100
+
+# Espera maxima por el cerrojo de migracion mientras otro proceso migra
+MIGRACION_ESPERA_MS = 600000
+
+# Tablas de conteos mantenidas por triggers sobre letras (como letras_fts).
+# claves: columnas de agrupacion; sumas: columna -> expresion sobre la fila
+# ({r} = new/old/letras); condicion: filas que cuentan en la tabla.
+_SUMAS_SCORE = {
+    "suma_score": "COALESCE({r}.score_poetico, 0)",
+    "n_score": "COALESCE({r}.score_poetico > 0, 0)",
+}
+AGREGADOS = {
+    "agg_anio_modalidad": {
+        "claves": ("anio", "modalidad"),
+        "sumas": {
+            "suma_calidad": "COALESCE({r}.calidad, 0)",
+            "n_calidad": "COALESCE({r}.calidad > 0, 0)",
+            "verificadas": "COALESCE({r}.verificado = 1, 0)",
+        },
+        "condicion": None,
+    },
+    "agg_tipo_pieza": {
+        "claves": ("tipo_pieza",),
+        "sumas": {},
+        "condicion": None,
+    },
+    "agg_agrupacion": {
+        "claves": ("agrupacion", "anio", "modalidad"),
+        "sumas": _SUMAS_SCORE,
+        "condicion": "{r}.agrupacion IS NOT NULL",
+    },
+    "agg_autor": {
+        "claves": ("autor", "agrupacion", "anio", "modalidad"),
+        "sumas": _SUMAS_SCORE,
+        "condicion": "{r}.autor IS NOT NULL",
+    },
+}
+
+# Entidades canonicas enlazadas a letras por tablas puente, mantenidas por
+# triggers. columna: columna de letras; puente: tabla letra <-> entidad.
+ENTIDADES = {
+    "autores": {"columna": "autor", "puente": "letra_autor", "fk": "autor_id"},
+    "agrupaciones": {"columna": "agrupacion", "puente": "letra_agrupacion", "fk": "agrupacion_id"},
+}
+
+# Columnas categoricas codificadas con diccionario: cada valor distinto se
+# guarda una vez en una tabla (id, nombre) y letras lo referencia por su
+# codigo entero (fk), mantenido por triggers. El texto sigue en letras tal
+# cual lo escriben los importadores, asi que las respuestas no cambian.
+CATEGORIAS = {
+    "modalidades": {"columna": "modalidad", "fk": "modalidad_id"},
+    "tipos_pieza": {"columna": "tipo_pieza", "fk": "tipo_pieza_id"},
+    "fuentes": {"columna": "fuente", "fk": "fuente_id"},
+}
+
+# Columnas pesadas fuera de la fila de letras, en tablas laterales 1:1 con el
+# mismo id. Las columnas originales de letras se conservan pero quedan a NULL;
+# la vista letras_completas reconstruye la fila entera.
+TABLAS_LATERALES = {
+    "letras_texto": ("contenido",),
+    "letras_analisis": ("analisis_poetico", "versos_destacados", "figuras_retoricas", "lexico_gaditano"),
+}
+COLUMNAS_PESADAS = tuple(c for cols in TABLAS_LATERALES.values() for c in cols)
+
+# analisis_poetico se guarda como BLOB: un byte de version y los datos.
+# 1 = JSON en UTF-8 comprimido con zlib. Las filas de texto son JSON sin comprimir
+# (formato antiguo) y migrate_db las convierte.
+FORMATO_ANALISIS = 1
+
+SQL_GUARDAR_CONTENIDO = """
+    INSERT INTO letras_texto (id, contenido) VALUES (:id, :contenido)
+    ON CONFLICT(id) DO UPDATE SET contenido = excluded.contenido
+"""
+
+
+def comprimir_analisis(texto_json):
+    """Codifica el JSON de un analisis poetico en el formato guardado."""
+    return bytes([FORMATO_ANALISIS]) + zlib.compress(texto_json.encode("utf-8"))
+
+
+def leer_analisis(valor):
+    """JSON (texto) de un analisis guardado, comprimido o en el formato antiguo."""
+    if valor is None or isinstance(valor, str):
+        return valor
+    if valor[0] != FORMATO_ANALISIS:
+        raise ValueError(f"Formato de analisis desconocido: {valor[0]}")
+    try:
+        return zlib.decompress(valor[1:]).decode("utf-8")
+    except zlib.error as e:
+        raise ValueError(f"Analisis comprimido corrupto: {e}") from e
+
+
+def normalizar_nombre(nombre):
+    """Clave de busqueda de un nombre: sin tildes, en minusculas y con espacios simples."""
+    if nombre is None:
+        return None
+    sin_tildes = "".join(
+        c for c in unicodedata.normalize("NFD", str(nombre))
+        if unicodedata.category(c) != "Mn"
+    )
+    return " ".join(sin_tildes.lower().split())
+
+
+_LITERALES_SQL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTAS_SQL = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SENTENCIAS_CON_PLAN = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def normalizar_sql(sql):
+    """Texto de la sentencia sin literales, listas IN ni espacios sobrantes: agrupa sus ejecuciones."""
+    sql = _LITERALES_SQL.sub("?", " ".join(sql.split()))
+    return _LISTAS_SQL.sub("(?, ...)", sql)
+
+
+def _percentil(ordenados, p):
+    return ordenados[min(len(ordenados) - 1, int(p * len(ordenados)))]
+
+
+def _capturar_plan(conn, sql, params):
+    """EXPLAIN QUERY PLAN de la sentencia, una linea por paso indentada segun su nivel."""
+    if not sql.lstrip().upper().startswith(_SENTENCIAS_CON_PLAN):
+        return []
+    try:
+        filas = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        return [f"(sin plan: {e})"]
+    niveles = {0: -1}
+    plan = []
+    for id_paso, padre, _, detalle in filas:
+        niveles[id_paso] = niveles.get(padre, -1) + 1
+        plan.append("  " * niveles[id_paso] + detalle)
+    return plan
+
+
+class RegistroConsultas:
+    """Llamadas, tiempos y filas por sentencia normalizada de las conexiones instrumentadas.
+
+    El tiempo de una ejecucion va de execute() hasta leer su ultima fila.
+    La primera vez que una sentencia pasa de `umbral_ms` se guarda su plan;
+    cada ejecucion lenta se anota en CONSULTAS_LOG. Desactivado, el pool da
+    conexiones sqlite3 normales y esto no cuesta nada.
+    """
+
+    def __init__(self, umbral_ms=CONSULTAS_UMBRAL_MS):
+        self.activo = False
+        self.umbral_ms = umbral_ms
+        self._lock = threading.Lock()
+        self._consultas = {}
+        self._lentas = deque(maxlen=100)
+
+    def registrar(self, conn, sql, params, ms, filas):
+        clave = normalizar_sql(sql)
+        with self._lock:
+            consulta = self._consultas.get(clave)
+            if consulta is None:
+                consulta = self._consultas[clave] = {
+                    "llamadas": 0, "total_ms": 0.0, "filas": 0,
+                    "muestras": deque(maxlen=CONSULTAS_MUESTRAS), "plan": None,
+                }
+            consulta["llamadas"] += 1
+            consulta["total_ms"] += ms
+            consulta["filas"] += filas
+            consulta["muestras"].append(ms)
+            lenta = ms >= self.umbral_ms
+            capturar = lenta and consulta["plan"] is None
+            if capturar:
+                consulta["plan"] = []  # el primer hilo que llega es el que lo captura
+        if not lenta:
+            return
+
+        if capturar:
+            consulta["plan"] = _capturar_plan(conn, sql, params)
+        entrada = {
+            "fecha": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "ms": round(ms, 2),
+            "filas": filas,
+            "sql": clave,
+            "plan": consulta["plan"],
+        }
+        with self._lock:
+            self._lentas.append(entrada)
+            try:
+                ruta = os.path.join(os.path.dirname(DB_NAME), CONSULTAS_LOG)
+                with open(ruta, "a", encoding="utf-8") as log:
+                    log.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+            except OSError:
+                pass
+
+    def resumen(self, orden="total_ms", limite=20):
+        """Las `limite` sentencias con mas `orden` (total_ms, p95_ms, max_ms, llamadas o filas)."""
+        with self._lock:
+            copia = [(sql, dict(c, muestras=sorted(c["muestras"]))) for sql, c in self._consultas.items()]
+            lentas = list(self._lentas)[-limite:][::-1]
+        consultas = []
+        for sql, c in copia:
+            muestras = c["muestras"]
+            consultas.append({
+                "sql": sql,
+                "llamadas": c["llamadas"],
+                "total_ms": round(c["total_ms"], 2),
+                "media_ms": round(c["total_ms"] / c["llamadas"], 2),
+                "p50_ms": round(_percentil(muestras, 0.50), 2),
+                "p95_ms": round(_percentil(muestras, 0.95), 2),
+                "max_ms": round(muestras[-1], 2),
+                "filas": c["filas"],
+                "plan": c["plan"],
+            })
+        consultas.sort(key=lambda c: c[orden], reverse=True)
+        return {
+            "activo": self.activo,
+            "umbral_ms": self.umbral_ms,
+            "sentencias": len(consultas),
+            "consultas": consultas[:limite],
+            "lentas": lentas,
+        }
+
+    def reiniciar(self):
+        with self._lock:
+            self._consultas.clear()
+            self._lentas.clear()
+
+
+consultas = RegistroConsultas()
+
+
+class CursorInstrumentado(sqlite3.Cursor):
+    """Cursor que mide cada sentencia desde execute() hasta agotar (o abandonar) sus filas."""
+
+    _medicion = None  # [sql, params, segundos, filas] de la sentencia en curso
+
+    def execute(self, sql, parameters=()):
+        self._terminar()
+        inicio = time.perf_counter()
+        super().execute(sql, parameters)
+        self._medicion = [sql, parameters, time.perf_counter() - inicio, 0]
+        if self.description is None:
+            self._terminar()  # sin filas que leer
+        return self
+
+    def _leer(self, leer, *args):
+        inicio = time.perf_counter()
+        resultado = leer(*args)
+        if self._medicion is not None:
+            self._medicion[2] += time.perf_counter() - inicio
+        return resultado
+
+    def _contar(self, n):
+        if self._medicion is not None:
+            self._medicion[3] += n
+
+    def fetchone(self):
+        fila = self._leer(super().fetchone)
+        if fila is None:
+            self._terminar()
+        else:
+            self._contar(1)
+        return fila
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        filas = self._leer(super().fetchmany, size)
+        self._contar(len(filas))
+        if len(filas) < size:
+            self._terminar()
+        return filas
+
+    def fetchall(self):
+        filas = self._leer(super().fetchall)
+        self._contar(len(filas))
+        self._terminar()
+        return filas
+
+    def __next__(self):
+        try:
+            fila = self._leer(super().__next__)
+        except StopIteration:
+            self._terminar()
+            raise
+        self._contar(1)
+        return fila
+
+    def close(self):
+        self._terminar()
+        super().close()
+
+    def __del__(self):
+        self._terminar()
+
+    def _terminar(self):
+        medicion, self._medicion = self._medicion, None
+        if medicion is not None:
+            sql, params, segundos, filas = medicion
+            consultas.registrar(self.connection, sql, params, segundos * 1000, filas)
+
+
+class ConexionInstrumentada(sqlite3.Connection):
+    """Conexion cuyos cursores (tambien los de conn.execute) registran en `consultas`."""
+
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def abrir_conexion(solo_lectura=False, instrumentada=False):
+    """Abre una conexion nueva ya configurada (fuera del pool)."""
+    conn = sqlite3.connect(
+        DB_NAME, check_same_thread=False,
+        factory=ConexionInstrumentada if instrumentada else sqlite3.Connection,
+    )
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
+    # Los triggers de ENTIDADES la usan: toda conexion que escriba en letras
+    # debe abrirse por aqui
+    conn.create_function("normalizar_nombre", 1, normalizar_nombre, deterministic=True)
+    conn.create_function("generar_huella", 1, generar_huella, deterministic=True)
+    conn.create_function("firma_minhash", 1, firma_minhash, deterministic=True)
+    conn.create_function("cubetas_lsh", 1, cubetas_lsh, deterministic=True)
+    # Cursor base: la configuracion no cuenta en el registro de consultas
+    ajustes = sqlite3.Cursor(conn)
+    for pragma, valor in PRAGMAS_CONEXION:
+        ajustes.execute(f"PRAGMA {pragma}={valor}")
+    if solo_lectura:
+        ajustes.execute("PRAGMA query_only=ON")
+    ajustes.close()
     return conn
 
 
-def init_db():
-    conn = get_db()
-    cursor = conn.cursor()
+class PoolConexiones:
+    """Pool acotado de conexiones SQLite de solo lectura, reutilizadas entre peticiones.
+
+    Si todas estan en uso se abre una conexion extra; al devolverla con el
+    pool lleno se cierra, de modo que nunca quedan mas de `tamano` ociosas.
+    Las escrituras van siempre por el hilo escritor (ver EscritorDB).
+    """
+
+    def __init__(self, tamano=POOL_TAMANO):
+        self.tamano = tamano
+        self._libres = queue.LifoQueue(maxsize=tamano)
+
+    def obtener(self):
+        try:
+            return self._libres.get_nowait()
+        except queue.Empty:
+            return abrir_conexion(solo_lectura=True, instrumentada=consultas.activo)
+
+    def devolver(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if isinstance(conn, ConexionInstrumentada) != consultas.activo:
+                raise queue.Full  # abierta antes de (des)activar la instrumentacion
+            self._libres.put_nowait(conn)
+        except (queue.Full, sqlite3.ProgrammingError):
+            # Pool lleno o conexion ya cerrada por el llamador
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass
+
+    def cerrar(self):
+        while True:
+            try:
+                self._libres.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = PoolConexiones()
+
+
+def get_db():
+    """Toma una conexion de lectura del pool. Devolverla con liberar_db()."""
+    return _pool.obtener()
+
+
+def liberar_db(conn):
+    """Devuelve al pool una conexion obtenida con get_db()."""
+    _pool.devolver(conn)
+
+
+def instrumentar_consultas(activo, umbral_ms=None):
+    """Activa o desactiva la instrumentacion de las conexiones de lectura del pool."""
+    if umbral_ms is not None:
+        consultas.umbral_ms = umbral_ms
+    if consultas.activo != activo:
+        consultas.activo = activo
+        # Las ociosas se cierran; las que estan en uso se descartan al devolverlas
+        _pool.cerrar()
+
+
+class EscritorDB:
+    """Hilo escritor unico: dueño de la unica conexion de escritura del proceso.
+
+    Los productores envian tareas (funciones que reciben la conexion) y el
+    hilo las agrupa en transacciones de hasta `max_tareas`. Cada tarea corre
+    en su propio SAVEPOINT, asi que un error solo deshace esa tarea. Las
+    tareas no deben hacer commit ni rollback.
+    """
+
+    def __init__(self, max_tareas=ESCRITOR_MAX_TAREAS):
+        self.max_tareas = max_tareas
+        self._cola = queue.Queue()
+        self._hilo = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._lotes = 0
+        self._tareas = 0
+        self._errores = 0
+        self._latencias = deque(maxlen=200)  # (tareas, espera_ms, transaccion_ms)
+
+    def enviar(self, tarea):
+        """Encola `tarea(conn)` y devuelve un Future con su resultado."""
+        futuro = Future()
+        if threading.current_thread() is self._hilo:
+            # Llamada anidada desde otra tarea: ya estamos dentro de la transaccion.
+            # Mismo contrato que la cola: SAVEPOINT propio y el error en el Future
+            self._conn.execute("SAVEPOINT tarea")
+            try:
+                futuro.set_result(tarea(self._conn))
+            except BaseException as e:
+                self._conn.execute("ROLLBACK TO tarea")
+                futuro.set_exception(e)
+            self._conn.execute("RELEASE tarea")
+            return futuro
+        self._arrancar()
+        self._cola.put((tarea, futuro, time.perf_counter()))
+        return futuro
+
+    def ejecutar(self, tarea):
+        """Ejecuta `tarea(conn)` en el hilo escritor y espera su resultado."""
+        return self.enviar(tarea).result()
+
+    def estadisticas(self):
+        with self._lock:
+            latencias = list(self._latencias)
+            stats = {
+                "activo": bool(self._hilo and self._hilo.is_alive()),
+                "pendientes": self._cola.qsize(),
+                "lotes": self._lotes,
+                "tareas": self._tareas,
+                "errores": self._errores,
+            }
+        if latencias:
+            totales = sorted(round(espera + trans, 2) for _, espera, trans in latencias)
+            stats["tareas_por_lote"] = round(sum(t for t, _, _ in latencias) / len(latencias), 1)
+            stats["ultimo_lote"] = {
+                "tareas": latencias[-1][0],
+                "espera_ms": latencias[-1][1],
+                "transaccion_ms": latencias[-1][2],
+            }
+            stats["latencia_ms"] = {
+                "media": round(sum(totales) / len(totales), 2),
+                "p95": totales[int(len(totales) * 0.95) - 1] if len(totales) >= 20 else totales[-1],
+                "max": totales[-1],
+            }
+        return stats
+
+    def _arrancar(self):
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name="escritor-db", daemon=True)
+                self._hilo.start()
+
+    def _bucle(self):
+        self._conn = abrir_conexion()
+        self._conn.isolation_level = None  # BEGIN/COMMIT explicitos
+        while True:
+            lote = [self._cola.get()]
+            while len(lote) < self.max_tareas:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+            self._procesar(lote)
+
+    def _procesar(self, lote):
+        conn = self._conn
+        inicio = time.perf_counter()
+        resultados = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for tarea, futuro, _ in lote:
+                conn.execute("SAVEPOINT tarea")
+                try:
+                    resultados.append((futuro, tarea(conn), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO tarea")
+                    resultados.append((futuro, None, e))
+                conn.execute("RELEASE tarea")
+            conn.execute("COMMIT")
+        except Exception as e:
+            # Fallo de BEGIN/COMMIT (p.ej. disco lleno): falla el lote entero
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            resultados = [(futuro, None, e) for _, futuro, _ in lote]
+        fin = time.perf_counter()
+
+        with self._lock:
+            self._lotes += 1
+            self._tareas += len(lote)
+            self._errores += sum(1 for _, _, err in resultados if err is not None)
+            espera = (inicio - min(encolado for _, _, encolado in lote)) * 1000
+            self._latencias.append((len(lote), round(espera, 2), round((fin - inicio) * 1000, 2)))
+
+        for futuro, resultado, error in resultados:
+            if error is not None:
+                futuro.set_exception(error)
+            else:
+                futuro.set_result(resultado)
+
+
+escritor = EscritorDB()
+
+
+def escribir(tarea):
+    """Ejecuta `tarea(conn)` en el hilo escritor y devuelve su resultado."""
+    return escritor.ejecutar(tarea)
+
+
+def escribir_lote(sql, filas):
+    """Aplica `sql` a todas las filas en una sola tarea del escritor. Devuelve filas afectadas.
+
+    `sql` puede ser una tupla de sentencias (con parametros con nombre) que se
+    aplican en orden a las mismas filas; cuenta la primera.
+    """
+    filas = list(filas)
+    if not filas:
+        return 0
+    sentencias = (sql,) if isinstance(sql, str) else tuple(sql)
+
+    def tarea(conn):
+        afectadas = conn.executemany(sentencias[0], filas).rowcount
+        for sentencia in sentencias[1:]:
+            conn.executemany(sentencia, filas)
+        return afectadas
+
+    return escribir(tarea)
+
+
+def init_db():
+    """Crea o actualiza el esquema completo (ver migrate_db)."""
+    migrate_db()
+
+
+def migrate_db():
+    """Aplica en orden las MIGRACIONES pendientes segun PRAGMA user_version.
+
+    Con el esquema al dia solo cuesta leer el PRAGMA. Si hay pendientes se
+    aplican todas en una transaccion BEGIN IMMEDIATE: el resto de procesos
+    (workers de gunicorn) espera al primero y luego ve la version nueva.
+    """
+    conn = sqlite3.connect(DB_NAME)
+    try:
+        al_dia = conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRACIONES)
+    finally:
+        conn.close()
+    if al_dia:
+        return
+
+    conn = abrir_conexion()
+    try:
+        conn.isolation_level = None
+        conn.execute(f"PRAGMA busy_timeout={MIGRACION_ESPERA_MS}")
+        # Solo surte efecto en una BD nueva y antes de pasar a WAL; las
+        # existentes se convierten con mantenimiento_db.convertir_auto_vacuum()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            for numero, migracion in enumerate(MIGRACIONES[version:], start=version + 1):
+                migracion(cursor)
+                cursor.execute(f"PRAGMA user_version={numero}")
+            _crear_vista_completa(cursor)
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+
+def _migracion_tabla_letras(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS letras (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            titulo TEXT NOT NULL,
+            anio TEXT,
+            modalidad TEXT,
+            tipo_pieza TEXT,
+            agrupacion TEXT,
+            autor TEXT,
+            contenido TEXT,
+            contenido_hash TEXT,
+            url TEXT UNIQUE,
+            fuente TEXT DEFAULT 'letrasdesdeelparaiso',
+            fecha_scraping TEXT DEFAULT (datetime('now')),
+            fecha_publicacion TEXT,
+            verificado INTEGER DEFAULT 0,
+            calidad INTEGER DEFAULT 0
+        )
+    """)
+
+
+def _migracion_columnas_e_indices(cursor):
+    """Columnas y indices que se fueron anadiendo a letras antes de versionar el esquema."""
+    nuevas_columnas = {
+        "tipo_pieza": "TEXT",
+        "autor": "TEXT",
+        "contenido_hash": "TEXT",
+        "fuente": "TEXT DEFAULT 'letrasdesdeelparaiso'",
+        "fecha_scraping": "TEXT",
+        "fecha_publicacion": "TEXT",
+        "verificado": "INTEGER DEFAULT 0",
+        "calidad": "INTEGER DEFAULT 0",
+        # Análisis poético
+        "metro_dominante": "TEXT",
+        "nombre_metro": "TEXT",
+        "coherencia_metrica": "INTEGER DEFAULT 0",
+        "esquema_rima": "TEXT",
+        "tipo_rima": "TEXT",
+        "score_poetico": "INTEGER DEFAULT 0",
+        "n_estrofas": "INTEGER DEFAULT 0",
+        "n_versos": "INTEGER DEFAULT 0",
+        "densidad_lexica": "REAL DEFAULT 0",
+        "versos_destacados": "TEXT",
+        "figuras_retoricas": "TEXT",
+        "lexico_gaditano": "TEXT",
+        "analisis_poetico": "TEXT",
+        "fecha_analisis": "TEXT",
+    }
+    _anadir_columnas(cursor, "letras", nuevas_columnas)
+
+    indices = [
+        ("idx_anio", "anio"),
+        ("idx_modalidad", "modalidad"),
+        ("idx_tipo_pieza", "tipo_pieza"),
+        ("idx_agrupacion", "agrupacion"),
+        ("idx_contenido_hash", "contenido_hash"),
+        ("idx_fuente", "fuente"),
+    ]
+    for idx_name, col in indices:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON letras({col})")
+
+
+def _migracion_indices_compuestos(cursor):
+    """Indices filtro + orden para /api/letras.
+
+    El rowid va implicito al final de cada indice, asi que sirven tambien
+    para el desempate por id de la paginacion por cursor.
+    """
+    indices_compuestos = [
+        ("idx_titulo", ("titulo",)),
+        ("idx_calidad", ("calidad",)),
+        ("idx_modalidad_anio_titulo", ("modalidad", "anio", "titulo")),
+        ("idx_anio_tipo_pieza_titulo", ("anio", "tipo_pieza", "titulo")),
+        ("idx_modalidad_titulo", ("modalidad", "titulo")),
+        ("idx_tipo_pieza_titulo", ("tipo_pieza", "titulo")),
+    ]
+    for idx_name, cols in indices_compuestos:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON letras({', '.join(cols)})")
+
+
+def _migracion_tablas_laterales_y_fts(cursor):
+    """Texto y analisis en tablas laterales; FTS5 leyendo el texto de la vista."""
+    _separar_columnas_pesadas(cursor)
+    _crear_vista_completa(cursor)
+    _comprimir_analisis_antiguos(cursor)
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name='letras_fts'")
+    fts_nueva = not cursor.fetchone()
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS letras_fts USING fts5(
+            titulo,
+            contenido,
+            agrupacion,
+            content='letras_completas',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+
+    # Triggers para mantener FTS sincronizado. titulo/agrupacion viven en
+    # letras y contenido en letras_texto: cada lado resincroniza lo suyo
+    texto_de = "(SELECT contenido FROM letras_texto WHERE id = {r}.id)"
+    triggers = [
+        ("letras_ai", f"""
+            CREATE TRIGGER IF NOT EXISTS letras_ai AFTER INSERT ON letras BEGIN
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                VALUES (new.id, new.titulo, {texto_de.format(r="new")}, new.agrupacion);
+            END
+        """),
+        ("letras_ad", f"""
+            CREATE TRIGGER IF NOT EXISTS letras_ad AFTER DELETE ON letras BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                VALUES ('delete', old.id, old.titulo, {texto_de.format(r="old")}, old.agrupacion);
+                DELETE FROM letras_texto WHERE id = old.id;
+                DELETE FROM letras_analisis WHERE id = old.id;
+            END
+        """),
+        ("letras_au", f"""
+            CREATE TRIGGER IF NOT EXISTS letras_au AFTER UPDATE OF titulo, agrupacion ON letras BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                VALUES ('delete', old.id, old.titulo, {texto_de.format(r="old")}, old.agrupacion);
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                VALUES (new.id, new.titulo, {texto_de.format(r="new")}, new.agrupacion);
+            END
+        """),
+        ("letras_texto_ai", """
+            CREATE TRIGGER IF NOT EXISTS letras_texto_ai AFTER INSERT ON letras_texto BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                SELECT 'delete', id, titulo, NULL, agrupacion FROM letras WHERE id = new.id;
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                SELECT id, titulo, new.contenido, agrupacion FROM letras WHERE id = new.id;
+            END
+        """),
+        ("letras_texto_ad", """
+            CREATE TRIGGER IF NOT EXISTS letras_texto_ad AFTER DELETE ON letras_texto BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                SELECT 'delete', id, titulo, old.contenido, agrupacion FROM letras WHERE id = old.id;
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                SELECT id, titulo, NULL, agrupacion FROM letras WHERE id = old.id;
+            END
+        """),
+        ("letras_texto_au", """
+            CREATE TRIGGER IF NOT EXISTS letras_texto_au AFTER UPDATE OF contenido ON letras_texto
+            WHEN old.contenido IS NOT new.contenido BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                SELECT 'delete', id, titulo, old.contenido, agrupacion FROM letras WHERE id = old.id;
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                SELECT id, titulo, new.contenido, agrupacion FROM letras WHERE id = new.id;
+            END
+        """),
+    ]
+    for name, sql in triggers:
+        cursor.execute(sql)
+    if fts_nueva:
+        cursor.execute("INSERT INTO letras_fts(letras_fts) VALUES ('rebuild')")
+
+
+def _migracion_estadisticas(cursor):
+    """Cache de estadisticas y contador de version de datos que la invalida."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats_cache (
+            clave TEXT PRIMARY KEY,
+            valor TEXT,
+            actualizado TEXT DEFAULT (datetime('now'))
+        )
+    """)
+    _anadir_columnas(cursor, "stats_cache", {"version": "INTEGER"})
+
+    # Cualquier cambio en letras incrementa el contador y deja obsoletas las
+    # estadisticas materializadas en stats_cache
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS version_datos (
+            clave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO version_datos (clave, valor) VALUES ('letras', 0)")
+    for evento in ("INSERT", "UPDATE", "DELETE"):
+        for tabla in ("letras", "letras_texto"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {tabla}_version_{evento.lower()} AFTER {evento} ON {tabla} BEGIN
+                    UPDATE version_datos SET valor = valor + 1 WHERE clave = 'letras';
+                END
+            """)
+
+
+def _migracion_agregados(cursor):
+    for tabla, definicion in AGREGADOS.items():
+        if not _existe_tabla(cursor, tabla):
+            _crear_agregado(cursor, tabla, definicion)
+
+
+def _migracion_entidades(cursor):
+    for tabla, definicion in ENTIDADES.items():
+        if not _existe_tabla(cursor, tabla):
+            _crear_entidad(cursor, tabla, definicion)
+
+
+def _migracion_trigrama(cursor):
+    if not _existe_tabla(cursor, "letras_trigrama"):
+        _crear_trigrama(cursor)
+
+
+def _migracion_pausa_fts(cursor):
+    """Triggers de FTS que se pueden pausar (ver mantenimiento_fts).
+
+    Con alguna fila en fts_pausa no tocan letras_fts ni letras_trigrama y
+    apuntan en fts_pendientes cada fila cambiada con los valores que tenia
+    indexados (indexada=0 si se inserto durante la pausa).
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS fts_pausa (id INTEGER PRIMARY KEY)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fts_pendientes (
+            id INTEGER PRIMARY KEY,
+            indexada INTEGER NOT NULL,
+            titulo TEXT,
+            agrupacion TEXT,
+            autor TEXT,
+            contenido TEXT
+        )
+    """)
+    for trigger in ("letras_ai", "letras_ad", "letras_au",
+                    "letras_texto_ai", "letras_texto_ad", "letras_texto_au",
+                    "letras_trigrama_ai", "letras_trigrama_ad", "letras_trigrama_au"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    activo = "NOT EXISTS (SELECT 1 FROM fts_pausa)"
+    pausado = "EXISTS (SELECT 1 FROM fts_pausa)"
+    texto_de = "(SELECT contenido FROM letras_texto WHERE id = {r}.id)"
+    trigrama = ", ".join(COLUMNAS_TRIGRAMA)
+    # Sin OR IGNORE: un upsert externo (SQL_GUARDAR_CONTENIDO) lo anularia
+    apuntar = "INSERT INTO fts_pendientes (id, indexada, titulo, agrupacion, autor, contenido)"
+    sin_apuntar = "NOT EXISTS (SELECT 1 FROM fts_pendientes WHERE id = {r}.id)"
+    triggers = [
+        f"""
+            CREATE TRIGGER letras_ai AFTER INSERT ON letras WHEN {activo} BEGIN
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                VALUES (new.id, new.titulo, {texto_de.format(r="new")}, new.agrupacion);
+            END
+        """,
+        # Sin WHEN: el borrado de las laterales va siempre, y el texto viejo
+        # hay que leerlo antes de borrarlo
+        f"""
+            CREATE TRIGGER letras_ad AFTER DELETE ON letras BEGIN
+                {apuntar}
+                SELECT old.id, 1, old.titulo, old.agrupacion, old.autor, {texto_de.format(r="old")}
+                WHERE {pausado} AND {sin_apuntar.format(r="old")};
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                SELECT 'delete', old.id, old.titulo, {texto_de.format(r="old")}, old.agrupacion
+                WHERE {activo};
+                DELETE FROM letras_texto WHERE id = old.id;
+                DELETE FROM letras_analisis WHERE id = old.id;
+            END
+        """,
+        f"""
+            CREATE TRIGGER letras_au AFTER UPDATE OF titulo, agrupacion ON letras WHEN {activo} BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                VALUES ('delete', old.id, old.titulo, {texto_de.format(r="old")}, old.agrupacion);
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                VALUES (new.id, new.titulo, {texto_de.format(r="new")}, new.agrupacion);
+            END
+        """,
+        f"""
+            CREATE TRIGGER letras_texto_ai AFTER INSERT ON letras_texto WHEN {activo} BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                SELECT 'delete', id, titulo, NULL, agrupacion FROM letras WHERE id = new.id;
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                SELECT id, titulo, new.contenido, agrupacion FROM letras WHERE id = new.id;
+            END
+        """,
+        f"""
+            CREATE TRIGGER letras_texto_ad AFTER DELETE ON letras_texto WHEN {activo} BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                SELECT 'delete', id, titulo, old.contenido, agrupacion FROM letras WHERE id = old.id;
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                SELECT id, titulo, NULL, agrupacion FROM letras WHERE id = old.id;
+            END
+        """,
+        f"""
+            CREATE TRIGGER letras_texto_au AFTER UPDATE OF contenido ON letras_texto
+            WHEN {activo} AND old.contenido IS NOT new.contenido BEGIN
+                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+                SELECT 'delete', id, titulo, old.contenido, agrupacion FROM letras WHERE id = old.id;
+                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+                SELECT id, titulo, new.contenido, agrupacion FROM letras WHERE id = new.id;
+            END
+        """,
+        f"""
+            CREATE TRIGGER letras_trigrama_ai AFTER INSERT ON letras WHEN {activo} BEGIN
+                INSERT INTO letras_trigrama(rowid, {trigrama}) VALUES (new.id, {_sql_valores_trigrama("new")});
+            END
+        """,
+        f"""
+            CREATE TRIGGER letras_trigrama_ad AFTER DELETE ON letras WHEN {activo} BEGIN
+                INSERT INTO letras_trigrama(letras_trigrama, rowid, {trigrama})
+                VALUES ('delete', old.id, {_sql_valores_trigrama("old")});
+            END
+        """,
+        f"""
+            CREATE TRIGGER letras_trigrama_au AFTER UPDATE OF {trigrama} ON letras WHEN {activo} BEGIN
+                INSERT INTO letras_trigrama(letras_trigrama, rowid, {trigrama})
+                VALUES ('delete', old.id, {_sql_valores_trigrama("old")});
+                INSERT INTO letras_trigrama(rowid, {trigrama}) VALUES (new.id, {_sql_valores_trigrama("new")});
+            END
+        """,
+        # Durante la pausa: solo apuntar la primera version de cada fila
+        f"""
+            CREATE TRIGGER fts_pendientes_letras_ai AFTER INSERT ON letras WHEN {pausado} BEGIN
+                INSERT INTO fts_pendientes (id, indexada) SELECT new.id, 0 WHERE {sin_apuntar.format(r="new")};
+            END
+        """,
+        f"""
+            CREATE TRIGGER fts_pendientes_letras_au AFTER UPDATE OF titulo, agrupacion, autor ON letras
+            WHEN {pausado} BEGIN
+                {apuntar}
+                SELECT old.id, 1, old.titulo, old.agrupacion, old.autor, {texto_de.format(r="old")}
+                WHERE {sin_apuntar.format(r="old")};
+            END
+        """,
+        f"""
+            CREATE TRIGGER fts_pendientes_texto_ai AFTER INSERT ON letras_texto WHEN {pausado} BEGIN
+                {apuntar}
+                SELECT id, 1, titulo, agrupacion, autor, NULL FROM letras
+                WHERE id = new.id AND {sin_apuntar.format(r="new")};
+            END
+        """,
+        f"""
+            CREATE TRIGGER fts_pendientes_texto_ad AFTER DELETE ON letras_texto WHEN {pausado} BEGIN
+                {apuntar}
+                SELECT id, 1, titulo, agrupacion, autor, old.contenido FROM letras
+                WHERE id = old.id AND {sin_apuntar.format(r="old")};
+            END
+        """,
+        f"""
+            CREATE TRIGGER fts_pendientes_texto_au AFTER UPDATE OF contenido ON letras_texto
+            WHEN {pausado} AND old.contenido IS NOT new.contenido BEGIN
+                {apuntar}
+                SELECT id, 1, titulo, agrupacion, autor, old.contenido FROM letras
+                WHERE id = old.id AND {sin_apuntar.format(r="old")};
+            END
+        """,
+    ]
+    for sql in triggers:
+        cursor.execute(sql)
+
+
+def _migracion_huella(cursor):
+    """Huella INTEGER de 64 bits del contenido: clave de deduplicacion mas estrecha que el MD5."""
+    _anadir_columnas(cursor, "letras", {"huella": "INTEGER"})
+    cursor.execute("""
+        UPDATE letras SET huella = generar_huella(t.contenido)
+        FROM letras_texto t
+        WHERE t.id = letras.id AND t.contenido IS NOT NULL AND letras.huella IS NULL
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_huella ON letras(huella)")
+
+
+def _migracion_minhash(cursor):
+    """Firmas MinHash y cubetas LSH de cada texto, mantenidas por triggers sobre letras_texto."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS letras_minhash (
+            id INTEGER PRIMARY KEY,
+            firma BLOB NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS letras_lsh (
+            cubeta INTEGER NOT NULL,
+            letra_id INTEGER NOT NULL,
+            PRIMARY KEY (cubeta, letra_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_letras_lsh_letra ON letras_lsh(letra_id)")
+
+    # Sin OR REPLACE: un upsert externo (SQL_GUARDAR_CONTENIDO) lo anularia
+    olvidar = """
+        DELETE FROM letras_lsh WHERE letra_id = {r}.id;
+        DELETE FROM letras_minhash WHERE id = {r}.id;
+    """
+    calcular = """
+        INSERT INTO letras_minhash (id, firma)
+        SELECT new.id, firma FROM (SELECT firma_minhash(new.contenido) AS firma) WHERE firma IS NOT NULL;
+        INSERT INTO letras_lsh (cubeta, letra_id)
+        SELECT j.value, m.id FROM letras_minhash m, json_each(cubetas_lsh(m.firma)) j WHERE m.id = new.id;
+    """
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS letras_minhash_ai AFTER INSERT ON letras_texto BEGIN
+            {olvidar.format(r="new")}
+            {calcular}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS letras_minhash_au AFTER UPDATE OF contenido ON letras_texto
+        WHEN old.contenido IS NOT new.contenido BEGIN
+            {olvidar.format(r="new")}
+            {calcular}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS letras_minhash_ad AFTER DELETE ON letras_texto BEGIN
+            {olvidar.format(r="old")}
+        END
+    """)
+
+    cursor.execute("""
+        INSERT OR IGNORE INTO letras_minhash (id, firma)
+        SELECT id, firma FROM (SELECT id, firma_minhash(contenido) AS firma FROM letras_texto)
+        WHERE firma IS NOT NULL
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO letras_lsh (cubeta, letra_id)
+        SELECT j.value, m.id FROM letras_minhash m, json_each(cubetas_lsh(m.firma)) j
+    """)
+
+
+def _migracion_procedencia(cursor):
+    """Registro de las letras fusionadas en otra al deduplicar: de donde venia cada copia."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS letras_procedencia (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            letra_id INTEGER NOT NULL,
+            origen_id INTEGER NOT NULL,
+            fuente TEXT,
+            url TEXT,
+            verificado INTEGER,
+            fecha_fusion TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_procedencia_letra ON letras_procedencia(letra_id)")
+
+
+def _sql_anio_num(r):
+    """Anio como entero a partir de los 4 primeros digitos del texto guardado (NULL si no los hay)."""
+    return (f"CASE WHEN trim({r}.anio) GLOB '[0-9][0-9][0-9][0-9]*' "
+            f"THEN CAST(substr(trim({r}.anio), 1, 4) AS INTEGER) END")
+
+
+def _migracion_anio_num(cursor):
+    """anio_num INTEGER junto al anio TEXT: los rangos por epoca y decada usan su indice.
+
+    Con anio TEXT, `anio >= 1940` compara texto con la afinidad de la columna
+    y no aprovecha idx_anio como rango numerico.
+    """
+    _anadir_columnas(cursor, "letras", {"anio_num": "INTEGER"})
+    cursor.execute(f"UPDATE letras SET anio_num = {_sql_anio_num('letras')} WHERE anio IS NOT NULL")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS letras_anio_num_ai AFTER INSERT ON letras
+        WHEN new.anio IS NOT NULL BEGIN
+            UPDATE letras SET anio_num = {_sql_anio_num('new')} WHERE id = new.id;
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS letras_anio_num_au AFTER UPDATE OF anio ON letras
+        WHEN old.anio IS NOT new.anio BEGIN
+            UPDATE letras SET anio_num = {_sql_anio_num('new')} WHERE id = new.id;
+        END
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_anio_num ON letras(anio_num)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_modalidad_anio_num ON letras(modalidad, anio_num)")
+
+
+def _sql_codificar_categoria(tabla, definicion, r):
+    """Alta del valor de la fila `r` en el diccionario (si es nuevo) y su codigo en letras."""
+    col, fk = definicion["columna"], definicion["fk"]
+    # NOT EXISTS y no OR IGNORE: un upsert externo anularia el IGNORE
+    return f"""
+        INSERT INTO {tabla} (nombre) SELECT {r}.{col}
+        WHERE {r}.{col} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {tabla} WHERE nombre = {r}.{col});
+        UPDATE letras SET {fk} = (SELECT id FROM {tabla} WHERE nombre = {r}.{col}) WHERE id = {r}.id;"""
+
+
+def _migracion_categorias(cursor):
+    """modalidad, tipo_pieza y fuente codificadas en diccionarios (ver CATEGORIAS).
+
+    Los filtros y GROUP BY pasan a los codigos enteros: sus indices son mas
+    pequenos que los de texto, que se sustituyen. Solo se conserva idx_modalidad
+    para ordenar /api/letras por el texto de la modalidad.
+    """
+    for tabla, definicion in CATEGORIAS.items():
+        col, fk = definicion["columna"], definicion["fk"]
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {tabla} (
+                id INTEGER PRIMARY KEY,
+                nombre TEXT NOT NULL UNIQUE
+            )
+        """)
+        _anadir_columnas(cursor, "letras", {fk: f"INTEGER REFERENCES {tabla}(id)"})
+
+        # Codigos en orden de primera aparicion
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO {tabla} (nombre)
+            SELECT {col} FROM letras WHERE {col} IS NOT NULL
+            GROUP BY {col} ORDER BY MIN(id)
+        """)
+        cursor.execute(f"UPDATE letras SET {fk} = c.id FROM {tabla} c WHERE c.nombre = letras.{col}")
+
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS letras_{fk}_ai AFTER INSERT ON letras
+            WHEN new.{col} IS NOT NULL BEGIN
+                {_sql_codificar_categoria(tabla, definicion, "new")}
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS letras_{fk}_au AFTER UPDATE OF {col} ON letras
+            WHEN old.{col} IS NOT new.{col} BEGIN
+                {_sql_codificar_categoria(tabla, definicion, "new")}
+            END
+        """)
+
+    indices = [
+        ("idx_modalidad_id_titulo", "modalidad_id, titulo"),
+        ("idx_modalidad_id_anio", "modalidad_id, anio"),
+        ("idx_modalidad_id_anio_num", "modalidad_id, anio_num"),
+        ("idx_tipo_pieza_id_titulo", "tipo_pieza_id, titulo"),
+        ("idx_anio_tipo_pieza_id_titulo", "anio, tipo_pieza_id, titulo"),
+        ("idx_fuente_id", "fuente_id"),
+    ]
+    for idx_name, cols in indices:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON letras({cols})")
+    for idx_name in ("idx_tipo_pieza", "idx_fuente", "idx_modalidad_titulo", "idx_tipo_pieza_titulo",
+                     "idx_modalidad_anio_titulo", "idx_anio_tipo_pieza_titulo", "idx_modalidad_anio_num"):
+        cursor.execute(f"DROP INDEX IF EXISTS {idx_name}")
+
+
+def _migracion_longitud(cursor):
+    """longitud (caracteres del contenido) en la fila ligera e indices parciales para colas y rankings.
+
+    Los filtros por longitud minima, la cola de analisis pendiente y los
+    "top score" se resuelven en estos indices sin leer letras_texto. El
+    contenido se inserta antes que su fila de letras (_fusionar_lote), asi
+    que la longitud se copia desde los dos lados.
+    """
+    _anadir_columnas(cursor, "letras", {"longitud": "INTEGER"})
+    cursor.execute("""
+        UPDATE letras SET longitud = length(t.contenido)
+        FROM letras_texto t WHERE t.id = letras.id AND t.contenido IS NOT NULL
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS letras_longitud_ai AFTER INSERT ON letras
+        WHEN EXISTS (SELECT 1 FROM letras_texto WHERE id = new.id) BEGIN
+            UPDATE letras SET longitud = (SELECT length(contenido) FROM letras_texto WHERE id = new.id)
+            WHERE id = new.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS letras_texto_longitud_ai AFTER INSERT ON letras_texto BEGIN
+            UPDATE letras SET longitud = length(new.contenido) WHERE id = new.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS letras_texto_longitud_au AFTER UPDATE OF contenido ON letras_texto
+        WHEN old.contenido IS NOT new.contenido BEGIN
+            UPDATE letras SET longitud = length(new.contenido) WHERE id = new.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS letras_texto_longitud_ad AFTER DELETE ON letras_texto BEGIN
+            UPDATE letras SET longitud = NULL WHERE id = old.id;
+        END
+    """)
+
+    # El WHERE de cada indice debe aparecer tal cual en la consulta (con el
+    # literal, no con un parametro) para que SQLite lo use
+    indices = [
+        ("idx_letras_pendientes", "longitud, fecha_analisis", "fecha_analisis IS NULL"),
+        ("idx_letras_analizables", "modalidad_id, anio, longitud", f"longitud > {LONGITUD_MIN_ANALISIS}"),
+        ("idx_letras_largas", "modalidad_id, anio, longitud", f"longitud > {LONGITUD_MIN_ALEATORIO}"),
+        ("idx_score_poetico", "score_poetico", "score_poetico > 0"),
+    ]
+    for idx_name, cols, condicion in indices:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON letras({cols}) WHERE {condicion}")
+
+
+def _migracion_indice_modalidad_anio_titulo(cursor):
+    """(modalidad_id, anio, titulo) en lugar de (modalidad_id, anio).
+
+    Es el equivalente de idx_modalidad_anio_titulo: /api/letras con modalidad
+    y anio ordenado por titulo busca la pagina en el indice sin releer la
+    modalidad entera.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_modalidad_id_anio_titulo ON letras(modalidad_id, anio, titulo)")
+    cursor.execute("DROP INDEX IF EXISTS idx_modalidad_id_anio")
+
+
+def filtro_categoria(tabla, alias=None):
+    """Condicion `fk = ?` sobre letras que resuelve el texto exacto del parametro a su codigo."""
+    fk = CATEGORIAS[tabla]["fk"]
+    return f"{alias + '.' if alias else ''}{fk} = (SELECT id FROM {tabla} WHERE nombre = ?)"
+
+
+# Migraciones en orden: la posicion (desde 1) es el numero guardado en
+# PRAGMA user_version. Solo se anaden al final; nunca se editan ni reordenan
+# las ya publicadas. Las primeras toleran bases creadas antes de versionar.
+MIGRACIONES = [
+    _migracion_tabla_letras,
+    _migracion_columnas_e_indices,
+    _migracion_indices_compuestos,
+    _migracion_tablas_laterales_y_fts,
+    _migracion_estadisticas,
+    _migracion_agregados,
+    _migracion_entidades,
+    _migracion_trigrama,
+    _migracion_pausa_fts,
+    _migracion_huella,
+    _migracion_minhash,
+    _migracion_procedencia,
+    _migracion_anio_num,
+    _migracion_categorias,
+    _migracion_longitud,
+    _migracion_indice_modalidad_anio_titulo,
+]
+
+
+def _existe_tabla(cursor, nombre):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (nombre,))
+    return cursor.fetchone() is not None
+
+
+def _anadir_columnas(cursor, tabla, columnas):
+    """ALTER TABLE ADD COLUMN de las columnas que aun no existan."""
+    cursor.execute(f"PRAGMA table_info({tabla})")
+    existentes = {row["name"] for row in cursor.fetchall()}
+    for col, tipo in columnas.items():
+        if col not in existentes:
+            cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {col} {tipo}")
+
+
+def _separar_columnas_pesadas(cursor):
+    """Crea las tablas laterales y mueve a ellas lo que quede en letras."""
+    for tabla, columnas in TABLAS_LATERALES.items():
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {tabla} (
+                id INTEGER PRIMARY KEY,
+                {", ".join(f"{c} TEXT" for c in columnas)}
+            )
+        """)
+
+    # El FTS antiguo indexaba letras directamente: se recrea sobre la vista
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name='letras_fts'")
+    row = cursor.fetchone()
+    if row and "content='letras'" in row["sql"]:
+        for trigger in ("letras_ai", "letras_ad", "letras_au"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DROP TABLE letras_fts")
+
+    for tabla, columnas in TABLAS_LATERALES.items():
+        hay_datos = " OR ".join(f"{c} IS NOT NULL" for c in columnas)
+        cursor.execute(f"""
+            INSERT INTO {tabla} (id, {", ".join(columnas)})
+            SELECT id, {", ".join(columnas)} FROM letras WHERE {hay_datos}
+            ON CONFLICT(id) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in columnas)}
+        """)
+        cursor.execute(f"UPDATE letras SET {', '.join(f'{c} = NULL' for c in columnas)} WHERE {hay_datos}")
+
+
+
+def _crear_vista_completa(cursor):
+    """(Re)crea letras_completas: fila ligera + laterales, con las columnas actuales."""
+    cursor.execute("PRAGMA table_info(letras)")
+    ligeras = [f"l.{row['name']}" for row in cursor.fetchall() if row["name"] not in COLUMNAS_PESADAS]
+    laterales = [f"{tabla}.{c}" for tabla, columnas in TABLAS_LATERALES.items() for c in columnas]
+    uniones = " ".join(f"LEFT JOIN {tabla} ON {tabla}.id = l.id" for tabla in TABLAS_LATERALES)
+    cursor.execute("DROP VIEW IF EXISTS letras_completas")
+    cursor.execute(f"CREATE VIEW letras_completas AS SELECT {', '.join(ligeras + laterales)} FROM letras l {uniones}")
+
+
+def _comprimir_analisis_antiguos(cursor):
+    cursor.execute("SELECT id, analisis_poetico FROM letras_analisis WHERE typeof(analisis_poetico) = 'text'")
+    cursor.executemany(
+        "UPDATE letras_analisis SET analisis_poetico = ? WHERE id = ?",
+        [(comprimir_analisis(row["analisis_poetico"]), row["id"]) for row in cursor.fetchall()],
+    )
+
+
+def _sql_sumar_agregado(tabla, definicion, r, signo):
+    """Sentencias que suman (signo '+') o restan ('-') la fila `r` en la tabla de conteos."""
+    claves = definicion["claves"]
+    sumas = definicion["sumas"]
+    donde = " AND ".join(f"{c} IS {r}.{c}" for c in claves)
+    condicion = definicion["condicion"].format(r=r) if definicion["condicion"] else "1"
+    asignaciones = ", ".join(
+        [f"cantidad = cantidad {signo} 1"] + [f"{col} = {col} {signo} {expr.format(r=r)}" for col, expr in sumas.items()]
+    )
+    sentencias = []
+    if signo == "+":
+        sentencias.append(f"""
+            INSERT INTO {tabla} ({", ".join(claves)})
+            SELECT {", ".join(f"{r}.{c}" for c in claves)}
+            WHERE {condicion} AND NOT EXISTS (SELECT 1 FROM {tabla} WHERE {donde});""")
+    sentencias.append(f"UPDATE {tabla} SET {asignaciones} WHERE {condicion} AND {donde};")
+    if signo == "-":
+        sentencias.append(f"DELETE FROM {tabla} WHERE {condicion} AND {donde} AND cantidad <= 0;")
+    return "\n".join(sentencias)
+
+
+def _crear_agregado(cursor, tabla, definicion):
+    claves = definicion["claves"]
+    sumas = definicion["sumas"]
+    columnas = [f"{c} TEXT" for c in claves] + ["cantidad INTEGER NOT NULL DEFAULT 0"]
+    columnas += [f"{col} INTEGER NOT NULL DEFAULT 0" for col in sumas]
+    cursor.execute(f"CREATE TABLE {tabla} ({', '.join(columnas)})")
+    cursor.execute(f"CREATE INDEX idx_{tabla} ON {tabla}({', '.join(claves)})")
+    if tabla == "agg_autor":
+        cursor.execute("CREATE INDEX idx_agg_autor_agrupacion ON agg_autor(agrupacion)")
+
+    vigiladas = list(claves) + sorted({col for expr in sumas.values() for col in re.findall(r"\{r\}\.(\w+)", expr)})
+    cambio = " OR ".join(f"old.{c} IS NOT new.{c}" for c in vigiladas)
+    cursor.execute(f"""
+        CREATE TRIGGER {tabla}_ai AFTER INSERT ON letras BEGIN
+            {_sql_sumar_agregado(tabla, definicion, "new", "+")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER {tabla}_ad AFTER DELETE ON letras BEGIN
+            {_sql_sumar_agregado(tabla, definicion, "old", "-")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER {tabla}_au AFTER UPDATE OF {", ".join(vigiladas)} ON letras
+        WHEN {cambio} BEGIN
+            {_sql_sumar_agregado(tabla, definicion, "old", "-")}
+            {_sql_sumar_agregado(tabla, definicion, "new", "+")}
+        END
+    """)
+
+    # Carga inicial desde las filas existentes
+    condicion = definicion["condicion"].format(r="letras") if definicion["condicion"] else "1"
+    cursor.execute(f"""
+        INSERT INTO {tabla} ({", ".join(claves)}, cantidad{"".join(", " + col for col in sumas)})
+        SELECT {", ".join(claves)}, COUNT(*){"".join(f", SUM({expr.format(r='letras')})" for expr in sumas.values())}
+        FROM letras WHERE {condicion}
+        GROUP BY {", ".join(claves)}
+    """)
+
+
+def _sql_enlazar_entidad(tabla, definicion, r):
+    """Alta de la entidad de la fila `r` (si no existe) y su enlace en la tabla puente."""
+    col, puente, fk = definicion["columna"], definicion["puente"], definicion["fk"]
+    return f"""
+        INSERT OR IGNORE INTO {tabla} (nombre, nombre_norm)
+        SELECT {r}.{col}, normalizar_nombre({r}.{col})
+        WHERE normalizar_nombre({r}.{col}) != '';
+        INSERT OR IGNORE INTO {puente} ({fk}, letra_id)
+        SELECT id, {r}.id FROM {tabla} WHERE nombre_norm = normalizar_nombre({r}.{col});"""
+
+
+def _sql_desenlazar_entidad(tabla, definicion, r):
+    """Quita el enlace de la fila `r` y la entidad si se queda sin letras."""
+    puente, fk = definicion["puente"], definicion["fk"]
+    return f"""
+        DELETE FROM {puente} WHERE letra_id = {r}.id;
+        DELETE FROM {tabla} WHERE nombre_norm = normalizar_nombre({r}.{definicion["columna"]})
+            AND NOT EXISTS (SELECT 1 FROM {puente} WHERE {fk} = {tabla}.id);"""
+
+
+def _crear_entidad(cursor, tabla, definicion):
+    col, puente, fk = definicion["columna"], definicion["puente"], definicion["fk"]
+    cursor.execute(f"""
+        CREATE TABLE {tabla} (
+            id INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            nombre_norm TEXT NOT NULL UNIQUE
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TABLE {puente} (
+            {fk} INTEGER NOT NULL REFERENCES {tabla}(id),
+            letra_id INTEGER NOT NULL,
+            PRIMARY KEY ({fk}, letra_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute(f"CREATE INDEX idx_{puente}_letra ON {puente}(letra_id)")
+
+    cursor.execute(f"""
+        CREATE TRIGGER {puente}_ai AFTER INSERT ON letras BEGIN
+            {_sql_enlazar_entidad(tabla, definicion, "new")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER {puente}_ad AFTER DELETE ON letras BEGIN
+            {_sql_desenlazar_entidad(tabla, definicion, "old")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER {puente}_au AFTER UPDATE OF {col} ON letras
+        WHEN normalizar_nombre(old.{col}) IS NOT normalizar_nombre(new.{col}) BEGIN
+            {_sql_desenlazar_entidad(tabla, definicion, "old")}
+            {_sql_enlazar_entidad(tabla, definicion, "new")}
+        END
+    """)
+
+    # Carga inicial: el nombre visible es el de la primera letra con esa clave
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO {tabla} (nombre, nombre_norm)
+        SELECT {col}, normalizar_nombre({col}) FROM letras
+        WHERE normalizar_nombre({col}) != ''
+        ORDER BY id
+    """)
+    cursor.execute(f"""
+        INSERT INTO {puente} ({fk}, letra_id)
+        SELECT e.id, l.id FROM letras l
+        JOIN {tabla} e ON e.nombre_norm = normalizar_nombre(l.{col})
+    """)
+
+
+def expresion_trigrama(columna, texto):
+    """Expresion MATCH de letras_trigrama que busca `texto` como subcadena de `columna`.
+
+    Devuelve None si el texto normalizado tiene menos de 3 caracteres: el
+    indice trigram no lo puede resolver y hay que recurrir a instr().
+    """
+    clave = normalizar_nombre(texto)
+    if not clave or len(clave) < 3:
+        return None
+    return '%s : "%s"' % (columna, clave.replace('"', '""'))
+
+
+def resolver_entidad(conn, tabla, nombre):
+    """Id y nombre canonico de un autor o agrupacion, o None si no existe.
+
+    Primero busca la clave normalizada exacta; si no hay, el nombre mas
+    corto que la contenga, localizado con el indice trigram.
+    """
+    clave = normalizar_nombre(nombre)
+    if not clave:
+        return None
+    row = conn.execute(f"SELECT id, nombre FROM {tabla} WHERE nombre_norm = ?", (clave,)).fetchone()
+    if row:
+        return row["id"], row["nombre"]
 
-    # Verificar si la tabla existe
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='letras'")
-    if not cursor.fetchone():
-        cursor.execute("""
-            CREATE TABLE letras (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                titulo TEXT NOT NULL,
-                anio TEXT,
-                modalidad TEXT,
-                tipo_pieza TEXT,
-                agrupacion TEXT,
-                autor TEXT,
-                contenido TEXT,
-                contenido_hash TEXT,
-                url TEXT UNIQUE,
-                fuente TEXT DEFAULT 'letrasdesdeelparaiso',
-                fecha_scraping TEXT DEFAULT (datetime('now')),
-                fecha_publicacion TEXT,
-                verificado INTEGER DEFAULT 0,
-                calidad INTEGER DEFAULT 0
-            )
-        """)
+    definicion = ENTIDADES[tabla]
+    expresion = expresion_trigrama(definicion["columna"], nombre)
+    if expresion:
+        row = conn.execute(f"""
+            SELECT id, nombre FROM {tabla} WHERE id IN (
+                SELECT {definicion["fk"]} FROM {definicion["puente"]} WHERE letra_id IN (
+                    SELECT rowid FROM letras_trigrama WHERE letras_trigrama MATCH ?))
+            ORDER BY LENGTH(nombre_norm), nombre_norm LIMIT 1
+        """, (expresion,)).fetchone()
+    else:
+        row = conn.execute(f"""
+            SELECT id, nombre FROM {tabla} WHERE instr(nombre_norm, ?) > 0
+            ORDER BY LENGTH(nombre_norm), nombre_norm LIMIT 1
+        """, (clave,)).fetchone()
+    return (row["id"], row["nombre"]) if row else None
 
-    conn.commit()
-    conn.close()
 
+# Indice trigram sin contenido (content='') sobre los nombres normalizados:
+# solo devuelve rowids, que son ids de letras
+COLUMNAS_TRIGRAMA = ("titulo", "agrupacion", "autor")
 
-def migrate_db():
-    """Migra la base de datos existente al nuevo esquema sin perder datos."""
-    conn = get_db()
-    cursor = conn.cursor()
 
-    # Verificar columnas existentes
-    cursor.execute("PRAGMA table_info(letras)")
-    columnas = {row["name"] for row in cursor.fetchall()}
+def _sql_valores_trigrama(r):
+    return ", ".join(f"normalizar_nombre({r}.{c})" for c in COLUMNAS_TRIGRAMA)
 
-    nuevas_columnas = {
-        "tipo_pieza": "TEXT",
-        "autor": "TEXT",
-        "contenido_hash": "TEXT",
-        "fuente": "TEXT DEFAULT 'letrasdesdeelparaiso'",
-        "fecha_scraping": "TEXT",
-        "fecha_publicacion": "TEXT",
-        "verificado": "INTEGER DEFAULT 0",
-        "calidad": "INTEGER DEFAULT 0",
-        # Análisis poético
-        "metro_dominante": "TEXT",
-        "nombre_metro": "TEXT",
-        "coherencia_metrica": "INTEGER DEFAULT 0",
-        "esquema_rima": "TEXT",
-        "tipo_rima": "TEXT",
-        "score_poetico": "INTEGER DEFAULT 0",
-        "n_estrofas": "INTEGER DEFAULT 0",
-        "n_versos": "INTEGER DEFAULT 0",
-        "densidad_lexica": "REAL DEFAULT 0",
-        "versos_destacados": "TEXT",
-        "figuras_retoricas": "TEXT",
-        "lexico_gaditano": "TEXT",
-        "analisis_poetico": "TEXT",
-        "fecha_analisis": "TEXT",
-    }
 
-    for col, tipo in nuevas_columnas.items():
-        if col not in columnas:
-            try:
-                cursor.execute(f"ALTER TABLE letras ADD COLUMN {col} {tipo}")
-            except sqlite3.OperationalError:
-                pass
+def _crear_trigrama(cursor):
+    columnas = ", ".join(COLUMNAS_TRIGRAMA)
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE letras_trigrama USING fts5(
+            {columnas}, content='', tokenize='trigram'
+        )
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER letras_trigrama_ai AFTER INSERT ON letras BEGIN
+            INSERT INTO letras_trigrama(rowid, {columnas}) VALUES (new.id, {_sql_valores_trigrama("new")});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER letras_trigrama_ad AFTER DELETE ON letras BEGIN
+            INSERT INTO letras_trigrama(letras_trigrama, rowid, {columnas})
+            VALUES ('delete', old.id, {_sql_valores_trigrama("old")});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER letras_trigrama_au AFTER UPDATE OF {columnas} ON letras BEGIN
+            INSERT INTO letras_trigrama(letras_trigrama, rowid, {columnas})
+            VALUES ('delete', old.id, {_sql_valores_trigrama("old")});
+            INSERT INTO letras_trigrama(rowid, {columnas}) VALUES (new.id, {_sql_valores_trigrama("new")});
+        END
+    """)
+    _cargar_trigrama(cursor)
 
-    # Crear indices
-    indices = [
-        ("idx_anio", "anio"),
-        ("idx_modalidad", "modalidad"),
-        ("idx_tipo_pieza", "tipo_pieza"),
-        ("idx_agrupacion", "agrupacion"),
-        ("idx_contenido_hash", "contenido_hash"),
-        ("idx_fuente", "fuente"),
-    ]
-    for idx_name, col in indices:
-        if col in columnas or col in nuevas_columnas:
-            try:
-                cursor.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON letras({col})")
-            except sqlite3.OperationalError:
-                pass
 
-    # FTS5 para busqueda full-text
+def _cargar_trigrama(cursor):
+    cursor.execute(f"""
+        INSERT INTO letras_trigrama(rowid, {", ".join(COLUMNAS_TRIGRAMA)})
+        SELECT id, {_sql_valores_trigrama("letras")} FROM letras
+    """)
+
+
+# =========================
+# ESTADISTICAS MATERIALIZADAS
+# =========================
+
+_recalculos_en_curso = set()
+_recalculos_lock = threading.Lock()
+
+
+def _recalcular_estadistica(clave, calcular):
+    """Calcula `clave` sobre una instantanea consistente y la guarda con su version."""
+    conn = get_db()
     try:
-        cursor.execute("""
-            CREATE VIRTUAL TABLE IF NOT EXISTS letras_fts USING fts5(
-                titulo,
-                contenido,
-                agrupacion,
-                content='letras',
-                content_rowid='id',
-                tokenize='unicode61 remove_diacritics 2'
-            )
-        """)
-    except sqlite3.OperationalError:
-        pass
+        conn.execute("BEGIN")
+        version = conn.execute("SELECT valor FROM version_datos WHERE clave = 'letras'").fetchone()[0]
+        valor = calcular(conn)
+    finally:
+        liberar_db(conn)
 
-    # Triggers para mantener FTS sincronizado
-    triggers = [
-        ("letras_ai", """
-            CREATE TRIGGER IF NOT EXISTS letras_ai AFTER INSERT ON letras BEGIN
-                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
-                VALUES (new.id, new.titulo, new.contenido, new.agrupacion);
-            END
-        """),
-        ("letras_ad", """
-            CREATE TRIGGER IF NOT EXISTS letras_ad AFTER DELETE ON letras BEGIN
-                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
-                VALUES ('delete', old.id, old.titulo, old.contenido, old.agrupacion);
-            END
-        """),
-        ("letras_au", """
-            CREATE TRIGGER IF NOT EXISTS letras_au AFTER UPDATE ON letras BEGIN
-                INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
-                VALUES ('delete', old.id, old.titulo, old.contenido, old.agrupacion);
-                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
-                VALUES (new.id, new.titulo, new.contenido, new.agrupacion);
-            END
-        """),
-    ]
-    for name, sql in triggers:
+    escribir(lambda c: c.execute("""
+        INSERT OR REPLACE INTO stats_cache (clave, valor, version, actualizado)
+        VALUES (?, ?, ?, datetime('now'))
+    """, (clave, json.dumps(valor, ensure_ascii=False), version)))
+    return valor
+
+
+def _recalcular_en_segundo_plano(clave, calcular):
+    with _recalculos_lock:
+        if clave in _recalculos_en_curso:
+            return
+        _recalculos_en_curso.add(clave)
+
+    def trabajo():
         try:
-            cursor.execute(sql)
-        except sqlite3.OperationalError:
-            pass
+            _recalcular_estadistica(clave, calcular)
+        finally:
+            with _recalculos_lock:
+                _recalculos_en_curso.discard(clave)
 
-    # Tabla de estadisticas cache
-    try:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS stats_cache (
-                clave TEXT PRIMARY KEY,
-                valor TEXT,
-                actualizado TEXT DEFAULT (datetime('now'))
-            )
-        """)
-    except sqlite3.OperationalError:
-        pass
+    threading.Thread(target=trabajo, name=f"stats-{clave}", daemon=True).start()
+
+
+def estadistica_materializada(clave, calcular):
+    """Devuelve la estadistica `clave` desde stats_cache.
+
+    `calcular(conn)` produce el valor. Si la copia guardada es de una version
+    de datos anterior se devuelve igualmente y se recalcula en segundo plano;
+    solo se calcula en linea la primera vez que no hay copia.
+    """
+    conn = get_db()
+    row = conn.execute("""
+        SELECT s.valor, s.version = v.valor AS vigente
+        FROM stats_cache s, version_datos v
+        WHERE s.clave = ? AND v.clave = 'letras'
+    """, (clave,)).fetchone()
+    liberar_db(conn)
+
+    if row is None or row["valor"] is None:
+        return _recalcular_estadistica(clave, calcular)
+    if not row["vigente"]:
+        _recalcular_en_segundo_plano(clave, calcular)
+    return json.loads(row["valor"])
 
-    conn.commit()
-    conn.close()
+
+def _texto_para_hash(texto):
+    return " ".join(texto.lower().split())
 
 
 def generar_hash(texto):
     if not texto:
         return None
-    normalizado = texto.lower().strip()
-    normalizado = " ".join(normalizado.split())
-    return hashlib.md5(normalizado.encode("utf-8")).hexdigest()
+    return hashlib.md5(_texto_para_hash(texto).encode("utf-8")).hexdigest()
+
+
+def generar_huella(texto):
+    """Primeros 8 bytes de blake2b del texto normalizado (como generar_hash), como INTEGER con signo.
+
+    Es la clave de igualdad y agrupacion de duplicados: cabe en un entero de
+    SQLite y su indice es mucho mas pequeno que el de contenido_hash.
+    """
+    if not texto:
+        return None
+    digest = hashlib.blake2b(_texto_para_hash(texto).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def _fusionar_lote(conn, registros):
+    """Vuelca `registros` en una tabla de staging y los fusiona en letras por conjuntos.
+
+    Se ejecuta como tarea del escritor. Descarta los que ya existen en letras
+    por huella del contenido o por url, y los repetidos dentro del propio lote
+    (gana el primero). Cada registro inserta solo las columnas que trae: las
+    que le faltan toman el DEFAULT de letras aunque otros registros del lote
+    las tengan. Devuelve {"nuevas": n, "duplicadas": m}.
+    """
+    existentes = {row["name"] for row in conn.execute("PRAGMA table_info(letras)")}
+    columnas = list(dict.fromkeys(["contenido_hash", "huella", "url"] + [c for r in registros for c in r]))
+    desconocidas = [c for c in columnas if c not in existentes or c == "id"]
+    if desconocidas:
+        raise ValueError(f"Columnas no importables: {', '.join(desconocidas)}")
+
+    conn.execute("DROP TABLE IF EXISTS temp.letras_staging")
+    conn.execute(f"CREATE TEMP TABLE letras_staging (seq INTEGER PRIMARY KEY, letra_id INTEGER, grupo INTEGER, {', '.join(columnas)})")
+    # Registros agrupados por el conjunto de columnas que traen
+    grupos = {}
+    for r in registros:
+        grupos.setdefault(frozenset(r), len(grupos))
+    conn.executemany(
+        f"INSERT INTO letras_staging (grupo, {', '.join(columnas)}) VALUES (?, {', '.join('?' for _ in columnas)})",
+        [[grupos[frozenset(r)]] + [r.get(c) for c in columnas] for r in registros],
+    )
+    if "contenido" in columnas:
+        conn.execute("UPDATE letras_staging SET huella = generar_huella(contenido) WHERE huella IS NULL")
+    conn.execute("CREATE INDEX temp.idx_staging_huella ON letras_staging(huella)")
+    conn.execute("CREATE INDEX temp.idx_staging_url ON letras_staging(url)")
+
+    # Ids para las nuevas, consecutivos tras el ultimo usado (AUTOINCREMENT)
+    conn.execute("""
+        UPDATE letras_staging SET letra_id = base.ultimo + r.n
+        FROM (
+            SELECT s.seq, ROW_NUMBER() OVER (ORDER BY s.seq) AS n
+            FROM letras_staging s
+            WHERE NOT EXISTS (SELECT 1 FROM letras l WHERE l.huella = s.huella)
+              AND NOT EXISTS (SELECT 1 FROM letras l WHERE l.url = s.url)
+              AND NOT EXISTS (
+                  SELECT 1 FROM letras_staging p
+                  WHERE p.seq < s.seq AND (p.huella = s.huella OR p.url = s.url))
+        ) AS r, (
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'letras'), 0),
+                       COALESCE((SELECT MAX(id) FROM letras), 0)) AS ultimo
+        ) AS base
+        WHERE letras_staging.seq = r.seq
+    """)
+
+    # Laterales antes que letras: asi el trigger de FTS ya encuentra el texto
+    for tabla, pesadas in TABLAS_LATERALES.items():
+        pesadas = [c for c in pesadas if c in columnas]
+        if pesadas:
+            conn.execute(f"""
+                INSERT INTO {tabla} (id, {", ".join(pesadas)})
+                SELECT letra_id, {", ".join(pesadas)} FROM letras_staging
+                WHERE letra_id IS NOT NULL AND ({" OR ".join(f"{c} IS NOT NULL" for c in pesadas)})
+            """)
+    # contenido_hash, huella y url (sin DEFAULT) van siempre: se calculan aqui
+    nuevas = 0
+    for claves, grupo in grupos.items():
+        ligeras = [c for c in columnas if c not in COLUMNAS_PESADAS
+                   and (c in claves or c in ("contenido_hash", "huella", "url"))]
+        nuevas += conn.execute(f"""
+            INSERT INTO letras (id, {", ".join(ligeras)}, fecha_scraping)
+            SELECT letra_id, {", ".join(ligeras)}, datetime('now') FROM letras_staging
+            WHERE letra_id IS NOT NULL AND grupo = ? ORDER BY seq
+        """, (grupo,)).rowcount
+    conn.execute("DROP TABLE temp.letras_staging")
+    return {"nuevas": nuevas, "duplicadas": len(registros) - nuevas}
+
+
+def importar_letras(registros):
+    """Importa un lote de letras (dicts con columnas de letras) en una sola transaccion.
+
+    Devuelve {"nuevas": n, "duplicadas": m}.
+    """
+    registros = list(registros)
+    if not registros:
+        return {"nuevas": 0, "duplicadas": 0}
+    return escribir(lambda conn: _fusionar_lote(conn, registros))
+
+
+def guardar_letra(datos):
+    """Encola la insercion de una letra en el hilo escritor. Devuelve un Future(bool)."""
+    return escritor.enviar(lambda conn: _fusionar_lote(conn, [datos])["nuevas"] == 1)
 
 
 def calcular_similitud(texto1, texto2):
@@ -177,24 +1753,162 @@ def calcular_similitud(texto1, texto2):
     return SequenceMatcher(None, texto1.lower(), texto2.lower()).ratio()
 
 
-def buscar_duplicados(umbral=0.90):
-    """Detecta letras duplicadas por hash exacto."""
+_SIN_PUNTUACION = re.compile(r"[^\w\s]")
+
+
+def firma_minhash(texto):
+    """Firma MinHash (BLOB de MINHASH_BINS enteros de 32 bits) de los shingles del texto.
+
+    El texto se compara sin tildes, mayusculas, puntuacion ni saltos de linea.
+    Cada shingle se hashea una sola vez (one permutation hashing): sus bits
+    bajos eligen el bin y el resto es el valor; los bins vacios de textos
+    cortos toman el del siguiente bin lleno desplazado segun la distancia.
+    """
+    if not texto:
+        return None
+    limpio = " ".join(_SIN_PUNTUACION.sub(" ", normalizar_nombre(texto)).split())
+    if len(limpio) < SHINGLE_CARACTERES:
+        return None
+
+    bits = MINHASH_BINS.bit_length() - 1
+    vacio = 1 << (32 - bits)
+    minimos = [vacio] * MINHASH_BINS
+    shingles = {limpio[i:i + SHINGLE_CARACTERES] for i in range(len(limpio) - SHINGLE_CARACTERES + 1)}
+    for shingle in shingles:
+        h = zlib.crc32(shingle.encode("utf-8"))
+        b, v = h & (MINHASH_BINS - 1), h >> bits
+        if v < minimos[b]:
+            minimos[b] = v
+
+    firma = list(minimos)
+    for b in range(MINHASH_BINS):
+        distancia = 1
+        while firma[b] == vacio:
+            vecino = minimos[(b + distancia) % MINHASH_BINS]
+            if vecino != vacio:
+                firma[b] = vecino + distancia * vacio
+            distancia += 1
+    return struct.pack(f"<{MINHASH_BINS}I", *firma)
+
+
+def cubetas_lsh(firma):
+    """Cubeta LSH de cada banda de la firma (banda en los bits altos), como JSON para json_each."""
+    if firma is None:
+        return None
+    ancho = len(firma) // LSH_BANDAS
+    return json.dumps([
+        (banda << 32) | zlib.crc32(firma[banda * ancho:(banda + 1) * ancho])
+        for banda in range(LSH_BANDAS)
+    ])
+
+
+def similitud_minhash(firma1, firma2):
+    """Estimacion de la similitud de Jaccard: fraccion de posiciones iguales entre dos firmas."""
+    if isinstance(firma1, bytes):
+        firma1 = struct.unpack(f"<{len(firma1) // 4}I", firma1)
+    if isinstance(firma2, bytes):
+        firma2 = struct.unpack(f"<{len(firma2) // 4}I", firma2)
+    return sum(map(operator.eq, firma1, firma2)) / len(firma1)
+
+
+def completar_hashes(conn):
+    """Calcula los hashes y huellas que faltan y los guarda a traves del escritor."""
+    cursor = conn.execute("""
+        SELECT l.id, t.contenido FROM letras l JOIN letras_texto t ON t.id = l.id
+        WHERE (l.contenido_hash IS NULL OR l.huella IS NULL) AND t.contenido IS NOT NULL
+    """)
+    escribir_lote(
+        "UPDATE letras SET contenido_hash = COALESCE(contenido_hash, ?), huella = COALESCE(huella, ?) WHERE id = ?",
+        [(generar_hash(row["contenido"]), generar_huella(row["contenido"]), row["id"]) for row in cursor.fetchall()],
+    )
+
+
+def buscar_duplicados_aproximados(umbral=0.90):
+    """Agrupa letras casi iguales usando el indice LSH en vez de comparar todas las parejas.
+
+    Solo se comparan las parejas que comparten cubetas; las que superan
+    `umbral` de similitud estimada se unen en grupos (union-find).
+    """
+    # Cada banda distinta tiene al menos una posicion diferente, asi que una
+    # pareja con `comunes` bandas iguales no pasa de (filas-1)*bandas + comunes
+    # posiciones iguales: por debajo de este minimo no puede llegar al umbral.
+    filas = MINHASH_BINS // LSH_BANDAS
+    minimo_bandas = max(1, math.ceil(umbral * MINHASH_BINS - (filas - 1) * LSH_BANDAS - 1e-9))
+
+    conn = get_db()
+    try:
+        parejas = conn.execute("""
+            SELECT a.letra_id AS id1, b.letra_id AS id2
+            FROM letras_lsh a
+            JOIN letras_lsh b ON b.cubeta = a.cubeta AND b.letra_id > a.letra_id
+            GROUP BY a.letra_id, b.letra_id
+            HAVING COUNT(*) >= ?
+        """, (minimo_bandas,)).fetchall()
+        ids = {i for pareja in parejas for i in pareja}
+        firmas = {
+            row["id"]: struct.unpack(f"<{MINHASH_BINS}I", row["firma"])
+            for row in conn.execute(
+                "SELECT id, firma FROM letras_minhash WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(sorted(ids)),),
+            )
+        }
+    finally:
+        liberar_db(conn)
+
+    padre = {}
+
+    def raiz(i):
+        padre.setdefault(i, i)
+        while padre[i] != i:
+            padre[i] = padre[padre[i]]
+            i = padre[i]
+        return i
+
+    aristas = []
+    for id1, id2 in parejas:
+        similitud = similitud_minhash(firmas[id1], firmas[id2])
+        if similitud < umbral:
+            continue
+        aristas.append((id1, similitud))
+        r1, r2 = raiz(id1), raiz(id2)
+        if r1 != r2:
+            padre[max(r1, r2)] = min(r1, r2)
+
+    grupos = {}
+    minima = {}
+    for i in list(padre):
+        grupos.setdefault(raiz(i), set()).add(i)
+    for id1, similitud in aristas:
+        r = raiz(id1)
+        minima[r] = min(similitud, minima.get(r, 1.0))
+    duplicados = [
+        {"tipo": "aproximado", "ids": sorted(ids), "similitud_min": round(minima[r], 3)}
+        for r, ids in sorted(grupos.items())
+    ]
+    return {
+        "duplicados_aproximados": duplicados,
+        "total_grupos": len(duplicados),
+        "umbral": umbral,
+    }
+
+
+def buscar_duplicados(umbral=0.90, modo="exacto"):
+    """Detecta letras duplicadas por huella exacta, o casi iguales con modo="aproximado"."""
+    if modo == "aproximado":
+        return buscar_duplicados_aproximados(umbral)
+
     conn = get_db()
     cursor = conn.cursor()
 
     # Actualizar hashes faltantes
-    cursor.execute("SELECT id, contenido FROM letras WHERE contenido_hash IS NULL AND contenido IS NOT NULL")
-    for row in cursor.fetchall():
-        h = generar_hash(row["contenido"])
-        cursor.execute("UPDATE letras SET contenido_hash = ? WHERE id = ?", (h, row["id"]))
-    conn.commit()
+    completar_hashes(conn)
 
-    # Duplicados exactos por hash
+    # Duplicados exactos por huella
     cursor.execute("""
-        SELECT contenido_hash, GROUP_CONCAT(id) as ids, COUNT(*) as cnt
+        SELECT MIN(contenido_hash) as contenido_hash, GROUP_CONCAT(id) as ids, COUNT(*) as cnt
         FROM letras
-        WHERE contenido_hash IS NOT NULL
-        GROUP BY contenido_hash
+        WHERE huella IS NOT NULL
+        GROUP BY huella
         HAVING cnt > 1
     """)
     duplicados_exactos = []
@@ -206,157 +1920,546 @@ def buscar_duplicados(umbral=0.90):
             "hash": row["contenido_hash"]
         })
 
-    conn.close()
+    liberar_db(conn)
     return {
         "duplicados_exactos": duplicados_exactos,
         "total_grupos": len(duplicados_exactos)
     }
 
 
-def eliminar_duplicados():
-    """Elimina duplicados conservando el registro mas antiguo."""
-    conn = get_db()
-    cursor = conn.cursor()
+def _resolver_grupos_duplicados(conn, desde, limite):
+    """Resuelve los siguientes `limite` grupos de huella repetida tras `desde` (None: desde el principio).
 
-    # Actualizar hashes
-    cursor.execute("SELECT id, contenido FROM letras WHERE contenido_hash IS NULL AND contenido IS NOT NULL")
-    for row in cursor.fetchall():
-        h = generar_hash(row["contenido"])
-        cursor.execute("UPDATE letras SET contenido_hash = ? WHERE id = ?", (h, row["id"]))
-    conn.commit()
+    Se ejecuta como tarea del escritor. En cada grupo la letra canonica es la
+    verificada, con mas calidad y mas metadatos (a igualdad, la mas antigua);
+    hereda los CAMPOS_FUSIONABLES que le falten, las demas quedan anotadas en
+    letras_procedencia y se borran. Devuelve (ultima_huella, grupos, fusionadas,
+    eliminadas); ultima_huella es None cuando no quedan grupos.
+    """
+    completitud = " + ".join(f"(NULLIF({c}, '') IS NOT NULL)" for c in CAMPOS_FUSIONABLES)
+    filtro, params = ("huella > ?", (desde, limite)) if desde is not None else ("huella IS NOT NULL", (limite,))
+    conn.execute("DROP TABLE IF EXISTS temp.dedup_rango")
+    conn.execute(f"""
+        CREATE TEMP TABLE dedup_rango AS
+        SELECT l.id, l.huella, ROW_NUMBER() OVER (
+            PARTITION BY l.huella
+            ORDER BY COALESCE(l.verificado, 0) DESC, COALESCE(l.calidad, -1) DESC, {completitud} DESC, l.id
+        ) AS rango
+        FROM letras l
+        JOIN (
+            SELECT huella FROM letras
+            WHERE {filtro}
+            GROUP BY huella HAVING COUNT(*) > 1
+            ORDER BY huella LIMIT ?
+        ) g ON g.huella = l.huella
+    """, params)
+    conn.execute("CREATE INDEX temp.idx_dedup_rango ON dedup_rango(huella, rango)")
 
-    # Eliminar duplicados exactos (mantener el de menor id)
-    cursor.execute("""
-        DELETE FROM letras WHERE id NOT IN (
-            SELECT MIN(id) FROM letras
-            WHERE contenido_hash IS NOT NULL
-            GROUP BY contenido_hash
-        ) AND contenido_hash IN (
-            SELECT contenido_hash FROM letras
-            WHERE contenido_hash IS NOT NULL
-            GROUP BY contenido_hash
-            HAVING COUNT(*) > 1
-        )
+    grupos, ultima = conn.execute("SELECT COUNT(*), MAX(huella) FROM dedup_rango WHERE rango = 1").fetchone()
+    if not grupos:
+        conn.execute("DROP TABLE temp.dedup_rango")
+        return None, 0, 0, 0
+
+    # Cada campo vacio de la canonica toma el primer valor no vacio por rango
+    asignaciones = ", ".join(f"""
+        {c} = COALESCE(NULLIF({c}, ''), (
+            SELECT d.{c} FROM dedup_rango r JOIN letras d ON d.id = r.id
+            WHERE r.huella = letras.huella AND r.rango > 1 AND NULLIF(d.{c}, '') IS NOT NULL
+            ORDER BY r.rango LIMIT 1))""" for c in CAMPOS_FUSIONABLES)
+    fusionadas = conn.execute(f"""
+        UPDATE letras SET {asignaciones}
+        WHERE id IN (SELECT id FROM dedup_rango WHERE rango = 1)
+          AND ({" OR ".join(f"NULLIF({c}, '') IS NULL" for c in CAMPOS_FUSIONABLES)})
+    """).rowcount
+
+    # Lo que ya apuntaba a una perdedora pasa a apuntar a su canonica
+    conn.execute("""
+        UPDATE letras_procedencia SET letra_id = c.id
+        FROM dedup_rango r JOIN dedup_rango c ON c.huella = r.huella AND c.rango = 1
+        WHERE r.rango > 1 AND letras_procedencia.letra_id = r.id
     """)
-    eliminados = cursor.rowcount
-    conn.commit()
-    conn.close()
-    return eliminados
+    conn.execute("""
+        INSERT INTO letras_procedencia (letra_id, origen_id, fuente, url, verificado)
+        SELECT c.id, l.id, l.fuente, l.url, l.verificado
+        FROM dedup_rango r
+        JOIN dedup_rango c ON c.huella = r.huella AND c.rango = 1
+        JOIN letras l ON l.id = r.id
+        WHERE r.rango > 1
+    """)
+    eliminadas = conn.execute(
+        "DELETE FROM letras WHERE id IN (SELECT id FROM dedup_rango WHERE rango > 1)"
+    ).rowcount
+    conn.execute("DROP TABLE temp.dedup_rango")
+    return ultima, grupos, fusionadas, eliminadas
 
 
-def obtener_estadisticas():
+def eliminar_duplicados(lote=LOTE_DEDUPLICACION):
+    """Fusiona cada grupo de duplicados exactos en su letra canonica.
+
+    Recorre los grupos por huella en transacciones de `lote` grupos, asi que
+    las lecturas no se bloquean durante toda la deduplicacion. Conviene
+    llamarla dentro de mantenimiento_fts() para reindexar solo lo borrado.
+    Devuelve conteos y rendimiento.
+    """
     conn = get_db()
-    cursor = conn.cursor()
+    try:
+        completar_hashes(conn)
+    finally:
+        liberar_db(conn)
 
-    stats = {}
+    inicio = time.perf_counter()
+    informe = {"grupos": 0, "fusionadas": 0, "eliminados": 0, "lotes": 0}
+    desde = None
+    while True:
+        desde, grupos, fusionadas, eliminadas = escribir(
+            lambda conn, desde=desde: _resolver_grupos_duplicados(conn, desde, lote))
+        if not grupos:
+            break
+        informe["lotes"] += 1
+        informe["grupos"] += grupos
+        informe["fusionadas"] += fusionadas
+        informe["eliminados"] += eliminadas
 
-    cursor.execute("SELECT COUNT(*) as total FROM letras")
-    stats["total_letras"] = cursor.fetchone()["total"]
+    segundos = time.perf_counter() - inicio
+    informe["segundos"] = round(segundos, 3)
+    informe["grupos_por_segundo"] = round(informe["grupos"] / segundos, 1) if segundos else 0.0
+    return informe
 
-    cursor.execute("SELECT COUNT(DISTINCT anio) as total FROM letras WHERE anio IS NOT NULL")
-    stats["total_anios"] = cursor.fetchone()["total"]
 
-    cursor.execute("SELECT COUNT(DISTINCT modalidad) as total FROM letras WHERE modalidad IS NOT NULL")
-    stats["total_modalidades"] = cursor.fetchone()["total"]
+def obtener_estadisticas():
+    return estadistica_materializada("estadisticas", calcular_estadisticas)
+
+
+def calcular_estadisticas(conn):
+    cursor = conn.cursor()
+
+    stats = {}
+
+    # Todo sale de las tablas de conteos (agg_*), no de letras
+    cursor.execute("""
+        SELECT COALESCE(SUM(cantidad), 0) as total,
+               COUNT(DISTINCT anio) as anios,
+               COUNT(DISTINCT modalidad) as modalidades,
+               COALESCE(SUM(verificadas), 0) as verificadas,
+               SUM(suma_calidad) * 1.0 / NULLIF(SUM(n_calidad), 0) as calidad_media
+        FROM agg_anio_modalidad
+    """)
+    row = cursor.fetchone()
+    stats["total_letras"] = row["total"]
+    stats["total_anios"] = row["anios"]
+    stats["total_modalidades"] = row["modalidades"]
 
-    cursor.execute("SELECT COUNT(DISTINCT agrupacion) as total FROM letras WHERE agrupacion IS NOT NULL")
+    cursor.execute("SELECT COUNT(DISTINCT agrupacion) as total FROM agg_agrupacion")
     stats["total_agrupaciones"] = cursor.fetchone()["total"]
 
     # Por anio
     cursor.execute("""
-        SELECT anio, COUNT(*) as cantidad
-        FROM letras WHERE anio IS NOT NULL
+        SELECT anio, SUM(cantidad) as cantidad
+        FROM agg_anio_modalidad WHERE anio IS NOT NULL
         GROUP BY anio ORDER BY anio
     """)
     stats["por_anio"] = [{"anio": r["anio"], "cantidad": r["cantidad"]} for r in cursor.fetchall()]
 
     # Por modalidad
     cursor.execute("""
-        SELECT modalidad, COUNT(*) as cantidad
-        FROM letras WHERE modalidad IS NOT NULL
+        SELECT modalidad, SUM(cantidad) as cantidad
+        FROM agg_anio_modalidad WHERE modalidad IS NOT NULL
         GROUP BY modalidad ORDER BY cantidad DESC
     """)
     stats["por_modalidad"] = [{"modalidad": r["modalidad"], "cantidad": r["cantidad"]} for r in cursor.fetchall()]
 
     # Por tipo de pieza
     cursor.execute("""
-        SELECT tipo_pieza, COUNT(*) as cantidad
-        FROM letras WHERE tipo_pieza IS NOT NULL
-        GROUP BY tipo_pieza ORDER BY cantidad DESC
+        SELECT tipo_pieza, cantidad
+        FROM agg_tipo_pieza WHERE tipo_pieza IS NOT NULL
+        ORDER BY cantidad DESC
     """)
     stats["por_tipo_pieza"] = [{"tipo": r["tipo_pieza"], "cantidad": r["cantidad"]} for r in cursor.fetchall()]
 
     # Top agrupaciones
     cursor.execute("""
-        SELECT agrupacion, COUNT(*) as cantidad
-        FROM letras WHERE agrupacion IS NOT NULL
+        SELECT agrupacion, SUM(cantidad) as cantidad
+        FROM agg_agrupacion
         GROUP BY agrupacion ORDER BY cantidad DESC LIMIT 20
     """)
     stats["top_agrupaciones"] = [{"agrupacion": r["agrupacion"], "cantidad": r["cantidad"]} for r in cursor.fetchall()]
 
     # Calidad
-    cursor.execute("SELECT COUNT(*) as total FROM letras WHERE verificado = 1")
-    stats["verificadas"] = cursor.fetchone()["total"]
-
-    cursor.execute("SELECT AVG(calidad) as media FROM letras WHERE calidad > 0")
-    row = cursor.fetchone()
-    stats["calidad_media"] = round(row["media"], 1) if row["media"] else 0
+    stats["verificadas"] = row["verificadas"]
+    stats["calidad_media"] = round(row["calidad_media"], 1) if row["calidad_media"] else 0
 
-    conn.close()
     return stats
 
 
-def busqueda_fulltext(query, limit=50, offset=0):
+def _indice_columna_fts(columna):
+    if columna is None:
+        return -1
+    if columna not in COLUMNAS_FTS:
+        raise ValueError(f"Columna de busqueda desconocida: {columna}")
+    return COLUMNAS_FTS.index(columna)
+
+
+class CacheRankings:
+    """LRU de rankings FTS5: consulta compilada -> (version, rowids por rank, facetas).
+
+    Una entrada solo vale para la version_datos con la que se calculo: cualquier
+    cambio en letras o un reindexado de letras_fts la deja obsoleta. Las
+    facetas son None si aun no se han pedido para esa consulta.
+    """
+
+    def __init__(self, tamano=BUSQUEDA_CACHE_TAMANO):
+        self.tamano = tamano
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, version):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None or entrada[0] != version:
+                return None
+            self._entradas.move_to_end(clave)
+            return entrada[1:]
+
+    def guardar(self, clave, version, ranking, facetas=None):
+        with self._lock:
+            self._entradas[clave] = (version, ranking, facetas)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.tamano:
+                self._entradas.popitem(last=False)
+
+
+rankings_busqueda = CacheRankings()
+
+
+_TOKEN_BUSQUEDA = re.compile(r'(-?)(?:([^\W\d]\w*):)?("[^"]*"?|\S+)')
+_ANIO_BUSQUEDA = re.compile(r"^(\d{4})?(\.\.)?(\d{4})?$")
+
+
+def _cadena_fts(texto, prefijo=False):
+    """Literal FTS5 entre comillas: el texto del usuario nunca es sintaxis."""
+    return '"' + texto.replace('"', '""') + '"' + ("*" if prefijo else "")
+
+
+def _condicion_anio(valor):
+    m = _ANIO_BUSQUEDA.match(valor)
+    if not m or not (m.group(1) or m.group(3)):
+        raise ValueError(f"anio:{valor} no es valido (usa AAAA, AAAA..AAAA, AAAA.. o ..AAAA)")
+    desde, rango, hasta = (int(g) if g and g.isdigit() else g for g in m.groups())
+    if not rango:
+        return "l.anio_num = ?", [desde]
+    if desde and hasta:
+        return "l.anio_num BETWEEN ? AND ?", [desde, hasta]
+    return ("l.anio_num >= ?", [desde]) if desde else ("l.anio_num <= ?", [hasta])
+
+
+def _condicion_valor(conn, tabla, valor):
+    """`l.fk IN (...)` con los codigos del diccionario `tabla` que coinciden sin tildes ni mayusculas."""
+    codigos = [row[0] for row in conn.execute(
+        f"SELECT id FROM {tabla} WHERE normalizar_nombre(nombre) = normalizar_nombre(?)", (valor,),
+    )]
+    if not codigos:
+        return "0", []
+    return f"l.{CATEGORIAS[tabla]['fk']} IN ({', '.join('?' * len(codigos))})", codigos
+
+
+def compilar_busqueda(conn, texto):
+    """Traduce la busqueda del usuario a (expresion MATCH o None, condiciones SQL, parametros).
+
+    Entiende palabras, "frases", prefijos (palabr*), exclusiones (-palabra),
+    OR entre terminos y filtros campo:valor (ver CAMPOS_BUSQUEDA), p.ej.
+    `anio:1990..1999 modalidad:comparsa tipo:pasodoble`. Todo texto del usuario
+    llega a FTS5 como literal entre comillas, asi que la expresion siempre es
+    valida. Las condiciones usan el alias `l` de letras. Lanza ValueError si
+    un filtro no tiene un valor valido.
+    """
+    grupos, excluidos, condiciones, params = [], [], [], []
+    unir_con_or = False
+
+    for m in _TOKEN_BUSQUEDA.finditer(texto):
+        negado, campo, valor = m.group(1) == "-", m.group(2), m.group(3)
+        if not negado and not campo and valor == "OR":
+            unir_con_or = bool(grupos)
+            continue
+
+        campo_real = CAMPOS_BUSQUEDA.get(campo.lower()) if campo else None
+        if campo and not campo_real:
+            # Campo desconocido: se busca tal cual como texto
+            valor, campo_real = m.group(0).lstrip("-"), None
+        frase = valor.startswith('"')
+        prefijo = not frase and len(valor) > 1 and valor.endswith("*")
+        valor = valor.strip('"') if frase else valor.rstrip("*") if prefijo else valor
+
+        if campo_real in ("anio", "modalidad", "tipo_pieza", "autor"):
+            if campo_real == "anio":
+                condicion, valores = _condicion_anio(valor)
+            elif campo_real == "autor":
+                entidad = resolver_entidad(conn, "autores", valor)
+                condicion, valores = (
+                    ("l.id IN (SELECT letra_id FROM letra_autor WHERE autor_id = ?)", [entidad[0]])
+                    if entidad else ("0", [])
+                )
+            else:
+                tabla = "modalidades" if campo_real == "modalidad" else "tipos_pieza"
+                condicion, valores = _condicion_valor(conn, tabla, valor)
+            condiciones.append(f"({condicion}) IS NOT 1" if negado else condicion)
+            params.extend(valores)
+            continue
+
+        expresion = _cadena_fts(valor, prefijo)
+        if campo_real:
+            expresion = f"{campo_real} : {expresion}"
+        if negado:
+            excluidos.append(expresion)
+        elif unir_con_or:
+            grupos[-1].append(expresion)
+        else:
+            grupos.append([expresion])
+        unir_con_or = False
+
+    positiva = " AND ".join(g[0] if len(g) == 1 else f"({' OR '.join(g)})" for g in grupos)
+    exclusion = " OR ".join(excluidos)
+    if positiva and exclusion:
+        return f"({positiva}) NOT ({exclusion})", condiciones, params
+    if exclusion:
+        # FTS5 no admite un NOT sin lado positivo: se excluye en SQL
+        condiciones.append("l.id NOT IN (SELECT rowid FROM letras_fts WHERE letras_fts MATCH ?)")
+        params.append(exclusion)
+    return positiva or None, condiciones, params
+
+
+def _contar_facetas(filas):
+    """Facetas de (id, modalidad, anio_num, tipo_pieza, agrupacion) en una pasada."""
+    modalidades, decadas, tipos, agrupaciones = Counter(), Counter(), Counter(), Counter()
+    for _, modalidad, anio_num, tipo_pieza, agrupacion in filas:
+        if modalidad:
+            modalidades[modalidad] += 1
+        if anio_num is not None:
+            decadas[anio_num // 10 * 10] += 1
+        if tipo_pieza:
+            tipos[tipo_pieza] += 1
+        if agrupacion:
+            agrupaciones[agrupacion] += 1
+
+    def lista(contador, n=None):
+        return [{"valor": v, "total": t} for v, t in contador.most_common(n)]
+
+    return {
+        "modalidad": lista(modalidades),
+        "decada": [{"valor": d, "total": t} for d, t in sorted(decadas.items())],
+        "tipo_pieza": lista(tipos),
+        "agrupacion": lista(agrupaciones, FACETAS_TOP_AGRUPACIONES),
+    }
+
+
+def busqueda_fulltext(query, limit=50, offset=0, columna="contenido", tokens=FRAGMENTO_TOKENS,
+                      facetas=False):
+    """Devuelve (resultados de la pagina, total de aciertos, facetas) de una busqueda FTS5.
+
+    `query` se compila con compilar_busqueda(): la MATCH y los filtros de
+    metadatos van en una sola sentencia. El ranking completo se calcula una
+    vez por consulta compilada y version de datos y se guarda en
+    rankings_busqueda: las paginas siguientes solo cortan esa lista. Cada
+    resultado lleva un fragmento de `tokens` palabras (ninguno si la busqueda
+    es solo de filtros), asi que su tamano no depende de lo larga que sea la
+    letra; el texto completo resaltado se pide con resaltar_letra().
+    Con `facetas` se cuentan tambien, sobre todos los aciertos y en la misma
+    sentencia del ranking, modalidad, decada, tipo_pieza y las agrupaciones
+    mas frecuentes; se cachean con el ranking. Si no, facetas es None.
+    Una busqueda sin terminos ni filtros (solo operadores) no devuelve nada.
+    Lanza ValueError si la busqueda tiene un filtro invalido.
+    """
+    indice = _indice_columna_fts(columna)
+    tokens = max(1, min(int(tokens), FRAGMENTO_MAX_TOKENS))
+    offset = max(0, offset)
     conn = get_db()
-    cursor = conn.cursor()
 
     try:
-        cursor.execute("""
-            SELECT l.id, l.titulo, l.anio, l.modalidad, l.tipo_pieza, l.agrupacion,
-                   highlight(letras_fts, 1, '<mark>', '</mark>') as fragmento,
-                   rank
-            FROM letras_fts
-            JOIN letras l ON l.id = letras_fts.rowid
-            WHERE letras_fts MATCH ?
-            ORDER BY rank
-            LIMIT ? OFFSET ?
-        """, (query, limit, offset))
-        resultados = [dict(r) for r in cursor.fetchall()]
-    except sqlite3.OperationalError:
-        resultados = []
+        conn.execute("BEGIN")
+        version = conn.execute("SELECT valor FROM version_datos WHERE clave = 'letras'").fetchone()[0]
+        expresion, condiciones, params = compilar_busqueda(conn, query)
+        if not expresion and not condiciones:
+            # Solo operadores ("OR OR", "-"): sin terminos no hay aciertos
+            return [], 0, _contar_facetas([]) if facetas else None
+        clave = (expresion, tuple(condiciones), tuple(params))
+        ranking, conteos = rankings_busqueda.obtener(clave, version) or (None, None)
+        if ranking is None or (facetas and conteos is None):
+            columnas = "l.id, l.modalidad, l.anio_num, l.tipo_pieza, l.agrupacion" if facetas else "l.id"
+            if expresion:
+                sql = f"""
+                    SELECT {columnas} FROM letras_fts
+                    JOIN letras l ON l.id = letras_fts.rowid
+                    WHERE {" AND ".join(["letras_fts MATCH ?"] + condiciones)}
+                    ORDER BY letras_fts.rank
+                """
+                params = [expresion] + params
+            else:
+                sql = f"SELECT {columnas} FROM letras l WHERE {' AND '.join(condiciones) or '1'} ORDER BY l.id DESC"
+            filas = conn.execute(sql, params).fetchall()
+            ranking = array("q", (row[0] for row in filas))
+            if facetas:
+                conteos = _contar_facetas(filas)
+            rankings_busqueda.guardar(clave, version, ranking, conteos)
 
-    conn.close()
-    return resultados
+        pagina = list(ranking[offset:offset + max(0, limit)])
+        filas = {}
+        if pagina:
+            marcas = ", ".join("?" * len(pagina))
+            if expresion:
+                cursor = conn.execute(f"""
+                    SELECT l.id, l.titulo, l.anio, l.modalidad, l.tipo_pieza, l.agrupacion,
+                           snippet(letras_fts, ?, '<mark>', '</mark>', '…', ?) as fragmento,
+                           rank
+                    FROM letras_fts
+                    JOIN letras l ON l.id = letras_fts.rowid
+                    WHERE letras_fts MATCH ? AND letras_fts.rowid IN ({marcas})
+                """, (indice, tokens, expresion, *pagina))
+            else:
+                cursor = conn.execute(f"""
+                    SELECT l.id, l.titulo, l.anio, l.modalidad, l.tipo_pieza, l.agrupacion,
+                           NULL as fragmento, NULL as rank
+                    FROM letras l
+                    WHERE l.id IN ({marcas})
+                """, pagina)
+            filas = {row["id"]: dict(row) for row in cursor}
+    finally:
+        liberar_db(conn)
 
+    return [filas[i] for i in pagina if i in filas], len(ranking), conteos if facetas else None
 
-def reconstruir_fts():
-    """Reconstruye el indice FTS5 completo."""
+
+def resaltar_letra(letra_id, query, columna="contenido"):
+    """Texto completo de `columna` con los aciertos de `query` marcados, o None."""
+    indice = _indice_columna_fts(columna or "contenido")
     conn = get_db()
+    try:
+        expresion = compilar_busqueda(conn, query)[0]
+        row = expresion and conn.execute("""
+            SELECT highlight(letras_fts, ?, '<mark>', '</mark>') as resaltado
+            FROM letras_fts
+            WHERE letras_fts MATCH ? AND rowid = ?
+        """, (indice, expresion, letra_id)).fetchone()
+    finally:
+        liberar_db(conn)
+    return row["resaltado"] if row else None
+
+
+def _reconstruir_fts(conn):
     cursor = conn.cursor()
+    cursor.execute("SAVEPOINT fts")
     try:
-        cursor.execute("DELETE FROM letras_fts")
+        cursor.execute("INSERT INTO letras_fts(letras_fts) VALUES ('rebuild')")
+        cursor.execute("RELEASE fts")
+    except (sqlite3.OperationalError, sqlite3.DatabaseError):
+        # Si esta corrupta, recrear desde cero
+        cursor.execute("ROLLBACK TO fts")
+        cursor.execute("RELEASE fts")
+        cursor.execute("DROP TABLE IF EXISTS letras_fts")
+        cursor.execute("""
+            CREATE VIRTUAL TABLE letras_fts USING fts5(
+                titulo, contenido, agrupacion,
+                content='letras_completas', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
         cursor.execute("""
             INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
-            SELECT id, titulo, contenido, agrupacion FROM letras
+            SELECT id, titulo, contenido, agrupacion FROM letras_completas
         """)
-        conn.commit()
+
+    cursor.execute("INSERT INTO letras_trigrama(letras_trigrama) VALUES ('delete-all')")
+    _cargar_trigrama(cursor)
+
+    # Con los indices completos no queda nada pendiente. Sirve tambien para
+    # recuperar una pausa colgada (proceso muerto dentro de mantenimiento_fts)
+    cursor.execute("DELETE FROM fts_pendientes")
+    cursor.execute("DELETE FROM fts_pausa")
+    # Los rankings de busqueda cacheados dependen del indice
+    cursor.execute("UPDATE version_datos SET valor = valor + 1 WHERE clave = 'letras'")
+
+
+def _reindexar_pendientes(cursor):
+    """Reindexa en letras_fts y letras_trigrama solo las filas de fts_pendientes."""
+    columnas = ", ".join(COLUMNAS_TRIGRAMA)
+    cursor.execute("""
+        INSERT INTO letras_fts(letras_fts, rowid, titulo, contenido, agrupacion)
+        SELECT 'delete', id, titulo, contenido, agrupacion FROM fts_pendientes WHERE indexada
+    """)
+    cursor.execute(f"""
+        INSERT INTO letras_trigrama(letras_trigrama, rowid, {columnas})
+        SELECT 'delete', id, {_sql_valores_trigrama("fts_pendientes")} FROM fts_pendientes WHERE indexada
+    """)
+    cursor.execute("""
+        INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
+        SELECT id, titulo, contenido, agrupacion FROM letras_completas
+        WHERE id IN (SELECT id FROM fts_pendientes)
+    """)
+    cursor.execute(f"""
+        INSERT INTO letras_trigrama(rowid, {columnas})
+        SELECT id, {_sql_valores_trigrama("letras")} FROM letras
+        WHERE id IN (SELECT id FROM fts_pendientes)
+    """)
+    cursor.execute("DELETE FROM fts_pendientes")
+
+
+def _cerrar_mantenimiento_fts(conn, pausa, modo, automerge, crisismerge):
+    inicio = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM fts_pausa WHERE id = ?", (pausa,))
+    filas = cursor.execute("SELECT COUNT(*) FROM fts_pendientes").fetchone()[0]
+    if modo == "auto":
+        total = cursor.execute("SELECT COUNT(*) FROM letras").fetchone()[0]
+        modo = "completo" if filas > total * FTS_UMBRAL_RECONSTRUCCION else "parcial"
+
+    if modo == "completo":
+        cursor.execute("INSERT INTO letras_fts(letras_fts) VALUES ('rebuild')")
+        cursor.execute("INSERT INTO letras_trigrama(letras_trigrama) VALUES ('delete-all')")
+        _cargar_trigrama(cursor)
+        cursor.execute("DELETE FROM fts_pendientes")
+    else:
+        _reindexar_pendientes(cursor)
+
+    for tabla in ("letras_fts", "letras_trigrama"):
+        cursor.execute(f"INSERT INTO {tabla}({tabla}, rank) VALUES ('automerge', ?)", (automerge,))
+        cursor.execute(f"INSERT INTO {tabla}({tabla}, rank) VALUES ('crisismerge', ?)", (crisismerge,))
+        cursor.execute(f"INSERT INTO {tabla}({tabla}) VALUES ('optimize')")
+    # Durante la pausa se pudieron cachear rankings del indice sin actualizar
+    cursor.execute("UPDATE version_datos SET valor = valor + 1 WHERE clave = 'letras'")
+
+    return {
+        "modo": modo,
+        "filas": filas,
+        "indice_ms": round((time.perf_counter() - inicio) * 1000, 2),
+    }
+
+
+@contextmanager
+def mantenimiento_fts(modo="auto", automerge=FTS_AUTOMERGE, crisismerge=FTS_CRISISMERGE):
+    """Pausa la sincronizacion de los indices FTS durante una mutacion masiva.
+
+    Dentro del bloque los triggers solo apuntan las filas tocadas. Al salir se
+    reindexan esas filas ("parcial") o los indices enteros ("completo"); "auto"
+    elige segun FTS_UMBRAL_RECONSTRUCCION. Despues se fijan automerge y
+    crisismerge y se optimiza. El dict que devuelve se rellena al salir con
+    el modo aplicado, las filas tocadas y los ms de mantenimiento del indice.
+
+        with mantenimiento_fts() as informe:
+            escribir_lote(...)
+    """
+    if modo not in ("auto", "parcial", "completo"):
+        raise ValueError(f"Modo de mantenimiento desconocido: {modo}")
+    informe = {}
+    pausa = escribir(lambda conn: conn.execute("INSERT INTO fts_pausa DEFAULT VALUES").lastrowid)
+    try:
+        yield informe
+    finally:
+        informe.update(escribir(
+            lambda conn: _cerrar_mantenimiento_fts(conn, pausa, modo, automerge, crisismerge)
+        ))
+
+
+def reconstruir_fts():
+    """Reconstruye los indices FTS5 completos (letras_fts y letras_trigrama)."""
+    try:
+        escribir(_reconstruir_fts)
     except (sqlite3.OperationalError, sqlite3.DatabaseError):
-        # Si esta corrupta, recrear desde cero
-        conn.rollback()
-        try:
-            cursor.execute("DROP TABLE IF EXISTS letras_fts")
-            cursor.execute("""
-                CREATE VIRTUAL TABLE letras_fts USING fts5(
-                    titulo, contenido, agrupacion,
-                    content='letras', content_rowid='id',
-                    tokenize='unicode61 remove_diacritics 2'
-                )
-            """)
-            cursor.execute("""
-                INSERT INTO letras_fts(rowid, titulo, contenido, agrupacion)
-                SELECT id, titulo, contenido, agrupacion FROM letras
-            """)
-            conn.commit()
-        except (sqlite3.OperationalError, sqlite3.DatabaseError):
-            pass
-    conn.close()
+        pass
@@ -0,0 +1,255 @@
+"""
+Mantenimiento periodico de la base de datos: estadisticas del planificador,
+checkpoints del WAL y recuperacion de paginas libres.
+
+Cada ciclo (MANTENIMIENTO_INTERVALO_S) hace solo lo que hace falta:
+  - ANALYZE la primera vez y PRAGMA optimize cuando letras acumula
+    CAMBIOS_OPTIMIZE cambios desde el ultimo analisis
+  - incremental_vacuum por pasos si hay paginas libres (auto_vacuum=INCREMENTAL)
+  - checkpoint PASSIVE si el -wal pasa de WAL_UMBRAL_PASIVO y TRUNCATE si pasa
+    de WAL_UMBRAL_TRUNCAR
+
+Usa su propia conexion en autocommit y no el hilo escritor: ni los checkpoints
+ni incremental_vacuum pueden ir dentro de las transacciones del escritor, y
+ANALYZE tendria parado al escritor mientras recorre los indices. Todo se hace
+en sentencias cortas y con busy_timeout, asi que el escritor solo espera, como
+mucho, un paso. Lo que escribe en tablas de la aplicacion (version_datos) pasa
+por el escritor.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+from database import DB_NAME, abrir_conexion, escribir
+
+MANTENIMIENTO_INTERVALO_S = 300
+
+# Cambios en letras (version_datos) que justifican recalcular estadisticas;
+# analysis_limit acota las filas que ANALYZE mira por indice
+CAMBIOS_OPTIMIZE = 1000
+ANALISIS_LIMITE = 1000
+
+# Tamano del -wal a partir del cual se fuerza checkpoint
+WAL_UMBRAL_PASIVO = 16 * 1024 * 1024
+WAL_UMBRAL_TRUNCAR = 64 * 1024 * 1024
+CHECKPOINT_ESPERA_MS = 1000
+
+# Paginas libres minimas para lanzar incremental_vacuum y paginas por paso
+VACUUM_MIN_PAGINAS = 256
+VACUUM_PAGINAS_POR_PASO = 1024
+
+MODOS_AUTO_VACUUM = {0: "none", 1: "full", 2: "incremental"}
+
+
+# =============================================
+# Estado global del mantenimiento
+# =============================================
+class EstadoMantenimiento:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ejecutando = threading.Lock()  # un solo ciclo a la vez por proceso
+        self.ciclos = 0
+        self.ultimo_ciclo = None
+        self.ultimas = {}  # tarea -> {"fecha", "ms", ...} de su ultima ejecucion
+
+    def anotar(self, tarea, inicio, **detalle):
+        with self.lock:
+            self.ultimas[tarea] = {
+                "fecha": datetime.now().isoformat(timespec="seconds"),
+                "ms": round((time.perf_counter() - inicio) * 1000, 2),
+                **detalle,
+            }
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "ciclos": self.ciclos,
+                "ultimo_ciclo": self.ultimo_ciclo,
+                "ultimas": {tarea: dict(info) for tarea, info in self.ultimas.items()},
+            }
+
+
+estado_mantenimiento = EstadoMantenimiento()
+
+
+def _tamano_wal():
+    try:
+        return os.path.getsize(DB_NAME + "-wal")
+    except OSError:
+        return 0
+
+
+def estado_bd(conn=None):
+    """Tamano del WAL, paginas libres y modo de auto_vacuum de la base de datos."""
+    propia = conn is None
+    if propia:
+        conn = abrir_conexion(solo_lectura=True)
+    try:
+        paginas = conn.execute("PRAGMA page_count").fetchone()[0]
+        libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        tam_pagina = conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "wal_bytes": _tamano_wal(),
+            "bd_bytes": paginas * tam_pagina,
+            "paginas": paginas,
+            "paginas_libres": libres,
+            "auto_vacuum": MODOS_AUTO_VACUUM.get(conn.execute("PRAGMA auto_vacuum").fetchone()[0]),
+            "estadisticas_planificador": conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is not None,
+        }
+    finally:
+        if propia:
+            conn.close()
+
+
+def _optimizar(conn, forzar):
+    """ANALYZE si no hay sqlite_stat1; PRAGMA optimize si hubo bastantes cambios desde el ultimo."""
+    version = conn.execute("SELECT valor FROM version_datos WHERE clave = 'letras'").fetchone()[0]
+    fila = conn.execute("SELECT valor FROM version_datos WHERE clave = 'analisis'").fetchone()
+    sin_estadisticas = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None
+    cambios = version - fila[0] if fila else version
+    if not (sin_estadisticas or forzar or cambios >= CAMBIOS_OPTIMIZE):
+        return
+
+    inicio = time.perf_counter()
+    conn.execute(f"PRAGMA analysis_limit={ANALISIS_LIMITE}")
+    if sin_estadisticas:
+        conn.execute("ANALYZE")
+    else:
+        # 0x10002: revisar todas las tablas, no solo las usadas por esta conexion
+        conn.execute("PRAGMA optimize=0x10002")
+    # La version del analisis se guarda en la BD: la comparten todos los workers
+    escribir(lambda c: c.execute(
+        "INSERT INTO version_datos (clave, valor) VALUES ('analisis', ?) "
+        "ON CONFLICT(clave) DO UPDATE SET valor = excluded.valor", (version,)))
+    estado_mantenimiento.anotar(
+        "analyze" if sin_estadisticas else "optimize", inicio, cambios=cambios)
+
+
+def _vacuum_incremental(conn, forzar):
+    """Devuelve al sistema las paginas libres en pasos de VACUUM_PAGINAS_POR_PASO."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return
+    libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if not libres or (libres < VACUUM_MIN_PAGINAS and not forzar):
+        return
+
+    inicio = time.perf_counter()
+    liberadas = 0
+    while libres:
+        # executescript ejecuta el PRAGMA hasta el final (execute solo libera una pagina)
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGINAS_POR_PASO})")
+        restantes = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if restantes >= libres:
+            break
+        liberadas += libres - restantes
+        libres = restantes
+    estado_mantenimiento.anotar("incremental_vacuum", inicio, paginas_liberadas=liberadas)
+
+
+def _checkpoint(conn, forzar):
+    """PASSIVE o TRUNCATE segun el tamano del -wal."""
+    wal = _tamano_wal()
+    if wal >= WAL_UMBRAL_TRUNCAR or (forzar and wal):
+        modo = "TRUNCATE"
+    elif wal >= WAL_UMBRAL_PASIVO:
+        modo = "PASSIVE"
+    else:
+        return
+
+    inicio = time.perf_counter()
+    # TRUNCATE espera a los lectores con el cerrojo de escritura tomado:
+    # se acota la espera para no frenar al escritor
+    conn.execute(f"PRAGMA busy_timeout={CHECKPOINT_ESPERA_MS}")
+    ocupado, paginas_wal, copiadas = conn.execute(f"PRAGMA wal_checkpoint({modo})").fetchone()
+    estado_mantenimiento.anotar(
+        "checkpoint", inicio, modo=modo.lower(), wal_bytes_antes=wal, wal_bytes=_tamano_wal(),
+        paginas_wal=paginas_wal, copiadas=copiadas, completo=not ocupado)
+
+
+def ejecutar_mantenimiento(forzar=False):
+    """Un ciclo de mantenimiento. Con forzar=True hace cada tarea aunque no toque.
+
+    Devuelve el estado de la BD tras el ciclo, o None si ya habia uno en curso.
+    """
+    if not estado_mantenimiento.ejecutando.acquire(blocking=False):
+        return None
+    try:
+        inicio = time.perf_counter()
+        conn = abrir_conexion()
+        conn.isolation_level = None
+        try:
+            _optimizar(conn, forzar)
+            _vacuum_incremental(conn, forzar)
+            _checkpoint(conn, forzar)
+            estado = estado_bd(conn)
+        finally:
+            conn.close()
+        with estado_mantenimiento.lock:
+            estado_mantenimiento.ciclos += 1
+            estado_mantenimiento.ultimo_ciclo = {
+                "fecha": datetime.now().isoformat(timespec="seconds"),
+                "ms": round((time.perf_counter() - inicio) * 1000, 2),
+            }
+        return estado
+    finally:
+        estado_mantenimiento.ejecutando.release()
+
+
+def convertir_auto_vacuum():
+    """Pasa una BD existente a auto_vacuum=INCREMENTAL con un VACUUM completo.
+
+    Reescribe todo el fichero y bloquea las escrituras mientras dura: es una
+    operacion puntual para lanzar a mano en un momento tranquilo.
+    """
+    with estado_mantenimiento.ejecutando:
+        inicio = time.perf_counter()
+        conn = abrir_conexion()
+        conn.isolation_level = None
+        try:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            estado = estado_bd(conn)
+        finally:
+            conn.close()
+        estado_mantenimiento.anotar("vacuum", inicio, bd_bytes=estado["bd_bytes"])
+        return estado
+
+
+def obtener_estado():
+    """Estado de la BD y tiempos de las ultimas tareas de mantenimiento."""
+    return {"bd": estado_bd(), **estado_mantenimiento.to_dict()}
+
+
+# =============================================
+# Ejecucion periodica en hilo de fondo
+# =============================================
+
+def _bucle_mantenimiento(intervalo):
+    while True:
+        time.sleep(intervalo)
+        try:
+            ejecutar_mantenimiento()
+        except Exception as e:
+            with estado_mantenimiento.lock:
+                estado_mantenimiento.ultimo_ciclo = {
+                    "fecha": datetime.now().isoformat(timespec="seconds"),
+                    "error": str(e),
+                }
+
+
+_programador = None
+
+
+def iniciar_mantenimiento_programado(intervalo=MANTENIMIENTO_INTERVALO_S):
+    """Arranca (una sola vez por proceso) el ciclo periodico. intervalo<=0 lo desactiva."""
+    global _programador
+    if intervalo <= 0 or _programador is not None:
+        return False
+    _programador = threading.Thread(
+        target=_bucle_mantenimiento, args=(intervalo,), name="mantenimiento-db", daemon=True)
+    _programador.start()
+    return True
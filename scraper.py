@@ -1,10 +1,9 @@
 import requests
 from bs4 import BeautifulSoup
-import sqlite3
 import re
 import time
 from metadata_extractor import normalizar_letra
-from database import DB_NAME, generar_hash
+from database import get_db, liberar_db, importar_letras, generar_hash, LOTE_IMPORTACION
 
 BASE_URL = "https://letrasdesdeelparaiso.blogspot.com/"
 
@@ -13,98 +12,109 @@ HEADERS = {
 }
 
 
-def ejecutar_scraper(max_paginas=None):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+def _url_existe(url):
+    """Comprueba la URL con una conexion del pool tomada solo para la consulta."""
+    conn = get_db()
+    try:
+        return conn.execute("SELECT 1 FROM letras WHERE url=?", (url,)).fetchone() is not None
+    finally:
+        liberar_db(conn)
+
 
+def ejecutar_scraper(max_paginas=None):
     pagina = BASE_URL
     nuevas = 0
     duplicadas = 0
     errores = 0
     paginas_procesadas = 0
+    lote = []
 
-    while pagina:
-        if max_paginas and paginas_procesadas >= max_paginas:
-            break
-
-        try:
-            response = requests.get(pagina, headers=HEADERS, timeout=15)
-            response.raise_for_status()
-        except requests.RequestException:
-            errores += 1
-            break
-
-        soup = BeautifulSoup(response.text, "html.parser")
-        enlaces = soup.select("h3.post-title a")
+    def volcar_lote():
+        nonlocal nuevas, duplicadas
+        resultado = importar_letras(lote)
+        nuevas += resultado["nuevas"]
+        duplicadas += resultado["duplicadas"]
+        lote.clear()
 
-        for enlace_tag in enlaces:
-            enlace = enlace_tag.get("href", "")
-            titulo = enlace_tag.text.strip()
-
-            if not enlace or not titulo:
-                continue
-
-            # Duplicado por URL
-            cursor.execute("SELECT id FROM letras WHERE url=?", (enlace,))
-            if cursor.fetchone():
-                duplicadas += 1
-                continue
+    # El lote pendiente se vuelca aunque el bucle termine por una excepcion
+    try:
+        while pagina:
+            if max_paginas and paginas_procesadas >= max_paginas:
+                break
 
             try:
-                time.sleep(0.3)
-                post = requests.get(enlace, headers=HEADERS, timeout=15)
-                post.raise_for_status()
-                post_soup = BeautifulSoup(post.text, "html.parser")
-                contenido_tag = post_soup.select_one(".post-body")
+                response = requests.get(pagina, headers=HEADERS, timeout=15)
+                response.raise_for_status()
+            except requests.RequestException:
+                errores += 1
+                break
 
-                if not contenido_tag:
-                    continue
+            soup = BeautifulSoup(response.text, "html.parser")
+            enlaces = soup.select("h3.post-title a")
 
-                texto_raw = contenido_tag.get_text("\n")
-                texto = normalizar_letra(texto_raw)
+            for enlace_tag in enlaces:
+                enlace = enlace_tag.get("href", "")
+                titulo = enlace_tag.text.strip()
 
-                if not texto or len(texto) < 50:
+                if not enlace or not titulo:
                     continue
 
-                # Duplicado por contenido
-                texto_hash = generar_hash(texto)
-                cursor.execute("SELECT id FROM letras WHERE contenido_hash=?", (texto_hash,))
-                if cursor.fetchone():
+                # Duplicado por URL
+                if _url_existe(enlace):
                     duplicadas += 1
                     continue
 
-                # Extraer fecha de publicacion
-                fecha_pub = None
-                fecha_tag = post_soup.select_one(".date-header span, .published, time")
-                if fecha_tag:
-                    fecha_pub = fecha_tag.text.strip()
-
-                cursor.execute("""
-                    INSERT INTO letras
-                    (titulo, anio, modalidad, tipo_pieza, agrupacion, autor, contenido, contenido_hash, url, fuente, fecha_publicacion)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (titulo, None, None, None, None, None, texto, texto_hash, enlace, "letrasdesdeelparaiso", fecha_pub))
-
-                conn.commit()
-                nuevas += 1
-
-            except requests.RequestException:
-                errores += 1
-            except Exception:
-                errores += 1
-
-        paginas_procesadas += 1
-
-        siguiente = soup.select_one("a.blog-pager-older-link")
-        if siguiente:
-            pagina = siguiente.get("href")
-        else:
-            pagina = None
-
-        time.sleep(0.5)
-
-    conn.close()
+                try:
+                    time.sleep(0.3)
+                    post = requests.get(enlace, headers=HEADERS, timeout=15)
+                    post.raise_for_status()
+                    post_soup = BeautifulSoup(post.text, "html.parser")
+                    contenido_tag = post_soup.select_one(".post-body")
+
+                    if not contenido_tag:
+                        continue
+
+                    texto_raw = contenido_tag.get_text("\n")
+                    texto = normalizar_letra(texto_raw)
+
+                    if not texto or len(texto) < 50:
+                        continue
+
+                    # Extraer fecha de publicacion
+                    fecha_pub = None
+                    fecha_tag = post_soup.select_one(".date-header span, .published, time")
+                    if fecha_tag:
+                        fecha_pub = fecha_tag.text.strip()
+
+                    # importar_letras descarta duplicados por contenido o URL
+                    lote.append({
+                        "titulo": titulo,
+                        "contenido": texto,
+                        "contenido_hash": generar_hash(texto),
+                        "url": enlace,
+                        "fuente": "letrasdesdeelparaiso",
+                        "fecha_publicacion": fecha_pub,
+                    })
+                    if len(lote) >= LOTE_IMPORTACION:
+                        volcar_lote()
+
+                except requests.RequestException:
+                    errores += 1
+                except Exception:
+                    errores += 1
+
+            paginas_procesadas += 1
+
+            siguiente = soup.select_one("a.blog-pager-older-link")
+            if siguiente:
+                pagina = siguiente.get("href")
+            else:
+                pagina = None
+
+            time.sleep(0.5)
+
+    finally:
+        volcar_lote()
 
     return {
         "nuevas": nuevas,
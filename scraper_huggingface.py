@@ -6,7 +6,7 @@ Descarga directamente los JSON del dataset (sin necesidad de scraping web).
 
 import requests
 import sqlite3
-from database import DB_NAME, generar_hash
+from database import importar_letras, generar_hash
 from metadata_extractor import normalizar_letra
 
 # URLs directas del dataset en HuggingFace
@@ -63,10 +63,6 @@ def ejecutar_importador_huggingface(solo_accurate=False, callback=None):
 
     conjuntos = ["accurate"] if solo_accurate else ["accurate", "midaccurate"]
 
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
     nuevas = 0
     duplicadas = 0
     errores = 0
@@ -91,6 +87,7 @@ def ejecutar_importador_huggingface(solo_accurate=False, callback=None):
 
         log(f"Descargados {len(datos)} registros del conjunto '{conjunto}'")
         total_descargados += len(datos)
+        registros = []
 
         for i, item in enumerate(datos):
             if (i + 1) % 100 == 0:
@@ -124,12 +121,6 @@ def ejecutar_importador_huggingface(solo_accurate=False, callback=None):
                 # Generar hash para deduplicación
                 contenido_hash = generar_hash(contenido)
 
-                # Verificar duplicado por hash
-                cursor.execute("SELECT id FROM letras WHERE contenido_hash=?", (contenido_hash,))
-                if cursor.fetchone():
-                    duplicadas += 1
-                    continue
-
                 # Construir título
                 titulo = f"{tipo_pieza} - {group}"
                 if year:
@@ -139,38 +130,32 @@ def ejecutar_importador_huggingface(solo_accurate=False, callback=None):
                 dataset_id = item.get("id", f"hf_{conjunto}_{i}")
                 url_unica = f"huggingface://letras-carnaval-cadiz/{conjunto}/{dataset_id}"
 
-                # Verificar duplicado por URL
-                cursor.execute("SELECT id FROM letras WHERE url=?", (url_unica,))
-                if cursor.fetchone():
-                    duplicadas += 1
-                    continue
+                # Todo el conjunto se importa de una vez; los duplicados por
+                # hash o por URL se descartan al fusionar
+                registros.append({
+                    "titulo": titulo,
+                    "anio": year if year else None,
+                    "modalidad": modalidad,
+                    "tipo_pieza": tipo_pieza,
+                    "agrupacion": group,
+                    "autor": autor,
+                    "contenido": contenido,
+                    "contenido_hash": contenido_hash,
+                    "url": url_unica,
+                    "fuente": "huggingface",
+                    "verificado": 1 if conjunto == "accurate" else 0,
+                })
 
-                cursor.execute("""
-                    INSERT INTO letras
-                    (titulo, anio, modalidad, tipo_pieza, agrupacion, autor, contenido, contenido_hash, url, fuente, fecha_scraping, verificado)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), ?)
-                """, (
-                    titulo,
-                    year if year else None,
-                    modalidad,
-                    tipo_pieza,
-                    group,
-                    autor,
-                    contenido,
-                    contenido_hash,
-                    url_unica,
-                    "huggingface",
-                    1 if conjunto == "accurate" else 0,
-                ))
-                conn.commit()
-                nuevas += 1
-
-            except sqlite3.IntegrityError:
-                duplicadas += 1
             except Exception:
                 errores += 1
 
-    conn.close()
+        try:
+            resultado = importar_letras(registros)
+            nuevas += resultado["nuevas"]
+            duplicadas += resultado["duplicadas"]
+        except sqlite3.Error as e:
+            log(f"Error guardando {conjunto}: {str(e)}")
+            errores += len(registros)
 
     log(f"Importación finalizada: {nuevas} nuevas, {duplicadas} duplicadas, {errores} errores")
 
@@ -8,13 +8,12 @@ Ejecuta en hilo de fondo con progreso en tiempo real via SSE.
 
 import requests
 from bs4 import BeautifulSoup
-import sqlite3
 import re
 import time
 import threading
 import xml.etree.ElementTree as ET
 from metadata_extractor import normalizar_letra
-from database import DB_NAME, generar_hash
+from database import get_db, liberar_db, importar_letras, generar_hash, LOTE_IMPORTACION, filtro_categoria
 
 SITEMAP_URL = "https://letrasdecarnaval.com/sitemap.xml"
 
@@ -201,121 +200,114 @@ def _worker_scraper():
     """Hilo de fondo que ejecuta el scraper completo."""
     global scraper_state
     state = scraper_state
+    lote = []
 
-    try:
-        state.mensaje = "Descargando sitemap.xml..."
-        urls = obtener_urls_sitemap()
-    except Exception as e:
-        state.mensaje = f"Error descargando sitemap: {e}"
-        state.running = False
-        state.terminado = True
-        return
-
-    # Filtrar URLs que ya estan en la DB
-    state.mensaje = "Filtrando URLs ya descargadas..."
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT url FROM letras WHERE fuente='letrasdecarnaval'")
-    urls_existentes = {row["url"] for row in cursor.fetchall()}
-    conn.close()
-
-    urls_nuevas = [u for u in urls if u not in urls_existentes]
-
-    with state.lock:
-        state.total = len(urls_nuevas)
-        state.mensaje = f"Sitemap: {len(urls)} totales, {len(urls_nuevas)} nuevas por descargar"
-
-    if not urls_nuevas:
-        state.mensaje = f"Todo al dia. Las {len(urls)} letras del sitemap ya estan descargadas."
-        state.running = False
-        state.terminado = True
-        return
-
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    for i, url in enumerate(urls_nuevas):
-        # Comprobar si se pidio parar
-        if state.should_stop:
-            state.mensaje = f"Detenido por el usuario. Guardadas {state.nuevas} letras nuevas."
-            break
-
-        with state.lock:
-            state.procesadas = i + 1
-
-        meta = parsear_metadata_url(url)
-
-        # Rate limiting
-        time.sleep(1.0)
-
+    def volcar_lote():
+        if not lote:
+            return
         try:
-            titulo_pagina, contenido_raw = scrape_letra_page(url)
+            resultado = importar_letras(lote)
+            with state.lock:
+                state.nuevas += resultado["nuevas"]
+                state.duplicadas += resultado["duplicadas"]
+                state.ultima_letra = lote[-1]["titulo"]
+                state.mensaje = f"[{state.procesadas}/{state.total}] +{state.nuevas} nuevas | {state.duplicadas} dup | {state.errores} err"
         except Exception:
             with state.lock:
-                state.errores += 1
-            continue
+                state.errores += len(lote)
+        lote.clear()
 
-        if not contenido_raw:
-            with state.lock:
-                state.errores += 1
-            continue
+    # running se libera siempre, tambien si algo falla a mitad
+    try:
+        try:
+            state.mensaje = "Descargando sitemap.xml..."
+            urls = obtener_urls_sitemap()
+        except Exception as e:
+            state.mensaje = f"Error descargando sitemap: {e}"
+            return
+
+        # Filtrar URLs que ya estan en la DB
+        state.mensaje = "Filtrando URLs ya descargadas..."
+        conn = get_db()
+        try:
+            urls_existentes = {row["url"] for row in conn.execute(
+                "SELECT url FROM letras WHERE " + filtro_categoria("fuentes"), ("letrasdecarnaval",))}
+        finally:
+            liberar_db(conn)
 
-        contenido = normalizar_letra(contenido_raw)
+        urls_nuevas = [u for u in urls if u not in urls_existentes]
 
-        if not contenido or len(contenido) < 30:
-            with state.lock:
-                state.errores += 1
-            continue
-
-        contenido_hash = generar_hash(contenido)
-        cursor.execute("SELECT id FROM letras WHERE contenido_hash=?", (contenido_hash,))
-        if cursor.fetchone():
-            with state.lock:
-                state.duplicadas += 1
-            continue
+        with state.lock:
+            state.total = len(urls_nuevas)
+            state.mensaje = f"Sitemap: {len(urls)} totales, {len(urls_nuevas)} nuevas por descargar"
 
-        titulo_final = titulo_pagina or meta.get("titulo_extraido") or "Sin titulo"
-        agrupacion = meta.get("agrupacion")
+        if not urls_nuevas:
+            state.mensaje = f"Todo al dia. Las {len(urls)} letras del sitemap ya estan descargadas."
+            return
 
+        # El lote pendiente se vuelca aunque el bucle termine por una excepcion
         try:
-            cursor.execute("""
-                INSERT INTO letras
-                (titulo, anio, modalidad, tipo_pieza, agrupacion, autor, contenido, contenido_hash, url, fuente, fecha_scraping)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
-            """, (
-                titulo_final,
-                meta.get("anio"),
-                meta.get("modalidad"),
-                meta.get("tipo_pieza"),
-                agrupacion,
-                None,
-                contenido,
-                contenido_hash,
-                url,
-                "letrasdecarnaval",
-            ))
-            conn.commit()
-            with state.lock:
-                state.nuevas += 1
-                state.ultima_letra = titulo_final
-                state.mensaje = f"[{state.procesadas}/{state.total}] +{state.nuevas} nuevas | {state.duplicadas} dup | {state.errores} err"
-        except sqlite3.IntegrityError:
-            with state.lock:
-                state.duplicadas += 1
-        except Exception:
-            with state.lock:
-                state.errores += 1
+            for i, url in enumerate(urls_nuevas):
+                # Comprobar si se pidio parar
+                if state.should_stop:
+                    break
+
+                with state.lock:
+                    state.procesadas = i + 1
+
+                meta = parsear_metadata_url(url)
+
+                # Rate limiting
+                time.sleep(1.0)
+
+                try:
+                    titulo_pagina, contenido_raw = scrape_letra_page(url)
+                except Exception:
+                    with state.lock:
+                        state.errores += 1
+                    continue
+
+                if not contenido_raw:
+                    with state.lock:
+                        state.errores += 1
+                    continue
+
+                contenido = normalizar_letra(contenido_raw)
+
+                if not contenido or len(contenido) < 30:
+                    with state.lock:
+                        state.errores += 1
+                    continue
+
+                titulo_final = titulo_pagina or meta.get("titulo_extraido") or "Sin titulo"
+
+                lote.append({
+                    "titulo": titulo_final,
+                    "anio": meta.get("anio"),
+                    "modalidad": meta.get("modalidad"),
+                    "tipo_pieza": meta.get("tipo_pieza"),
+                    "agrupacion": meta.get("agrupacion"),
+                    "contenido": contenido,
+                    "contenido_hash": generar_hash(contenido),
+                    "url": url,
+                    "fuente": "letrasdecarnaval",
+                })
+                if len(lote) >= LOTE_IMPORTACION:
+                    volcar_lote()
+        finally:
+            volcar_lote()
 
-    conn.close()
-
-    if not state.should_stop:
-        state.mensaje = f"Completado: {state.nuevas} nuevas, {state.duplicadas} duplicadas, {state.errores} errores"
-
-    state.running = False
-    state.terminado = True
+        if state.should_stop:
+            state.mensaje = f"Detenido por el usuario. Guardadas {state.nuevas} letras nuevas."
+        else:
+            state.mensaje = f"Completado: {state.nuevas} nuevas, {state.duplicadas} duplicadas, {state.errores} errores"
+    except Exception as e:
+        with state.lock:
+            state.mensaje = f"Error en el scraper: {e}"
+    finally:
+        with state.lock:
+            state.running = False
+            state.terminado = True
 
 
 def iniciar_scraper():
@@ -246,7 +246,7 @@ function buscarFullText() {
     const cont = document.getElementById("resultadosBusqueda");
     cont.innerHTML = '<div class="loading">Buscando...</div>';
 
-    fetch("/api/buscar?q=" + encodeURIComponent(q))
+    fetch("/api/buscar?facetas=1&q=" + encodeURIComponent(q))
         .then(r => r.json())
         .then(data => {
             cont.innerHTML = "";
@@ -261,6 +261,8 @@ function buscarFullText() {
             header.textContent = `${data.total} resultados para "${data.query}"`;
             cont.appendChild(header);
 
+            if (data.facetas) cont.appendChild(renderFacetas(data.facetas));
+
             data.resultados.forEach(r => {
                 const item = document.createElement("div");
                 item.className = "resultado-item";
@@ -280,6 +282,28 @@ function buscarFullText() {
         });
 }
 
+function renderFacetas(facetas) {
+    const grupos = [
+        ["modalidad", "tag modalidad", v => v],
+        ["decada", "tag anio", v => `${v}s`],
+        ["tipo_pieza", "tag tipo", v => v],
+        ["agrupacion", "tag", v => v],
+    ];
+    const div = document.createElement("div");
+    div.className = "facetas";
+    grupos.forEach(([clave, clase, etiqueta]) => {
+        const valores = facetas[clave] || [];
+        if (!valores.length) return;
+        const fila = document.createElement("div");
+        fila.className = "faceta";
+        fila.innerHTML = valores
+            .map(f => `<span class="${clase}">${escapeHtml(String(etiqueta(f.valor)))} (${f.total})</span>`)
+            .join(" ");
+        div.appendChild(fila);
+    });
+    return div;
+}
+
 // ==============================
 // DETALLE (MODAL)
 // ==============================
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Sin hilos de copias ni de mantenimiento al importar app
+os.environ.setdefault("COPIAS_INTERVALO_HORAS", "0")
+os.environ.setdefault("MANTENIMIENTO_INTERVALO_S", "0")
+
+
+@pytest.fixture(scope="session")
+def bd(tmp_path_factory):
+    """Base de datos migrada en un directorio temporal (antes de importar app)."""
+    import database
+
+    database.DB_NAME = str(tmp_path_factory.mktemp("bd") / "database.db")
+    database.migrate_db()
+    return database
+
+
+@pytest.fixture(scope="session")
+def cliente(bd):
+    import app
+
+    return app.app.test_client()
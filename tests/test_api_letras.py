@@ -0,0 +1,26 @@
+import base64
+import json
+
+import pytest
+
+
+def _cursor(valor, letra_id):
+    return base64.urlsafe_b64encode(json.dumps([valor, letra_id]).encode()).decode().rstrip("=")
+
+
+def test_paginacion_por_cursor(cliente):
+    primera = cliente.get("/api/letras?after=&per_page=1")
+    assert primera.status_code == 200
+    assert len(primera.get_json()["letras"]) <= 1
+
+
+@pytest.mark.parametrize("valor, letra_id", [
+    (["a"], 1),
+    ({"a": 1}, 1),
+    ("titulo", "1"),
+    ("titulo", True),
+])
+def test_cursor_con_tipos_no_validos_da_400(cliente, valor, letra_id):
+    respuesta = cliente.get(f"/api/letras?after={_cursor(valor, letra_id)}")
+    assert respuesta.status_code == 400
+    assert respuesta.get_json()["error"] == "Cursor no valido"
@@ -0,0 +1,20 @@
+def test_lote_con_columnas_distintas_respeta_los_default(bd):
+    registros = [
+        {"titulo": "Con calidad", "contenido": "primera letra de prueba " * 5,
+         "url": "https://ejemplo.test/1", "calidad": 80, "verificado": 1},
+        {"titulo": "Sin calidad", "contenido": "segunda letra de prueba " * 5,
+         "url": "https://ejemplo.test/2"},
+    ]
+    assert bd.importar_letras(registros) == {"nuevas": 2, "duplicadas": 0}
+
+    conn = bd.abrir_conexion(solo_lectura=True)
+    try:
+        filas = {row["url"]: row for row in conn.execute(
+            "SELECT url, calidad, verificado, fuente FROM letras WHERE url LIKE 'https://ejemplo.test/%'")}
+    finally:
+        conn.close()
+
+    assert (filas["https://ejemplo.test/1"]["calidad"], filas["https://ejemplo.test/1"]["verificado"]) == (80, 1)
+    # Las columnas que el registro no trae toman el DEFAULT, no el NULL del lote
+    sin = filas["https://ejemplo.test/2"]
+    assert (sin["calidad"], sin["verificado"], sin["fuente"]) == (0, 0, "letrasdesdeelparaiso")